@@ -50,6 +50,19 @@ Stepper stepperD(57, 58, 59, 2);
 
 CommandInterpreter commander(handler);
 
+// Axis that were started together by GOALL and haven't finished yet, one bit
+// per axis. They get a single NOTICE DONE ALL instead of one each.
+uint8_t groupAxes = 0;
+
+// Axis running a move from the queue.  Once they are all done and the queue
+// is empty, NOTICE DONE QUEUE is sent.
+uint8_t queueAxes = 0;
+
+// WATCH: how often to send a position report (0 for never), in ms, and
+// millis() when the last one went out
+unsigned long watchPeriod = 0;
+unsigned long lastWatchTime = 0;
+
 #if defined(__AVR_ATmega1280__) 
 
 // Dragon stop motion talks to the camera
@@ -62,6 +75,18 @@ void handler( CommandInterpreter::Message *msg ) {
     case M_GO:
       handleGO(msg->fields[0], msg->fields[1], msg->fields[2]);
       break;
+    case M_GOALL:
+      handleGOALL(msg->fields, msg->fields[MAX_STEPPERS]);
+      break;
+    case M_LINE:
+      handleLINE(msg->fields, msg->fields[MAX_STEPPERS]);
+      break;
+    case M_QUEUE:
+      handleQUEUE(msg->fields, msg->fields[MAX_STEPPERS]);
+      break;
+    case M_FLUSH:
+      handleFLUSH();
+      break;
     case M_STOP:
       handleSTOP();
       break;
@@ -80,6 +105,9 @@ void handler( CommandInterpreter::Message *msg ) {
     case M_STATE:
       handleSTATE();
       break;
+    case M_WATCH:
+      handleWATCH(msg->fields[0]);
+      break;
   }
 }
 
@@ -90,9 +118,8 @@ void handleGO(uint8_t axis, long position, long time) {
   }
   
   if (Stepper::getStepper(axis).moveAbsolute(position, time)) {
-    char buffer[50];
-    sprintf(buffer, "GO %d %ld %ld", axis, position, time);
-    commander.sendACK(buffer);
+    long reply[] = { axis, position, time };
+    commander.sendACK(M_GO, reply, 3);
   }
   else {
     // TODO: Give a better reason here?
@@ -101,24 +128,91 @@ void handleGO(uint8_t axis, long position, long time) {
 }
 
 
+void handleGOALL(long* positions, long time) {
+  handleGroupMove(M_GOALL, positions, time, false);
+}
+
+
+void handleLINE(long* positions, long time) {
+  handleGroupMove(M_LINE, positions, time, true);
+}
+
+
+void handleGroupMove(MESSAGE_TYPE type, long* positions, long time, boolean coordinated) {
+  uint8_t started = Stepper::moveAll(positions, time, coordinated);
+
+  // The axis that did start will still report DONE ALL when they finish
+  groupAxes |= started;
+
+  if ( started == 0 ) {
+    commander.sendERROR("Couldn't acheive desired motion");
+    return;
+  }
+
+  for ( uint8_t axis = 1; axis <= Stepper::count(); axis++) {
+    if ( !(started & (1 << axis)) ) {
+      commander.sendERROR("Couldn't acheive desired motion");
+      return;
+    }
+  }
+
+  long reply[] = { positions[0], positions[1], positions[2], positions[3], time };
+  commander.sendACK(type, reply, 5);
+}
+
+
+void handleQUEUE(long* positions, long time) {
+  if ( !Stepper::queueSegment(positions, time) ) {
+    commander.sendERROR("queue full");
+    return;
+  }
+  
+  long reply[] = { Stepper::queueFree() };
+  commander.sendACK(M_QUEUE, reply, 1);
+}
+
+
+void handleFLUSH() {
+  boolean flushed = Stepper::queueFree() != QUEUE_LEN;
+  Stepper::flushQueue();
+  commander.sendACK("FLUSH");
+  
+  // With no queued move running, there's no DONE coming to finish it off
+  if ( flushed && queueAxes == 0 ) {
+    commander.sendDONE("QUEUE");
+  }
+}
+
+
 void handleSTOP() {
+  boolean flushed = Stepper::queueFree() != QUEUE_LEN;
+  Stepper::flushQueue();
+  
   for ( uint8_t axis = 1; axis <= Stepper::count(); axis++) { 
     Stepper::getStepper(axis).stop();
   }
   
   commander.sendACK("STOP");
+  
+  if ( flushed && queueAxes == 0 ) {
+    commander.sendDONE("QUEUE");
+  }
 }  
 
 void handleGET(uint8_t parameterName, uint8_t axis) {  
-  char buffer[50];
+  long value;
   boolean good = false;
   switch (parameterName) {
     case P_VERSION:
-      sprintf(buffer, "GET VERSION %ld", versionNumber);
+      value = versionNumber;
       good = true;
       break;
     case P_INDEX:
-      sprintf(buffer, "GET INDEX %ld", settings.index);
+      value = settings.index;
+      good = true;
+      break;
+    case P_QUEUE:
+      value = Stepper::queueFree();
       good = true;
       break;
     case P_MAX_VEL:
@@ -126,22 +220,16 @@ void handleGET(uint8_t parameterName, uint8_t axis) {
         commander.sendERROR("parameter axis out of bounds");
         return;
       }
-     {
-      long velocity = Stepper::getStepper(axis).getMaxVelocity();
-      sprintf(buffer, "GET MAX_VEL %d %ld", axis, velocity);
+      value = Stepper::getStepper(axis).getMaxVelocity();
       good = true;
-     }
       break;
     case P_ACCEL:
       if ( !Stepper::indexValid(axis)  ) {
         commander.sendERROR("parameter axis out of bounds");
         return;
       }
-     {
-      long acceleration = Stepper::getStepper(axis).getAcceleration();
-      sprintf(buffer, "GET ACCEL %d %ld", axis, acceleration);
+      value = Stepper::getStepper(axis).getAcceleration();
       good = true;
-     }
       break;
     case P_STOP_MODE:
       if ( !Stepper::indexValid(axis)  ) {
@@ -149,36 +237,28 @@ void handleGET(uint8_t parameterName, uint8_t axis) {
         return;
       }
       // TODO: Add better interface for this
-     {
-       int mode = 0;
-       
       switch(Stepper::getStepper(axis).getStopMode()) {
-        case S_KEEP_ENABLED: mode = 0; break;
-        case S_DISABLE:      mode = 1; break;
+        case S_KEEP_ENABLED: value = 0; break;
+        case S_DISABLE:      value = 1; break;
         default:
           commander.sendERROR("stop mode not understood");
           return;
       }
-
-      sprintf(buffer, "GET STOP_MODE %d %d", axis, mode);
       good = true;
-     }
       break;
     case P_POS:
       if ( !Stepper::indexValid(axis)  ) {
         commander.sendERROR("parameter axis out of bounds");
         return;
       }
-     {
-      long position = Stepper::getStepper(axis).getPosition();
-      sprintf(buffer, "GET POS %d %ld", axis, position);
+      value = Stepper::getStepper(axis).getPosition();
       good = true;
-     }
       break;
   }
   
   if (good) {
-    commander.sendACK(buffer);
+    long reply[] = { parameterName, axis, value };
+    commander.sendACK(M_GET, reply, 3);
   }
   else {
     commander.sendERROR("invalid parameter");
@@ -187,19 +267,22 @@ void handleGET(uint8_t parameterName, uint8_t axis) {
 
 
 void handleSET(uint8_t parameterName, long value1, long value2) {  
-  // TODO: Don't allow anything to be set while in motion?
+  // The Stepper setters refuse while the axis is moving, so those come back
+  // as "invalid parameter"
   
-  char buffer[50];
   boolean good = false;
   switch (parameterName) {
     case P_VERSION:
       commander.sendERROR("Can't change the version number!");
       return;
       break;
+    case P_QUEUE:
+      commander.sendERROR("Can't set the queue size!");
+      return;
+      break;
     case P_INDEX:
       settings.index = value2;
       saveSettings();
-      sprintf(buffer, "SET INDEX %ld", settings.index);
       good = true;
       break;
     case P_MAX_VEL:
@@ -211,7 +294,6 @@ void handleSET(uint8_t parameterName, long value1, long value2) {
       
       if ( good ) {
         saveSettings();
-        sprintf(buffer, "SET MAX_VEL %ld %ld", value1, value2);
       }
       break;
     case P_ACCEL:
@@ -223,7 +305,6 @@ void handleSET(uint8_t parameterName, long value1, long value2) {
       
       if ( good ) {
         saveSettings();
-        sprintf(buffer, "SET ACCEL %ld %ld", value1, value2);
       }
       break;
     case P_STOP_MODE:
@@ -238,6 +319,7 @@ void handleSET(uint8_t parameterName, long value1, long value2) {
         case 1: mode = S_DISABLE; break;
         default:
           commander.sendERROR("stop mode not understood");
+          return;
       }
         
       
@@ -246,7 +328,6 @@ void handleSET(uint8_t parameterName, long value1, long value2) {
       
       if ( good ) {
         saveSettings();
-        sprintf(buffer, "SET STOP_MODE %ld %ld", value1, value2);
       }
       break;
     case P_POS:
@@ -255,15 +336,12 @@ void handleSET(uint8_t parameterName, long value1, long value2) {
         return;
       }
       good = Stepper::getStepper(value1).setPosition(value2);
-      
-      if ( good ) {
-        sprintf(buffer, "SET POS %ld %ld", value1, value2);
-      }
       break;
   }
   
   if (good) {
-    commander.sendACK(buffer);
+    long reply[] = { parameterName, value1, value2 };
+    commander.sendACK(M_SET, reply, 3);
   }
   else {
     commander.sendERROR("invalid parameter");
@@ -277,9 +355,8 @@ void handleHOME(uint8_t axis) {
   }
   
   if (Stepper::getStepper(axis).home()) {
-    char buffer[50];
-    sprintf(buffer, "HOME %d", axis);
-    commander.sendACK(buffer);
+    long reply[] = { axis };
+    commander.sendACK(M_HOME, reply, 1);
   }
   else {
     // TODO: Give a better reason here?
@@ -327,6 +404,42 @@ void handleSTATE() {
 }
 
 
+void handleWATCH(long period) {
+  if ( period < 0 ) {
+    commander.sendERROR("period out of bounds");
+    return;
+  }
+  
+  if ( period != 0 && period < MIN_WATCH_PERIOD ) {
+    period = MIN_WATCH_PERIOD;
+  }
+  watchPeriod = period;
+  
+  long reply[] = { period };
+  commander.sendACK(M_WATCH, reply, 1);
+  
+  // First report straight away
+  lastWatchTime = millis() - watchPeriod;
+}
+
+
+void checkWatch() {
+  if ( watchPeriod == 0 || millis() - lastWatchTime < watchPeriod ) {
+    return;
+  }
+  // If we fell behind, skip the reports we missed instead of catching up
+  lastWatchTime = millis();
+  
+  long positions[MAX_STEPPERS];
+  uint8_t states[MAX_STEPPERS];
+  for ( uint8_t axis = 1; axis <= Stepper::count(); axis++) {
+    positions[axis - 1] = Stepper::getStepper(axis).getPosition();
+    states[axis - 1] = Stepper::getStepper(axis).getState();
+  }
+  commander.sendPOS(lastWatchTime, positions, states, Stepper::count());
+}
+
+
 void restoreSettings() {
   
   int offset = 0;
@@ -432,10 +545,45 @@ char buff[25];
 void loop() {
   for ( uint8_t axis = 1; axis <= Stepper::count(); axis++) { 
     if ( Stepper::getStepper(axis).checkFinished() ) {
-      sprintf(buff, "%d", axis);
-      commander.sendDONE(buff);
+      if ( queueAxes & (1 << axis) ) {
+        // Running from the queue, only report once it has all been run
+        queueAxes &= ~(1 << axis);
+        if ( queueAxes == 0 && Stepper::queueFree() == QUEUE_LEN ) {
+          commander.sendDONE("QUEUE");
+        }
+      }
+      else if ( groupAxes & (1 << axis) ) {
+        // Part of a GOALL, only report once the last one is in
+        groupAxes &= ~(1 << axis);
+        if ( groupAxes == 0 ) {
+          commander.sendDONE("ALL");
+        }
+      }
+      else {
+        sprintf(buff, "%d", axis);
+        commander.sendDONE(buff);
+      }
     }
   }
   
+  // Keep the queued moves coming
+  uint8_t started = Stepper::checkQueue();
+  if ( started == QUEUE_REFUSED ) {
+    // The host should stop streaming.  If that was the last of the queue,
+    // nothing else is going to finish it off.
+    sprintf(buff, "QUEUE REFUSED %d", Stepper::queueFree());
+    commander.sendNOTICE(buff);
+    if ( queueAxes == 0 && Stepper::queueFree() == QUEUE_LEN ) {
+      commander.sendDONE("QUEUE");
+    }
+  }
+  else if ( started != 0 ) {
+    queueAxes |= started;
+    sprintf(buff, "QUEUE %d", Stepper::queueFree());
+    commander.sendNOTICE(buff);
+  }
+  
+  checkWatch();
+  
   commander.checkSerialInput();
 }
@@ -4,10 +4,35 @@
 #include "WProgram.h"
 
 #define CMD_BUF_LEN 64
-#define MAX_MSG_FIELDS 4
+#define MAX_MSG_FIELDS 5    // GOALL/LINE: a position for each of the 4 axes, plus time
 
+// Binary frames, used after a BINARY handshake:
+// [FRAME_START | type] [payload length] [payload] [CRC-8 of everything before it]
+// Commands use their MESSAGE_TYPE as the type, with each value packed as a
+// byte (axis, parameter) or a little-endian long.  Replies use these types:
+#define FRAME_START       0x80
+#define FRAME_ACK         0x40    // Message type, then a long for each value
+#define FRAME_ACK_TEXT    0x41    // Text of the ACK, for ones without values
+#define FRAME_ERROR       0x42
+#define FRAME_NOTICE      0x43
+#define FRAME_DONE        0x44
+#define FRAME_POS         0x45    // millis(), then a long position and a state byte for each axis
+#define FRAME_OVERHEAD    3       // Type, length and CRC
+
+// How long to wait for an ALIVE after switching baud rates before giving up
+// and going back to the old one, in ms
+#define BAUD_VERIFY_TIME  1000
+
+// Shortest period WATCH will send position reports at, in ms
+#define MIN_WATCH_PERIOD  20
+
+// These numbers go over the wire in binary mode, so add new ones to the end
 enum MESSAGE_TYPE {
   M_GO,
+  M_GOALL,
+  M_LINE,
+  M_QUEUE,
+  M_FLUSH,
   M_STOP,
   M_SET,
   M_GET,
@@ -15,9 +40,13 @@ enum MESSAGE_TYPE {
   M_STATE,
   M_ALIVE,
   M_CLICK,
+  M_BINARY,
+  M_BAUD,
+  M_WATCH,
   NOT_A_MESSAGE,
 };
 
+// Also sent in binary mode, same as MESSAGE_TYPE
 enum PARAMETER {
   P_VERSION,
   P_INDEX,
@@ -25,6 +54,7 @@ enum PARAMETER {
   P_ACCEL,
   P_STOP_MODE,
   P_POS,
+  P_QUEUE,
   NOT_A_PARAMETER,
 };
 
@@ -42,18 +72,26 @@ class CommandInterpreter {
  
   CommandInterpreter(CommandHandler handler);
   
-  void begin( unsigned int baudrate );
+  void begin( long baudrate );
  
   void checkSerialInput();
   
   void sendACK( const char* message );
+  // ACK for a message type followed by its values; in binary mode the values
+  // are sent as longs instead of text.  For GET and SET the first value is
+  // the parameter, and the axis is left out of the text if it doesn't need one.
+  void sendACK( MESSAGE_TYPE type, const long* values, uint8_t count );
   void sendERROR( const char* message );
   void sendNOTICE( const char* message );
   void sendDONE( const char* message );
+  // Position report for WATCH: the time it was taken, then the position and
+  // STEPPER_STATE of each axis
+  void sendPOS( unsigned long time, const long* positions, const uint8_t* states, uint8_t count );
 
  private:
   enum MESSAGE_VALUE_TYPE {
     MT_INTEGER,
+    MT_AXIS,          // Integer, but only a byte in binary mode
     MT_PARAM_NAME,
     NOT_A_VALUE,
   };
@@ -72,15 +110,31 @@ class CommandInterpreter {
 
   static MESSAGE_VALUE_TYPE NO_VALUES[];
   static MESSAGE_VALUE_TYPE GO_VALUES[];
+  static MESSAGE_VALUE_TYPE GOALL_VALUES[];
   static MESSAGE_VALUE_TYPE SET_VALUES[];
   static MESSAGE_VALUE_TYPE GET_VALUES[];
   static MESSAGE_VALUE_TYPE HOME_VALUES[];
+  static MESSAGE_VALUE_TYPE BAUD_VALUES[];
+  static MESSAGE_VALUE_TYPE WATCH_VALUES[];
+  
+  static long baudRates[];
  
   static MessageTypeDefinition messageTypes[];
   static ParameterDefinition parameterTypes[];
  
   boolean processCommand( const char *cmd, Message& msg );
   
+  boolean processFrame( const uint8_t *frame, Message& msg );
+  
+  void sendFrame( uint8_t type, const uint8_t* payload, uint8_t length );
+  
+  static uint8_t crc8( const uint8_t* data, uint8_t length );
+  static uint8_t crc8Update( uint8_t crc, uint8_t data );
+  
+  void changeBaud( long rate );
+  
+  void checkBaud();
+  
   void sendReply( const char *str );
   
   int parseCmdType( const char *cmd, Message& msg );
@@ -93,6 +147,14 @@ class CommandInterpreter {
   char paramBuf[CMD_BUF_LEN+1];
   char commandBufIdx;
   
+  boolean binaryMode;   //< Replies go out as frames, set by BINARY
+  boolean inFrame;      //< commandBuf holds a frame instead of a line
+  
+  long baudRate;
+  long oldBaudRate;             //< Rate to go back to if the new one doesn't work
+  unsigned long baudChangeTime; //< millis() when the rate was changed
+  boolean verifyingBaud;        //< Waiting for an ALIVE at the new rate
+  
   CommandHandler cmdHandler;
 };
 
@@ -11,17 +11,52 @@
  * ACK is sent by the controller immediately after GO recvd.  POSITION and TIME may be modified if POSITION was out of range or TIME was too short.
  * NOTICE DONE is sent when the move completes
  * 
+ * GOALL position1 position2 position3 position4 time
+ * ACK GOALL position1 position2 position3 position4 time
+ * NOTICE DONE ALL
+ *
+ * GOALL Starts all axis moving towards their POSITIONs at the same instant.  TIME is reported back as the time the
+ * slowest axis will take.  A single NOTICE DONE ALL is sent once every axis has arrived, instead of one per axis.
+ * 
+ * LINE position1 position2 position3 position4 time
+ * ACK LINE position1 position2 position3 position4 time
+ * NOTICE DONE ALL
+ *
+ * LINE Is GOALL, except that every axis is slowed down to take as long as the slowest one, so the axis move in a
+ * straight line and all finish on the same tick.  TIME is raised if any axis can't make it that fast.
+ * 
  * STOP Tells the controller to stop the motion of all axis immediately
  * ACK is sent by the controller immediately after DONE recvd.
  * NOTICE DONE will be recieved on any axis that were moving
  *
+ * QUEUE position1 position2 position3 position4 time
+ * ACK QUEUE free
+ * NOTICE QUEUE free
+ * NOTICE QUEUE REFUSED free
+ * NOTICE DONE QUEUE
+ *
+ * QUEUE Adds a LINE move to the back of the controller's move queue, so the host can stream moves ahead of the ones
+ * being run.  Queued moves start back to back as each one finishes.  FREE is the number of queue slots left; NOTICE
+ * QUEUE is sent with the new count each time a queued move starts.  NOTICE DONE QUEUE is sent when the queue has run
+ * dry and the last move has finished.  ERROR is sent if the queue is full.  If no axis will start a queued move (they
+ * are all held at their limit switches, say), it is thrown away and NOTICE QUEUE REFUSED is sent instead.
+ *
+ * FLUSH
+ * ACK FLUSH
+ *
+ * Throws away any queued moves that haven't started.  STOP also flushes the queue.  If no queued move is running
+ * to finish it off, NOTICE DONE QUEUE follows the ACK.
+ *
  * SET param value
  * ACK SET param value
  * Sets PARAM to VALUE.  Valid PARAMs are: VERSION, INDEX, MAX_VELOCITY, ACCEL, POS
+ * Only INDEX can be set while the axis is moving; anything else gets ERROR invalid parameter.
+ * ACCEL is in steps/s^2.  If it is non-zero, moves ramp up to speed and back down with a trapezoidal profile, and the
+ * TIME reported in ACK GO includes the ramps.  0 means start and stop at full speed.
  * 
  * GET param value
  * ACK GET param value
- * Gets the current VALUE of PARAM.
+ * Gets the current VALUE of PARAM.  GET QUEUE gives the number of free slots in the move queue.
  * 
  * HOME axis
  * ACK HOME axis
@@ -46,7 +81,30 @@
  *
  * Send a click to the camera, which is on the second serial port
  *
- 
+ * BINARY
+ * ACK BINARY
+ *
+ * Switch to binary frames (see commands.h) for everything after the ACK, which is still sent as text.  Commands can
+ * then be sent as frames or as text lines; any text line switches the controller back to text.  Blank lines are
+ * ignored, so a host that has lost track can send CMD_BUF_LEN newlines to finish off a partial frame, then ALIVE.
+ * Older firmware answers BINARY with ERROR, and the host should stay with text.
+ *
+ * BAUD rate
+ * ACK BAUD rate
+ *
+ * Switch the link to RATE (one of 9600, 19200, 38400, 57600, 115200, 250000, 500000, 1000000) once the ACK has been
+ * sent at the old rate.  The host then has BAUD_VERIFY_TIME ms to send an ALIVE at the new rate, or the controller
+ * goes back to the old one.  Anything else that arrives in the meantime is handled as normal.
+ *
+ * WATCH period
+ * ACK WATCH period
+ * NOTICE POS time position1 position2 position3 position4 states
+ *
+ * Report the position and state of every axis each PERIOD ms, until WATCH 0.  PERIOD is raised to MIN_WATCH_PERIOD if
+ * it is shorter.  TIME is millis() when the report was taken, and STATES has a digit for each axis, its
+ * STEPPER_STATE (0 READY, 1 MOVING, 3 and 4 HOMING, 7 ERROR).  In binary mode reports are FRAME_POS frames instead.
+ * A text report can take up to 75 characters, so at 9600 baud it is best not to ask for more than a few a second.
+ *
 */
 
 
@@ -66,11 +124,17 @@ CommandInterpreter::ParameterDefinition CommandInterpreter::parameterTypes[] = {
   { "ACCEL",    P_ACCEL,        true },
   { "STOP_MODE",P_STOP_MODE,    true },
   { "POS",      P_POS,          true },
+  { "QUEUE",    P_QUEUE,        false },    // Free slots in the move queue (read only)
   { NULL,       NOT_A_PARAMETER },
 };
 
 
+// Names are matched by prefix, so GOALL has to come before GO
 CommandInterpreter::MessageTypeDefinition CommandInterpreter::messageTypes[] = {
+  { "GOALL",  M_GOALL      , GOALL_VALUES },  // GOALL position1 position2 position3 position4 time
+  { "LINE",   M_LINE       , GOALL_VALUES },  // LINE position1 position2 position3 position4 time
+  { "QUEUE",  M_QUEUE      , GOALL_VALUES },  // QUEUE position1 position2 position3 position4 time
+  { "FLUSH",  M_FLUSH      , NO_VALUES  },    // FLUSH
   { "GO",     M_GO         , GO_VALUES  },    // GO axis position time
   { "STOP",   M_STOP       , NO_VALUES  },    // STOP
   { "GET",    M_GET        , GET_VALUES },    // GET param axis
@@ -79,29 +143,84 @@ CommandInterpreter::MessageTypeDefinition CommandInterpreter::messageTypes[] = {
   { "STATE",  M_STATE      , NO_VALUES  },    // STATE
   { "ALIVE",  M_ALIVE      , NO_VALUES  },    // ALIVE
   { "CLICK",  M_CLICK      , NO_VALUES  },    // Send a 'click' to the camera
+  { "BINARY", M_BINARY     , NO_VALUES  },    // Switch to binary frames
+  { "BAUD",   M_BAUD       , BAUD_VALUES },   // BAUD rate
+  { "WATCH",  M_WATCH      , WATCH_VALUES },  // WATCH period
   { NULL,  NOT_A_MESSAGE, NULL },
 };
 
 CommandInterpreter::MESSAGE_VALUE_TYPE CommandInterpreter::NO_VALUES[]     = {NOT_A_VALUE};
-CommandInterpreter::MESSAGE_VALUE_TYPE CommandInterpreter::GO_VALUES[]     = {MT_INTEGER, MT_INTEGER, MT_INTEGER, NOT_A_VALUE};
-CommandInterpreter::MESSAGE_VALUE_TYPE CommandInterpreter::SET_VALUES[]    = {MT_PARAM_NAME, MT_INTEGER, MT_INTEGER, NOT_A_VALUE};
-CommandInterpreter::MESSAGE_VALUE_TYPE CommandInterpreter::GET_VALUES[]    = {MT_PARAM_NAME, MT_INTEGER, NOT_A_VALUE};
-CommandInterpreter::MESSAGE_VALUE_TYPE CommandInterpreter::HOME_VALUES[]   = {MT_INTEGER, NOT_A_VALUE};
+CommandInterpreter::MESSAGE_VALUE_TYPE CommandInterpreter::GO_VALUES[]     = {MT_AXIS, MT_INTEGER, MT_INTEGER, NOT_A_VALUE};
+CommandInterpreter::MESSAGE_VALUE_TYPE CommandInterpreter::GOALL_VALUES[]  = {MT_INTEGER, MT_INTEGER, MT_INTEGER, MT_INTEGER, MT_INTEGER, NOT_A_VALUE};
+CommandInterpreter::MESSAGE_VALUE_TYPE CommandInterpreter::SET_VALUES[]    = {MT_PARAM_NAME, MT_AXIS, MT_INTEGER, NOT_A_VALUE};
+CommandInterpreter::MESSAGE_VALUE_TYPE CommandInterpreter::GET_VALUES[]    = {MT_PARAM_NAME, MT_AXIS, NOT_A_VALUE};
+CommandInterpreter::MESSAGE_VALUE_TYPE CommandInterpreter::HOME_VALUES[]   = {MT_AXIS, NOT_A_VALUE};
+CommandInterpreter::MESSAGE_VALUE_TYPE CommandInterpreter::BAUD_VALUES[]   = {MT_INTEGER, NOT_A_VALUE};
+CommandInterpreter::MESSAGE_VALUE_TYPE CommandInterpreter::WATCH_VALUES[]  = {MT_INTEGER, NOT_A_VALUE};
+
+long CommandInterpreter::baudRates[] = { 9600, 19200, 38400, 57600, 115200, 250000, 500000, 1000000, 0 };
 
 
 CommandInterpreter::CommandInterpreter(CommandHandler handler) : 
   commandBufIdx(0),
+  binaryMode(false),
+  inFrame(false),
+  verifyingBaud(false),
   cmdHandler(handler)
 {
 }
 
 
-void CommandInterpreter::begin(unsigned int baudrate)
+void CommandInterpreter::begin(long baudrate)
 {
+  baudRate = baudrate;
   Serial.begin(baudrate);
 }
 
+
+void CommandInterpreter::changeBaud( long rate ) {
+  uint8_t i = 0;
+  while( baudRates[i] != 0 && baudRates[i] != rate ) i++;
+  
+  if( baudRates[i] == 0 ) {
+    sendERROR( "baud rate not supported" );
+    return;
+  }
+  
+  sendACK( M_BAUD, &rate, 1 );
+  
+  // Serial.print returns once the last character is handed to the UART, so
+  // give it time to get out before changing the clock under it
+  delay( 2 + 20000 / baudRate );
+  
+  oldBaudRate = baudRate;
+  baudRate = rate;
+  Serial.begin(rate);
+  
+  // Whatever was half read was at the old rate
+  commandBufIdx = 0;
+  
+  baudChangeTime = millis();
+  verifyingBaud = true;
+}
+
+
+void CommandInterpreter::checkBaud() {
+  if( verifyingBaud && millis() - baudChangeTime > BAUD_VERIFY_TIME ) {
+    // Nobody got through at the new rate
+    verifyingBaud = false;
+    baudRate = oldBaudRate;
+    Serial.begin(baudRate);
+    commandBufIdx = 0;
+  }
+}
+
 void CommandInterpreter::sendERROR( const char* message ) {
+  if ( binaryMode ) {
+    sendFrame( FRAME_ERROR, (const uint8_t*)message, strlen(message) );
+    return;
+  }
+  
   Serial.print("ERROR ");
   Serial.print(message);
   Serial.print("\n");
@@ -109,24 +228,154 @@ void CommandInterpreter::sendERROR( const char* message ) {
 
 
 void CommandInterpreter::sendACK( const char* message ) {
+  if ( binaryMode ) {
+    sendFrame( FRAME_ACK_TEXT, (const uint8_t*)message, strlen(message) );
+    return;
+  }
+  
   Serial.print("ACK ");
   Serial.print(message);
   Serial.print("\n");
 }
 
 
+void CommandInterpreter::sendACK( MESSAGE_TYPE type, const long* values, uint8_t count ) {
+  if ( binaryMode ) {
+    uint8_t payload[1 + MAX_MSG_FIELDS*4];
+    uint8_t length = 0;
+    
+    payload[length++] = type;
+    for( uint8_t i = 0; i < count; i++ ) {
+      unsigned long value = values[i];
+      for( uint8_t byteIdx = 0; byteIdx < 4; byteIdx++ ) {
+        payload[length++] = value & 0xFF;
+        value >>= 8;
+      }
+    }
+    sendFrame( FRAME_ACK, payload, length );
+    return;
+  }
+  
+  int i=0;
+  while( messageTypes[i].type != type && messageTypes[i].name != NULL ) i++;
+  
+  Serial.print("ACK ");
+  Serial.print(messageTypes[i].name);
+  
+  for( uint8_t valIdx = 0; valIdx < count; valIdx++ ) {
+    Serial.print(" ");
+    
+    // Parameters go out by name, followed by the axis if they have one
+    if( valIdx == 0 && (type == M_GET || type == M_SET) ) {
+      int j=0;
+      while( parameterTypes[j].param != values[0] && parameterTypes[j].name != NULL ) j++;
+      
+      Serial.print(parameterTypes[j].name);
+      if( !parameterTypes[j].requiresAxis ) valIdx++;
+      continue;
+    }
+    
+    Serial.print(values[valIdx]);
+  }
+  Serial.print("\n");
+}
+
+
 void CommandInterpreter::sendNOTICE( const char* message ) {
+  if ( binaryMode ) {
+    sendFrame( FRAME_NOTICE, (const uint8_t*)message, strlen(message) );
+    return;
+  }
+  
   Serial.print("NOTICE ");
   Serial.print(message);
   Serial.print("\n");
 }
 
 void CommandInterpreter::sendDONE( const char* message ) {
-  Serial.print("DONE ");
+  if ( binaryMode ) {
+    sendFrame( FRAME_DONE, (const uint8_t*)message, strlen(message) );
+    return;
+  }
+  
+  Serial.print("NOTICE DONE ");
   Serial.print(message);
   Serial.print("\n");
 }
 
+
+void CommandInterpreter::sendPOS( unsigned long time, const long* positions, const uint8_t* states, uint8_t count ) {
+  if ( binaryMode ) {
+    uint8_t payload[4 + MAX_MSG_FIELDS*5];
+    uint8_t length = 0;
+    
+    for( uint8_t byteIdx = 0; byteIdx < 4; byteIdx++ ) {
+      payload[length++] = time & 0xFF;
+      time >>= 8;
+    }
+    for( uint8_t i = 0; i < count; i++ ) {
+      unsigned long value = positions[i];
+      for( uint8_t byteIdx = 0; byteIdx < 4; byteIdx++ ) {
+        payload[length++] = value & 0xFF;
+        value >>= 8;
+      }
+      payload[length++] = states[i];
+    }
+    sendFrame( FRAME_POS, payload, length );
+    return;
+  }
+  
+  Serial.print("NOTICE POS ");
+  Serial.print(time);
+  for( uint8_t i = 0; i < count; i++ ) {
+    Serial.print(" ");
+    Serial.print(positions[i]);
+  }
+  Serial.print(" ");
+  for( uint8_t i = 0; i < count; i++ ) {
+    Serial.print(states[i], DEC);
+  }
+  Serial.print("\n");
+}
+
+
+void CommandInterpreter::sendFrame( uint8_t type, const uint8_t* payload, uint8_t length ) {
+  uint8_t header[2] = { FRAME_START | type, length };
+  
+  // CRC the header and payload as if they were one buffer
+  uint8_t crc = crc8( header, 2 );
+  for( uint8_t i = 0; i < length; i++ ) {
+    crc = crc8Update( crc, payload[i] );
+  }
+  
+  Serial.write(header[0]);
+  Serial.write(header[1]);
+  for( uint8_t i = 0; i < length; i++ ) {
+    Serial.write(payload[i]);
+  }
+  Serial.write(crc);
+}
+
+
+uint8_t CommandInterpreter::crc8Update( uint8_t crc, uint8_t data ) {
+  // CRC-8, polynomial x^8 + x^2 + x + 1
+  crc ^= data;
+  for( uint8_t bit = 0; bit < 8; bit++ ) {
+    if( crc & 0x80 ) crc = (crc << 1) ^ 0x07;
+    else             crc <<= 1;
+  }
+  return crc;
+}
+
+
+uint8_t CommandInterpreter::crc8( const uint8_t* data, uint8_t length ) {
+  uint8_t crc = 0;
+  for( uint8_t i = 0; i < length; i++ ) {
+    crc = crc8Update( crc, data[i] );
+  }
+  return crc;
+}
+
 //returns the index of the character after the last charater in the message type or -1
 //sets msg->type and msg->typeDefIdx
 int CommandInterpreter::parseCmdType( const char *cmd, Message& msg ) {
@@ -178,6 +427,7 @@ boolean CommandInterpreter::parseMessageValues( const char *str, Message& msg )
     switch( mt.values[valIdx] ) {
       // If it is an integer, read it in as a signed long
       case MT_INTEGER:
+      case MT_AXIS:
         if( 1 != sscanf( str + strIdx, "%ld", &msg.fields[valIdx] ) )
           goto PARSE_ERROR;
         break;
@@ -238,35 +488,139 @@ boolean CommandInterpreter::processCommand( const char* command, Message& msg )
 }
 
 
+//pre: frame holds a complete frame, including the CRC
+//post: msg contains the new command
+//return: true if a valid message was read
+boolean CommandInterpreter::processFrame( const uint8_t* frame, Message& msg ) {
+  uint8_t length = frame[1];
+  
+  if( crc8( frame, length + 2 ) != frame[length + 2] ) {
+    sendERROR( "frame failed CRC" );
+    return false;
+  }
+  
+  int i=0;
+  while( messageTypes[i].name != NULL && messageTypes[i].type != (frame[0] & ~FRAME_START) ) i++;
+  
+  if( messageTypes[i].name == NULL ) {
+    sendERROR( "message had unknown prefix" );
+    return false;
+  }
+  msg.type = messageTypes[i].type;
+  msg.typeDefIdx = i;
+  
+  // Unlike text, every value is always there, even an unused axis
+  const uint8_t* payload = frame + 2;
+  uint8_t payloadIdx = 0;
+  MESSAGE_VALUE_TYPE* values = messageTypes[i].values;
+  for( uint8_t valIdx = 0; values[valIdx] != NOT_A_VALUE; valIdx++ ) {
+    if( values[valIdx] == MT_INTEGER ) {
+      if( payloadIdx + 4 > length ) goto PARSE_ERROR;
+      
+      unsigned long value = 0;
+      for( int8_t byteIdx = 3; byteIdx >= 0; byteIdx-- ) {
+        value = (value << 8) | payload[payloadIdx + byteIdx];
+      }
+      msg.fields[valIdx] = value;
+      payloadIdx += 4;
+    }
+    else {
+      if( payloadIdx + 1 > length ) goto PARSE_ERROR;
+      msg.fields[valIdx] = payload[payloadIdx++];
+      
+      if( values[valIdx] == MT_PARAM_NAME && msg.fields[valIdx] >= NOT_A_PARAMETER )
+        goto PARSE_ERROR;
+    }
+  }
+  
+  if( payloadIdx != length ) goto PARSE_ERROR;
+  
+  return true;
+  
+ PARSE_ERROR: 
+  sendERROR( "message arguments did not parse" );
+  msg.type = NOT_A_MESSAGE;
+  return false;
+}
+
+
 void CommandInterpreter::checkSerialInput() {
   static Message staticMsg;
   
+  checkBaud();
+  
   if( !Serial.available() ) return;
   
-  commandBuf[commandBufIdx++] = Serial.read();
+  uint8_t c = Serial.read();
+  
+  // In binary mode, a byte with the top bit set starts a frame instead of a line
+  if( commandBufIdx == 0 ) {
+    inFrame = binaryMode && (c & FRAME_START);
+  }
+  
+  commandBuf[commandBufIdx++] = c;
   commandBuf[commandBufIdx  ] = 0;
 
-  if( commandBuf[commandBufIdx-1] == '\n' ) {
-    if( !processCommand( commandBuf, staticMsg ) ) {
+  if( inFrame ) {
+    if( commandBufIdx < 2 ) return;
+    
+    uint8_t length = commandBuf[1];
+    if( length > CMD_BUF_LEN - FRAME_OVERHEAD ) {
       commandBufIdx = 0;
+      sendERROR( "message too long" );
+      return;
+    }
+    if( commandBufIdx < length + FRAME_OVERHEAD ) return;
+    
+    commandBufIdx = 0;
+    if( !processFrame( (const uint8_t*)commandBuf, staticMsg ) ) {
       return;
     }
-    if( staticMsg.type == M_ALIVE ) {
-      sendACK( "ALIVE" );
+  }
+  
+  else if( c == '\n' ) {
+    if( commandBufIdx == 1 ) {
+      // Blank line
       commandBufIdx = 0;
+      return;
     }
-    if( cmdHandler == NULL ) {
-      sendERROR( "No way to parse messages!" );
+    
+    // Text in, text out
+    binaryMode = false;
+    
+    if( !processCommand( commandBuf, staticMsg ) ) {
       commandBufIdx = 0;
       return;
     }
-    cmdHandler( &staticMsg );
     commandBufIdx = 0;
   }
   
-  else if( commandBufIdx == CMD_BUF_LEN ) {
-    commandBufIdx = 0;
-    sendERROR( "message too long" );
+  else {
+    if( commandBufIdx == CMD_BUF_LEN ) {
+      commandBufIdx = 0;
+      sendERROR( "message too long" );
+    }
+    return;
+  }
+  
+  if( staticMsg.type == M_ALIVE ) {
+    // Also confirms a new baud rate
+    verifyingBaud = false;
+    sendACK( "ALIVE" );
+  }
+  if( staticMsg.type == M_BAUD ) {
+    changeBaud( staticMsg.fields[0] );
+    return;
+  }
+  if( staticMsg.type == M_BINARY ) {
+    // The ACK goes out the same way the BINARY came in
+    sendACK( "BINARY" );
+    binaryMode = true;
+    return;
+  }
+  if( cmdHandler == NULL ) {
+    sendERROR( "No way to parse messages!" );
     return;
   }
+  cmdHandler( &staticMsg );
 }
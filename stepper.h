@@ -5,6 +5,16 @@
 
 #define MAX_STEPPERS 4
 
+// Rate of the stepper interrupt, in Hz
+#define TICK_FREQUENCY 10000
+
+// Number of moves that can be queued up ahead of the one in progress
+#define QUEUE_LEN 8
+
+// What checkQueue returns when the next queued move couldn't start at all.
+// Bit 0 is never an axis (bit n is axis n).
+#define QUEUE_REFUSED 1
+
 enum STOP_MODES {
   S_KEEP_ENABLED,
   S_DISABLE,
@@ -42,6 +52,28 @@ class Stepper {
   
   static int saveSettings(int offset);
   static int restoreSettings(int offset);
+
+  // Start every stepper towards its position (positions[0] is axis 1) in the
+  // same interrupt.  If coordinated, they all share the tick budget of the
+  // slowest axis, so they move in a straight line and finish on the same
+  // tick.  time is updated to the time the move will take.
+  // Returns a bitmask of the axis that started (bit n is axis n), or 0 if
+  // anything was busy (see anyBusy) or none of them could start.
+  static uint8_t moveAll(long* positions, long& time, boolean coordinated);
+  // TRUE if any stepper is still moving
+  static boolean anyBusy();
+
+  // Queue of coordinated moves, run back to back as each one finishes.
+  // positions[0] is axis 1.  Returns false if the queue is full.
+  static boolean queueSegment(long* positions, long time);
+  static uint8_t queueFree();
+  // Throw away everything that hasn't started yet
+  static void flushQueue();
+  // Start the next queued move if everything has stopped.  Returns a bitmask
+  // of the axis that started (see moveAll), 0 if it has to wait, or
+  // QUEUE_REFUSED if none of the axis would start (held at a limit switch,
+  // say), in which case the move is thrown away.
+  static uint8_t checkQueue();
   
  private:
 //  static Stepper* registeredSteppers[MAX_STEPPERS];
@@ -49,6 +81,15 @@ class Stepper {
   
   static unsigned int frequency;
 
+  struct Segment {
+    long positions[MAX_STEPPERS];
+    long time;
+  };
+
+  static Segment queue[QUEUE_LEN];
+  static uint8_t queueHead;     //< Index of the next segment to run
+  static uint8_t queueCount;    //< Number of segments waiting
+
   static boolean registerStepper(Stepper* stepper_);
   
 // Instance-specific stepper stuff
@@ -60,10 +101,14 @@ class Stepper {
   
   // newPosition Position to move to, in stepper counts
   // ticks       Time it should take to get there, in milliseconds
-  boolean moveAbsolute(long newPosition, long& time);
+  // alignToEnd  Take the last step on the last tick, rather than half a step early
+  boolean moveAbsolute(long newPosition, long& time, boolean alignToEnd = false);
   // steps       Steps to take, in stepper counts
   // ticks       Time it should take to move, in milliseconds
-  boolean moveRelative(long steps, long& time);
+  boolean moveRelative(long steps, long& time, boolean alignToEnd = false);
+
+  // Shortest time it could take to get to newPosition, in milliseconds
+  long getMinimumTime(long newPosition);
   
   // Find the limit switch, and set it to the 0 position
   boolean home();
@@ -88,6 +133,8 @@ class Stepper {
   
   boolean busy();    //< TRUE if stepper is moving
   
+  STEPPER_STATE getState();
+  
   boolean checkFinished();  //< TRUE if the device just finished moving. Clears the
                             //< finished bit if set.
 
@@ -128,6 +175,22 @@ class Stepper {
   long deltay;
   long error;
   
+  // Acceleration profile, used instead of the line above if acceleration is set
+  boolean ramped;     //< True if this move has a trapezoidal velocity profile
+  long cruiseRate;    //< Top speed for this move, in steps/s
+  long rate;          //< Current speed, in steps/s
+  long rateRemainder; //< Speed change carried over between ticks, in 1/TICK_FREQUENCY steps/s
+  long phase;         //< Progress towards the next step, a step is TICK_FREQUENCY
+  long rampSteps;     //< Steps taken while speeding up; we slow down for as many
+  long startRate;     //< Speed of the first step, the slowest we slow down to
+  
+  // Work out the time a move of steps will take, given the requested time,
+  // and the top speed it will reach
+  void planMove(long steps, long& time, long& cruise);
+  
+  // One tick of the acceleration profile.  Returns true if it is time to step.
+  boolean doRamp();
+  
   void doInterrupt();
 };
 
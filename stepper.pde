@@ -1,6 +1,7 @@
 #include "stepper.h"
 #include "EEPROM_templates.h"
 #include <EEPROM.h>
+#include <math.h>
 
 
 #if defined(__AVR_ATmega8__) || \
@@ -27,6 +28,10 @@ ISR(TIMER1_COMPA_vect)
 uint8_t Stepper::stepperCount = 0;
 unsigned int Stepper::frequency = 0;
 
+Stepper::Segment Stepper::queue[QUEUE_LEN];
+uint8_t Stepper::queueHead = 0;
+uint8_t Stepper::queueCount = 0;
+
 Stepper* registeredSteppers[MAX_STEPPERS];
 
 void Stepper::setup(unsigned int frequency_) {
@@ -68,6 +73,93 @@ Stepper& Stepper::getStepper(const int index) {
   return *registeredSteppers[index - 1];
 }
 
+boolean Stepper::anyBusy() {
+  for (uint8_t i = 0; i < stepperCount; i++) {
+    if ( registeredSteppers[i]->busy() ) {
+      return true;
+    }
+  }
+  return false;
+}
+
+uint8_t Stepper::moveAll(long* positions, long& time, boolean coordinated) {
+  // Don't start anything unless everything can start
+  if ( anyBusy() ) {
+    return 0;
+  }
+
+  // For a straight line, everyone has to go at the pace of the slowest axis
+  if ( coordinated ) {
+    for (uint8_t i = 0; i < stepperCount; i++) {
+      time = max(time, registeredSteppers[i]->getMinimumTime(positions[i]));
+    }
+  }
+
+  long longestTime = 0;
+  uint8_t started = 0;
+
+  // Hold off the stepper interrupt so that every axis takes its first tick
+  // together
+  noInterrupts();
+  for (uint8_t i = 0; i < stepperCount; i++) {
+    long axisTime = time;
+    if ( registeredSteppers[i]->moveAbsolute(positions[i], axisTime, coordinated) ) {
+      started |= (1 << (i + 1));
+      longestTime = max(longestTime, axisTime);
+    }
+  }
+  interrupts();
+
+  time = longestTime;
+  return started;
+}
+
+boolean Stepper::queueSegment(long* positions, long time) {
+  if ( queueCount >= QUEUE_LEN ) {
+    return false;
+  }
+  
+  Segment& segment = queue[(queueHead + queueCount) % QUEUE_LEN];
+  for (uint8_t i = 0; i < MAX_STEPPERS; i++) {
+    segment.positions[i] = positions[i];
+  }
+  segment.time = time;
+  queueCount++;
+  
+  return true;
+}
+
+uint8_t Stepper::queueFree() {
+  return QUEUE_LEN - queueCount;
+}
+
+void Stepper::flushQueue() {
+  queueCount = 0;
+}
+
+uint8_t Stepper::checkQueue() {
+  if ( queueCount == 0 ) {
+    return 0;
+  }
+  
+  // moveAll won't start anything while an axis is still busy
+  if ( anyBusy() ) {
+    return 0;
+  }
+  
+  // Everything has stopped, so if nothing starts now it never will; don't
+  // hold up the queue retrying it
+  Segment& segment = queue[queueHead];
+  uint8_t started = moveAll(segment.positions, segment.time, true);
+  queueHead = (queueHead + 1) % QUEUE_LEN;
+  queueCount--;
+  
+  if ( started == 0 ) {
+    return QUEUE_REFUSED;
+  }
+  return started;
+}
+
 int Stepper::saveSettings(int offset) {
   int size = 0;
   
@@ -123,12 +215,51 @@ void Stepper::doReset() {
   }
 }
 
-boolean Stepper::moveAbsolute(long newPosition, long& time) {
-  return moveRelative(newPosition - position, time);
+boolean Stepper::moveAbsolute(long newPosition, long& time, boolean alignToEnd) {
+  return moveRelative(newPosition - position, time, alignToEnd);
+}
+
+long Stepper::getMinimumTime(long newPosition) {
+  long time = 0;
+  long cruise;
+  planMove(abs(newPosition - position), time, cruise);
+  return time;
+}
+
+void Stepper::planMove(long steps, long& time, long& cruise) {
+  // Without acceleration, we just go at a constant speed
+  if ( settings.acceleration <= 0 ) {
+    // If the requested speed is too fast, set it to a speed we can achieve
+    if ( time <= 0 ||
+         ((float)steps / time ) * 1000 > settings.maxVelocity ) {
+      time = ((float)steps * 1000) / settings.maxVelocity;
+    }
+    cruise = ((float)steps * 1000) / max(time, 1L);
+    return;
+  }
+
+  // With a trapezoidal profile, a move of S steps at cruise speed v with
+  // acceleration a takes T = S/v + v/a.  Find the slowest cruise speed that
+  // still gets there in the requested time...
+  float a = settings.acceleration;
+  float v = settings.maxVelocity;
+  if ( time > 0 ) {
+    float t = time / 1000.0;
+    float discriminant = a*a*t*t - 4*a*steps;
+    if ( discriminant >= 0 ) {
+      v = min(v, (a*t - sqrt(discriminant)) / 2);
+    }
+  }
+
+  // ...but short moves never get up to speed before they have to slow down
+  v = min(v, (float)sqrt(a * steps));
+  v = max(v, 1.0f);
+
+  cruise = v;
+  time = ((float)steps / v + v / a) * 1000;
 }
 
-boolean Stepper::moveRelative(long steps, long& time) {
-  long frequency = 10000;  // Frequency, in Hz
+boolean Stepper::moveRelative(long steps, long& time, boolean alignToEnd) {
   long ticks;
   
   // If we are already doing something, don't start a new motion
@@ -150,15 +281,12 @@ boolean Stepper::moveRelative(long steps, long& time) {
     }
   }
   
-  // If the requested speed is too fast, set it to a speed we can achieve
-  if ( time <= 0 ||
-       ((float)abs(steps) / time ) * 1000 > settings.maxVelocity ) {
-    time = ((float)abs(steps) * 1000) / settings.maxVelocity;
-  }
+  // Work out how long this will take, and how fast we can go
+  planMove(abs(steps), time, cruiseRate);
   
   // Calculate how many ticks the operation should last
   // ticks(steps) = frequency (steps/s) * time (ms) / 1000 (s/ms)
-  ticks = (float)frequency * time / 1000;
+  ticks = (float)TICK_FREQUENCY * time / 1000;
   
   if ( steps > 0) {
     digitalWrite(directionPin, HIGH);
@@ -173,7 +301,24 @@ boolean Stepper::moveRelative(long steps, long& time) {
 
   deltax = ticks;
   deltay = abs(steps);
-  error = deltax / 2;
+  
+  // Starting the error at deltax - 1 delays every step by half a step, so
+  // that the last one lands exactly on the last tick.  Axis moving together
+  // with the same number of ticks then all finish at once.
+  if ( alignToEnd ) {
+    error = deltax - 1;
+  }
+  else {
+    error = deltax / 2;
+  }
+
+  // Ramped moves start from a standstill
+  ramped = settings.acceleration > 0;
+  rate = 0;
+  rateRemainder = 0;
+  phase = 0;
+  rampSteps = 0;
+  startRate = 0;
 
   if ( settings.stopMode = S_DISABLE ) {
     digitalWrite(enablePin, LOW);
@@ -289,8 +434,20 @@ void Stepper::doInterrupt() {
   
   // If we are still moving, do so
   if (!doneMoving) {
-    error = error - deltay;
-    if (error < 0) {
+    boolean doStep;
+    
+    if (ramped) {
+      doStep = doRamp();
+    }
+    else {
+      error = error - deltay;
+      doStep = (error < 0);
+      if (doStep) {
+        error = error + deltax;
+      }
+    }
+    
+    if (doStep) {
       // Do movement
       digitalWrite(stepPin, HIGH);
       digitalWrite(stepPin, LOW);
@@ -299,8 +456,6 @@ void Stepper::doInterrupt() {
       position += direction;
       stepsLeft--;
       
-      error = error + deltax;
-      
       if (stepsLeft == 0) {
         state = S_FINISHED_MOVING;
     
@@ -318,8 +473,56 @@ void Stepper::doInterrupt() {
 }
 
 
+boolean Stepper::doRamp() {
+  // Integer-only trapezoid: the rate (steps/s) changes by acceleration/TICK_FREQUENCY
+  // every tick, with the remainder carried over in rateRemainder.  We start
+  // slowing down once there are only as many steps left as it took to get
+  // up to speed.
+  boolean accelerating = false;
+  
+  if ( stepsLeft <= rampSteps ) {
+    rateRemainder += settings.acceleration;
+    while ( rateRemainder >= TICK_FREQUENCY ) {
+      rateRemainder -= TICK_FREQUENCY;
+      // Don't crawl to a stop before the last step
+      if ( rate > startRate ) {
+        rate--;
+      }
+    }
+  }
+  else if ( rate < cruiseRate ) {
+    accelerating = true;
+    rateRemainder += settings.acceleration;
+    while ( rateRemainder >= TICK_FREQUENCY && rate < cruiseRate ) {
+      rateRemainder -= TICK_FREQUENCY;
+      rate++;
+    }
+  }
+  
+  // Take a step each time a whole step's worth of phase has built up
+  phase += rate;
+  if ( phase < TICK_FREQUENCY ) {
+    return false;
+  }
+  phase -= TICK_FREQUENCY;
+  
+  if ( startRate == 0 ) {
+    startRate = rate;
+  }
+  if ( accelerating ) {
+    rampSteps++;
+  }
+  return true;
+}
+
+
 long Stepper::getPosition() {
-  return position;
+  // The interrupt changes it, and a long takes more than one instruction to
+  // read
+  noInterrupts();
+  long position_ = position;
+  interrupts();
+  return position_;
 }
 
 boolean Stepper::setPosition(long position_) {
@@ -402,3 +605,7 @@ boolean Stepper::busy() {
   return !(state == S_READY);
 }
 
+STEPPER_STATE Stepper::getState() {
+  return state;
+}
+
@@ -0,0 +1,488 @@
+
+# Event-loop version of SerialHandler/stepperAxis, so that one process can
+# keep many controllers busy without a thread (or a blocked call) per board.
+#
+# This is Python 2, so there's no asyncio. Coroutines are generators that
+# yield Futures, and give their result with raise StopIteration(value). An
+# EventLoop select()s on the serial ports:
+#
+# def shoot(axisX, axisY):
+#     yield gather(axisX.moveAbsolute(1000), axisY.moveAbsolute(500))
+#     yield axisX.handler.click()
+#     position = yield axisX.readPosition()
+#     raise StopIteration(position)
+#
+# loop = EventLoop()
+# handler = AsyncSerialHandler(loop, "/dev/ttyUSB0")
+# loop.runUntilComplete(shoot(asyncStepperAxis(1, handler),
+#                             asyncStepperAxis(2, handler)))
+#
+# Nothing waits forever: a command that isn't answered within the handler's
+# timeout, or a motion that doesn't report DONE within its doneTimeout, fails
+# with a NameError. See async_benchmark.py for a dozen boards at once.
+
+import heapq
+import select
+import serial
+import time
+import types
+from collections import deque
+
+# Seconds to wait for the immediate response (ACK, ERROR) to a command
+defaultTimeout = 10
+
+# Seconds to wait for a motion to report DONE. HOME can walk 11000 steps,
+# which is 55 s at the default MAX_VEL.
+defaultDoneTimeout = 120
+
+
+class Future:
+    """ Result of an operation that hasn't finished yet """
+    def __init__(self):
+        self.isDone = False
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def done(self):
+        return self.isDone
+
+    def result(self):
+        if not self.isDone:
+            raise NameError("Future isn't done yet!")
+        if self.error != None:
+            raise self.error
+        return self.value
+
+    def setResult(self, value):
+        self.value = value
+        self.finish()
+
+    def setException(self, error):
+        self.error = error
+        self.finish()
+
+    def addDoneCallback(self, callback):
+        if self.isDone:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def finish(self):
+        if self.isDone:
+            raise NameError("Future already finished!")
+        self.isDone = True
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class Task(Future):
+    """ Runs a generator, sending it the result of each Future it yields """
+    def __init__(self, coroutine):
+        Future.__init__(self)
+        self.coroutine = coroutine
+        self.step(None, None)
+
+    def step(self, value, error):
+        try:
+            if error != None:
+                future = self.coroutine.throw(error)
+            else:
+                future = self.coroutine.send(value)
+        except StopIteration, e:
+            self.setResult(e.args[0] if len(e.args) > 0 else None)
+            return
+        except Exception, e:
+            self.setException(e)
+            return
+
+        future = asFuture(future)
+        future.addDoneCallback(self.wakeup)
+
+    def wakeup(self, future):
+        if future.error != None:
+            self.step(None, future.error)
+        else:
+            self.step(future.value, None)
+
+
+def asFuture(thing):
+    if isinstance(thing, Future):
+        return thing
+    if isinstance(thing, types.GeneratorType):
+        return Task(thing)
+    raise NameError("Can't wait for: " + repr(thing))
+
+
+def gather(*things):
+    """ Future that finishes when all of the given futures/coroutines have,
+        with a list of their results """
+    futures = [asFuture(thing) for thing in things]
+    gathered = Future()
+    results = [None] * len(futures)
+    remaining = [len(futures)]
+
+    def finishOne(index, future):
+        if gathered.done():
+            return
+        if future.error != None:
+            gathered.setException(future.error)
+            return
+        results[index] = future.value
+        remaining[0] -= 1
+        if remaining[0] == 0:
+            gathered.setResult(results)
+
+    if len(futures) == 0:
+        gathered.setResult([])
+    for index, future in enumerate(futures):
+        future.addDoneCallback(lambda f, index=index: finishOne(index, f))
+    return gathered
+
+
+class EventLoop:
+    def __init__(self):
+        self.readers = {}
+        self.timers = []
+        self.timerCount = 0
+
+    def addReader(self, fileObject, callback):
+        self.readers[fileObject.fileno()] = callback
+
+    def removeReader(self, fileObject):
+        del self.readers[fileObject.fileno()]
+
+    def callLater(self, delay, callback):
+        # The counter keeps heapq from ever comparing two callbacks
+        self.timerCount += 1
+        heapq.heappush(self.timers, (time.time() + delay, self.timerCount, callback))
+
+    def sleep(self, delay):
+        future = Future()
+        self.callLater(delay, lambda: future.setResult(None))
+        return future
+
+    def expire(self, future, delay, what, forget):
+        """ Fail future with a NameError if it isn't done within delay
+            seconds, calling forget() first so nothing is left holding it """
+        def check():
+            if not future.done():
+                forget()
+                future.setException(NameError("timed out waiting for " + what))
+        self.callLater(delay, check)
+
+    def runOnce(self, timeout = None):
+        if len(self.timers) > 0:
+            untilTimer = max(0, self.timers[0][0] - time.time())
+            if timeout == None or untilTimer < timeout:
+                timeout = untilTimer
+
+        readable, _, _ = select.select(self.readers.keys(), [], [], timeout)
+        for fd in readable:
+            if fd in self.readers:
+                self.readers[fd]()
+
+        now = time.time()
+        while len(self.timers) > 0 and self.timers[0][0] <= now:
+            _, _, callback = heapq.heappop(self.timers)
+            callback()
+
+    def runUntilComplete(self, thing, timeout = None):
+        future = asFuture(thing)
+        timeoutTime = time.time() + (timeout if timeout != None else 1e9)
+        while not future.done():
+            remaining = timeoutTime - time.time()
+            if remaining <= 0:
+                raise NameError("timed out waiting for the event loop!")
+            self.runOnce(remaining)
+        return future.result()
+
+
+class AsyncSerialHandler:
+    def __init__(self, loop, port, baud = 9600, timeout = defaultTimeout):
+        self.loop = loop
+        self.readBuffer = bytearray()
+        self.timeout = timeout
+        self.doneTimeout = defaultDoneTimeout
+
+        # Commands that haven't been written yet, and the one waiting for its
+        # ACK. The controller only buffers one line, so send one at a time.
+        self.queued = deque()
+        self.inFlight = None
+
+        # Set after a response went missing, until the controller answers an
+        # ALIVE. Nothing is sent in the meantime.
+        self.resyncing = False
+        self.resyncs = 0
+
+        # Futures waiting on NOTICE DONE, by axis, and on the next NOTICE
+        # that starts with a prefix (NOTICE DONE ALL, say), as (prefix,
+        # future)
+        self.doneFutures = {}
+        self.noticeFutures = []
+
+        # Free slots in the controller's move queue, as of the last ACK QUEUE
+        # or NOTICE QUEUE
+        self.queueFree = None
+
+        # Queued moves the controller threw away because none of the axis
+        # would start them
+        self.queueRefusals = 0
+
+        # Delayed responses that aren't for a specific axis
+        self.messages = deque()
+
+        self.ser = serial.Serial(port, baud, timeout=0)
+        self.loop.addReader(self.ser, self.onReadable)
+
+    def disconnect(self):
+        self.loop.removeReader(self.ser)
+        self.ser.close()
+
+    def sendCommand(self, command):
+        """ Future for the controller's immediate response (ACK or ERROR) """
+        future = Future()
+        self.queued.append((command, future))
+        self.sendNext()
+        return future
+
+    def sendNext(self):
+        if self.inFlight != None or self.resyncing or len(self.queued) == 0:
+            return
+        command, future = self.queued.popleft()
+        self.inFlight = future
+        self.ser.write(command)
+        self.loop.callLater(self.timeout, lambda: self.checkAnswered(future))
+
+    def checkAnswered(self, future):
+        """ The command in flight has had self.timeout seconds to be
+            answered """
+        if self.inFlight is not future:
+            return
+        self.inFlight = None
+        # Before failing it, so whatever that sends next waits for the resync
+        self.resync()
+        future.setException(NameError("timed out waiting for response from Arduino!"))
+
+    def resync(self):
+        """ Get back in step after a response went missing. The newline
+            finishes off anything the controller half read, and everything up
+            to the ACK ALIVE is thrown away, since the lost response might
+            still turn up. """
+        self.resyncing = True
+        self.resyncs += 1
+        attempt = self.resyncs
+        self.ser.write("\nALIVE\n")
+        self.loop.callLater(self.timeout, lambda: self.checkResynced(attempt))
+
+    def checkResynced(self, attempt):
+        if not self.resyncing or attempt != self.resyncs:
+            return
+        # Nobody there. Fail whatever is waiting to go out, instead of letting
+        # it hang, and keep trying.
+        queued, self.queued = self.queued, deque()
+        self.resync()
+        for command, future in queued:
+            future.setException(NameError("controller isn't answering"))
+
+    def expectDone(self, axis, timeout = None):
+        """ Future for the next NOTICE DONE on axis, which fails after
+            timeout seconds (self.doneTimeout if None) """
+        future = Future()
+        self.doneFutures.setdefault(axis, deque()).append(future)
+        self.loop.expire(future, self.timeoutOrDefault(timeout), "DONE on axis %d" % axis,
+                         lambda: self.forgetDone(axis, future))
+        return future
+
+    def forgetDone(self, axis, future):
+        waiting = self.doneFutures.get(axis)
+        if waiting and future in waiting:
+            waiting.remove(future)
+
+    def waitForNotice(self, prefix, timeout = None):
+        """ Future for the next NOTICE that starts with prefix, which fails
+            after timeout seconds (self.doneTimeout if None) """
+        future = Future()
+        entry = (prefix, future)
+        self.noticeFutures.append(entry)
+        self.loop.expire(future, self.timeoutOrDefault(timeout), prefix,
+                         lambda: self.noticeFutures.remove(entry))
+        return future
+
+    def timeoutOrDefault(self, timeout):
+        if timeout == None:
+            return self.doneTimeout
+        return timeout
+
+    def onReadable(self):
+        self.readBuffer += self.ser.read(max(1, self.ser.inWaiting()))
+
+        start = 0
+        end = self.readBuffer.find("\n", start)
+        while end >= 0:
+            self.routeMessage(str(self.readBuffer[start:end]))
+            start = end + 1
+            end = self.readBuffer.find("\n", start)
+        del self.readBuffer[:start]
+
+    def routeMessage(self, message):
+        if message.startswith("ACK ") or message.startswith("ERROR "):
+            if self.resyncing:
+                if message == "ACK ALIVE":
+                    self.resyncing = False
+                    self.sendNext()
+                return
+            if message.startswith("ACK QUEUE "):
+                self.updateQueueFree(message)
+            future, self.inFlight = self.inFlight, None
+            self.sendNext()
+            if future != None:
+                future.setResult(message)
+        elif (message.startswith("NOTICE DONE ALL") or message.startswith("NOTICE DONE QUEUE") or
+              message.startswith("NOTICE QUEUE ")):
+            if message.startswith("NOTICE QUEUE "):
+                self.updateQueueFree(message)
+            if message.startswith("NOTICE QUEUE REFUSED"):
+                self.queueRefusals += 1
+            waiting = [entry for entry in self.noticeFutures if message.startswith(entry[0])]
+            for entry in waiting:
+                self.noticeFutures.remove(entry)
+                entry[1].setResult(message)
+        elif message.startswith("NOTICE DONE ") or message.startswith("DONE "):
+            try:
+                axis = int(message.split()[-1])
+            except ValueError:
+                return
+            waiting = self.doneFutures.get(axis)
+            if waiting:
+                waiting.popleft().setResult(message)
+        elif message.startswith("NOTICE "):
+            self.messages.append(message)
+
+    def updateQueueFree(self, message):
+        try:
+            self.queueFree = int(message.split()[-1])
+        except ValueError:
+            pass
+
+    def checked(self, command):
+        """ Send a command, failing the future if the controller says ERROR """
+        response = yield self.sendCommand(command)
+        if not response.startswith("ACK "):
+            raise NameError(response)
+
+    def stop(self):
+        return Task(self.checked("STOP\n"))
+
+    def alive(self):
+        return Task(self.checked("ALIVE\n"))
+
+    def click(self):
+        return Task(self.checked("CLICK\n"))
+
+    def state(self):
+        """ Future for the controller state (READY, GOING, ...) """
+        def getState():
+            response = yield self.sendCommand("STATE\n")
+            if not response.startswith("ACK STATE "):
+                raise NameError(response)
+            raise StopIteration(response.split()[2])
+        return Task(getState())
+
+    def getParameter(self, name, axis = None):
+        """ Future for the integer value of a GET parameter """
+        command = "GET " + name
+        if axis != None:
+            command += " " + str(axis)
+        def get():
+            response = yield self.sendCommand(command + "\n")
+            if not response.startswith("ACK " + command):
+                raise NameError(response)
+            raise StopIteration(int(response.split()[-1]))
+        return Task(get())
+
+    def setParameter(self, name, axis, value):
+        command = "SET " + name + " " + str(axis) + " " + str(value) + "\n"
+        return Task(self.checked(command))
+
+    def goAll(self, positions, moveTime = 0, timeout = None):
+        """ Future that starts every axis towards its position at once, and
+            finishes with their NOTICE DONE ALL """
+        return Task(self.runGroup("GOALL", positions, moveTime, timeout))
+
+    def moveLine(self, positions, moveTime = 0, timeout = None):
+        """ Like goAll, but the axis move in a straight line and arrive
+            together """
+        return Task(self.runGroup("LINE", positions, moveTime, timeout))
+
+    def runGroup(self, name, positions, moveTime, timeout):
+        yield self.checked(name + " " + " ".join([str(p) for p in positions]) +
+                           " " + str(moveTime) + "\n")
+        # The ACK is handled before the next message is read, so the DONE ALL
+        # can't get past this
+        message = yield self.waitForNotice("NOTICE DONE ALL", timeout)
+        raise StopIteration(message)
+
+    def streamMoves(self, frames, moveTime = 0, timeout = None):
+        """ Future that runs the axis through frames (each a position for
+            every axis) as QUEUE moves, sending each one as there's room in
+            the controller's queue, and finishes with the NOTICE DONE QUEUE
+            after the last. Fails if the controller refuses one of them
+            (none of the axis would start it). timeout is the longest to wait for room, or for
+            the end. """
+        return Task(self.runQueue(frames, moveTime, timeout))
+
+    def runQueue(self, frames, moveTime, timeout):
+        refusals = self.queueRefusals
+        sent = False
+        for frame in frames:
+            while self.queueFree == 0:
+                yield self.waitForNotice("NOTICE QUEUE ", timeout)
+            if self.queueRefusals != refusals:
+                # The rest would carry on from somewhere the axis never got to
+                yield self.sendCommand("FLUSH\n")
+                raise NameError("controller refused a queued move")
+            yield self.checked("QUEUE " + " ".join([str(p) for p in frame]) +
+                               " " + str(moveTime) + "\n")
+            sent = True
+        if not sent:
+            return
+        message = yield self.waitForNotice("NOTICE DONE QUEUE", timeout)
+        if self.queueRefusals != refusals:
+            raise NameError("controller refused a queued move")
+        raise StopIteration(message)
+
+
+class asyncStepperAxis:
+    def __init__(self, axis, handler):
+        self.axis = axis
+        self.handler = handler
+        self.requestedPosition = 0
+
+    def moveAbsolute(self, position, moveTime = 0, timeout = None):
+        """ Future that finishes when the axis reports DONE, or fails if it
+            doesn't within timeout seconds (the handler's doneTimeout if
+            None) """
+        self.requestedPosition = position
+        command = "GO " + str(self.axis) + " " + str(position) + " " + str(moveTime) + "\n"
+        return Task(self.runMotion(command, timeout))
+
+    def moveRelative(self, counts, moveTime = 0, timeout = None):
+        return self.moveAbsolute(self.requestedPosition + counts, moveTime, timeout)
+
+    def home(self, timeout = None):
+        return Task(self.runMotion("HOME " + str(self.axis) + "\n", timeout))
+
+    def runMotion(self, command, timeout):
+        # Register for DONE before sending, in case it comes right behind the ACK
+        done = self.handler.expectDone(self.axis, timeout)
+        response = yield self.handler.sendCommand(command)
+        if not response.startswith("ACK "):
+            self.handler.forgetDone(self.axis, done)
+            raise NameError(response)
+        message = yield done
+        raise StopIteration(message)
+
+    def readPosition(self):
+        return self.handler.getParameter("POS", self.axis)
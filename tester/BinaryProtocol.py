@@ -0,0 +1,248 @@
+
+# Binary framing for the controller protocol (see BINARY in commands.pde).
+# Commands and replies are converted to and from the same text the ASCII
+# protocol uses, so nothing above the serial port needs to know which one is
+# being spoken:
+#
+# frame = encodeCommand("GO 3 -12345 0\n")
+# decoder = FrameDecoder()
+# for message, size, framed in decoder.feed(ser.read(ser.inWaiting())):
+#     print message        # "ACK GO 3 -12345 0"
+
+import struct
+
+# [frameStart | type] [payload length] [payload] [CRC-8]
+frameStart = 0x80
+frameOverhead = 3
+
+# Reply frame types
+frameAck = 0x40         # Message type, then a long for each value
+frameAckText = 0x41
+frameError = 0x42
+frameNotice = 0x43
+frameDone = 0x44
+framePos = 0x45         # Time, then a long position and a state byte per axis
+
+# MESSAGE_TYPE and PARAMETER from commands.h, in order
+messageTypes = ["GO", "GOALL", "LINE", "QUEUE", "FLUSH", "STOP", "SET", "GET",
+                "HOME", "STATE", "ALIVE", "CLICK", "BINARY", "BAUD", "WATCH"]
+parameters = ["VERSION", "INDEX", "MAX_VEL", "ACCEL", "STOP_MODE", "POS", "QUEUE"]
+axisParameters = set(["MAX_VEL", "ACCEL", "STOP_MODE", "POS"])
+
+# Payload of each command: B for an axis or parameter, l for a long
+commandLayouts = {
+    "GO":     struct.Struct("<Bll"),
+    "GOALL":  struct.Struct("<lllll"),
+    "LINE":   struct.Struct("<lllll"),
+    "QUEUE":  struct.Struct("<lllll"),
+    "SET":    struct.Struct("<BBl"),
+    "GET":    struct.Struct("<BB"),
+    "HOME":   struct.Struct("<B"),
+    "BAUD":   struct.Struct("<l"),
+    "WATCH":  struct.Struct("<l"),
+}
+emptyLayout = struct.Struct("<")
+
+# Payload of a position report: millis(), then each axis
+posTimeLayout = struct.Struct("<L")
+posAxisLayout = struct.Struct("<lB")
+
+
+def crc8(data, crc = 0):
+    """ CRC-8 with polynomial x^8 + x^2 + x + 1, same as the firmware """
+    for byte in bytearray(data):
+        crc ^= byte
+        for bit in range(8):
+            if crc & 0x80:
+                crc = ((crc << 1) ^ 0x07) & 0xFF
+            else:
+                crc = (crc << 1) & 0xFF
+    return crc
+
+
+def makeFrame(frameType, payload):
+    frame = bytearray([frameStart | frameType, len(payload)])
+    frame += payload
+    frame.append(crc8(frame))
+    return frame
+
+
+def parseValues(name, words):
+    """ Turn the words after a message name into numbers, replacing the
+        parameter name of GET/SET, and filling in the axis if it has none """
+    if (name == "GET" or name == "SET") and len(words) > 0:
+        param = words[0]
+        values = [parameters.index(param)]
+        if param not in axisParameters:
+            values.append(0)
+        return values + [int(word) for word in words[1:]]
+    return [int(word) for word in words]
+
+
+def encodeCommand(command):
+    """ Frame for a text command, e.g. "GO 1 100 0\n" """
+    words = command.split()
+    try:
+        name = words[0]
+        layout = commandLayouts.get(name, emptyLayout)
+        payload = layout.pack(*parseValues(name, words[1:]))
+        return makeFrame(messageTypes.index(name), payload)
+    except (IndexError, ValueError, struct.error):
+        raise NameError("Can't encode command: ", command)
+
+
+def decodeCommand(frame):
+    """ Text of a command frame, or None if it isn't valid """
+    frame = memoryview(frame)
+    if crc8(frame[:-1].tobytes()) != ord(frame[-1]):
+        return None
+    messageType = ord(frame[0]) & ~frameStart
+    if messageType >= len(messageTypes):
+        return None
+
+    name = messageTypes[messageType]
+    layout = commandLayouts.get(name, emptyLayout)
+    if ord(frame[1]) != layout.size:
+        return None
+    values = list(layout.unpack_from(frame.tobytes(), 2))
+    return " ".join([name] + formatValues(name, values))
+
+
+def formatValues(name, values):
+    """ Opposite of parseValues """
+    words = []
+    if (name == "GET" or name == "SET") and len(values) > 0:
+        if values[0] >= len(parameters):
+            return ["?"]
+        param = parameters[values[0]]
+        words.append(param)
+        values = values[1:]
+        if param not in axisParameters:
+            values = values[1:]
+    return words + [str(value) for value in values]
+
+
+def encodeReply(message):
+    """ Frame the firmware would send instead of a text reply """
+    words = message.split()
+    if message.startswith("ACK "):
+        # Replies with numbers in them go as longs
+        try:
+            values = parseValues(words[1], words[2:])
+            if len(values) > 0:
+                payload = bytearray([messageTypes.index(words[1])])
+                payload += struct.pack("<%dl" % len(values), *values)
+                return makeFrame(frameAck, payload)
+        except (ValueError, IndexError):
+            pass
+        return makeFrame(frameAckText, message[len("ACK "):])
+    if message.startswith("ERROR "):
+        return makeFrame(frameError, message[len("ERROR "):])
+    if message.startswith("NOTICE DONE "):
+        return makeFrame(frameDone, message[len("NOTICE DONE "):])
+    if message.startswith("NOTICE POS "):
+        # NOTICE POS time position... states
+        words = words[2:]
+        payload = posTimeLayout.pack(int(words[0]))
+        for position, state in zip(words[1:-1], words[-1]):
+            payload += posAxisLayout.pack(int(position), int(state))
+        return makeFrame(framePos, payload)
+    return makeFrame(frameNotice, message[len("NOTICE "):])
+
+
+def decodeReply(frame):
+    """ Text of a reply frame, or None if it isn't valid """
+    frame = memoryview(frame)
+    if crc8(frame[:-1].tobytes()) != ord(frame[-1]):
+        return None
+    frameType = ord(frame[0]) & ~frameStart
+    payload = frame[2:-1]
+
+    if frameType == frameAck:
+        if len(payload) < 1 or (len(payload) - 1) % 4 != 0:
+            return None
+        messageType = ord(payload[0])
+        if messageType >= len(messageTypes):
+            return None
+        name = messageTypes[messageType]
+        values = struct.unpack_from("<%dl" % ((len(payload) - 1) / 4), payload.tobytes(), 1)
+        return " ".join(["ACK", name] + formatValues(name, list(values)))
+
+    if frameType == framePos:
+        if len(payload) < posTimeLayout.size or \
+                (len(payload) - posTimeLayout.size) % posAxisLayout.size != 0:
+            return None
+        data = payload.tobytes()
+        axes = [posAxisLayout.unpack_from(data, offset) for offset in
+                range(posTimeLayout.size, len(data), posAxisLayout.size)]
+        return "NOTICE POS %d %s %s" % (posTimeLayout.unpack_from(data)[0],
+                                        " ".join([str(position) for position, state in axes]),
+                                        "".join([str(state) for position, state in axes]))
+
+    prefix = {frameAckText: "ACK ",
+              frameError: "ERROR ",
+              frameNotice: "NOTICE ",
+              frameDone: "NOTICE DONE "}.get(frameType)
+    if prefix == None:
+        return None
+    return prefix + payload.tobytes()
+
+
+class FrameDecoder:
+    """ Splits a byte stream into messages. Like the firmware, frames are only
+        looked for after the handshake line; any other text line means the
+        other end has gone back to text. """
+    def __init__(self, decode = decodeReply, handshake = "ACK BINARY",
+                 maxPayload = 64 - frameOverhead):
+        self.buffer = bytearray()
+        self.decode = decode
+        self.handshake = handshake
+        self.maxPayload = maxPayload
+        self.binary = False
+
+        # Frames that didn't make it through
+        self.badFrames = 0
+
+    def feed(self, data):
+        """ Add data to the buffer and return a list of (text, size, framed)
+            for each complete message in it. Size is the number of bytes it
+            took up, and framed is True if it was a binary frame. """
+        self.buffer += data
+
+        messages = []
+        start = 0
+        while start < len(self.buffer):
+            if self.binary and self.buffer[start] & frameStart:
+                if len(self.buffer) - start < 2:
+                    break
+                length = self.buffer[start + 1]
+                if length > self.maxPayload:
+                    # Can't be a frame; skip a byte and look again
+                    self.badFrames += 1
+                    start += 1
+                    continue
+                end = start + length + frameOverhead
+                if end > len(self.buffer):
+                    break
+                message = self.decode(self.buffer[start:end])
+                if message == None:
+                    self.badFrames += 1
+                    start += 1
+                    continue
+                messages.append((message, end - start, True))
+                start = end
+            else:
+                end = self.buffer.find("\n", start)
+                if end < 0:
+                    break
+                line = str(self.buffer[start:end])
+                messages.append((line, end + 1 - start, False))
+                start = end + 1
+
+                if line == self.handshake:
+                    self.binary = True
+                elif line != "":
+                    self.binary = False
+
+        del self.buffer[:start]
+        return messages
@@ -5,6 +5,10 @@
 
 import ctypes
 import os
+import Queue
+import threading
+
+import Trace
 
 # gphoto structures
 """ From 'gphoto2-camera.h'
@@ -25,14 +29,80 @@ GP_CAPTURE_IMAGE = 0
 # CameraFileType enum in 'gphoto2-file.h'
 GP_FILE_TYPE_NORMAL = 1
 
+# MjpegSink keeps its index next to the video
+indexSuffix = ".index"
+
+
+class DiskSink():
+    """ Saves pictures to files. The whole picture goes to the file in one
+        write, straight from the camera's buffer. """
+    def __call__(self, name, data):
+        output = open(name, "wb")
+        try:
+            output.write(data)
+        finally:
+            output.close()
+
+
+class QueueSink():
+    """ Puts (name, bytes) on a queue for something else to deal with.
+        This has to copy the picture, since the buffer it comes in is gone
+        once the sink returns. """
+    def __init__(self, queue):
+        self.queue = queue
+
+    def __call__(self, name, data):
+        self.queue.put((name, data.tobytes()))
+
+
+class MjpegSink():
+    """ Saves pictures one after another in a single file, which plays as an
+        MJPEG video, with an index of where each one is. The index has a
+        line for each picture: name, offset, size. Used for previews, where
+        a picture per file would be thousands of files. """
+    def __init__(self, path, append = False):
+        mode = ["wb", "ab"][append]
+        self.output = open(path, mode)
+        self.index = open(path + indexSuffix, mode)
+        self.output.seek(0, os.SEEK_END)
+        self.offset = self.output.tell()
+
+    def __call__(self, name, data):
+        self.output.write(data)
+        self.index.write("%s %d %d\n" % (name, self.offset, len(data)))
+        self.offset += len(data)
 
+    def close(self):
+        self.output.close()
+        self.index.close()
 
 
+def readMjpeg(path):
+    """ (name, picture) for each picture saved by MjpegSink """
+    input = open(path, "rb")
+    try:
+        for line in open(path + indexSuffix):
+            name, offset, size = line.split()
+            input.seek(int(offset))
+            yield name, input.read(int(size))
+    finally:
+        input.close()
+
 
 class CameraController():
-    def __init__(self):
-        # Load library
-        self.gp = ctypes.CDLL('libgphoto2.so.2')
+    def __init__(self, sink = None, library = None):
+        # Load library (or something pretending to be it, see MockGphoto2)
+        if library == None:
+            library = ctypes.CDLL('libgphoto2.so.2')
+        self.gp = library
+
+        # Where downloaded pictures go: any sink(name, data), called with a
+        # memoryview of the picture that is only good until it returns.
+        # With no sink, libgphoto2 writes pictures straight to the file.
+        self.sink = sink
+
+        # The camera can only do one thing at a time, whichever thread asks
+        self.lock = threading.Lock()
 
         # Init camera
         self.context = self.gp.gp_context_new()
@@ -46,28 +116,162 @@ class CameraController():
         self.gp.gp_camera_unref(self.camera)
 
     def capture(self, name):
-        # Capture image
+        self.download(self.trigger(), name)
+
+    def trigger(self):
+        """ Take a picture and leave it on the camera. Returns where it is
+            on the camera, for download(). """
         cam_path = CameraFilePath()
-        self.gp.gp_camera_capture(self.camera,
-                             GP_CAPTURE_IMAGE,
-                             ctypes.pointer(cam_path),
-                             self.context)
-
-        # Download and delete
-        cam_file = ctypes.c_void_p()
-        fd = os.open(name, os.O_CREAT | os.O_WRONLY)
-        self.gp.gp_file_new_from_fd(ctypes.pointer(cam_file), fd)
-        self.gp.gp_camera_file_get(self.camera,
-                              cam_path.folder,
-                              cam_path.name,
-                              GP_FILE_TYPE_NORMAL,
-                              cam_file,
-                              self.context)
+        with self.lock:
+            traceId = Trace.begin(Trace.CAT_CAMERA, "trigger")
+            try:
+                self.gp.gp_camera_capture(self.camera,
+                                     GP_CAPTURE_IMAGE,
+                                     ctypes.pointer(cam_path),
+                                     self.context)
+            finally:
+                Trace.end(Trace.CAT_CAMERA, "trigger", traceId)
+        return cam_path
+
+    def download(self, cam_path, name):
+        """ Get a picture taken by trigger() off the camera, give it to
+            the sink (or save it to a file), and delete it from the camera """
+        traceId = Trace.begin(Trace.CAT_CAMERA, "download")
+        try:
+            if self.sink == None:
+                self.downloadToFile(cam_path, name)
+            else:
+                self.downloadToMemory(cam_path, name)
+        finally:
+            Trace.end(Trace.CAT_CAMERA, "download", traceId)
+
+    def downloadToFile(self, cam_path, name):
+        with self.lock:
+            cam_file = ctypes.c_void_p()
+            # libgphoto2 closes fd when it frees cam_file
+            fd = os.open(name, os.O_CREAT | os.O_TRUNC | os.O_WRONLY)
+            self.gp.gp_file_new_from_fd(ctypes.pointer(cam_file), fd)
+            try:
+                self.getFile(cam_path, cam_file)
+            finally:
+                self.gp.gp_file_unref(cam_file)
+
+    def downloadToMemory(self, cam_path, name):
+        with self.lock:
+            cam_file = ctypes.c_void_p()
+            self.gp.gp_file_new(ctypes.pointer(cam_file))
+            try:
+                self.getFile(cam_path, cam_file)
+            except:
+                self.gp.gp_file_unref(cam_file)
+                raise
+
+        # The camera is free again; the sink can take its time while the
+        # next picture is taken
+        try:
+            self.sendFile(cam_file, name, self.sink)
+        finally:
+            self.gp.gp_file_unref(cam_file)
+
+    def preview(self, name, sink = None):
+        """ Take a low resolution picture from the camera's live view, and
+            give it to sink (or the camera's own). Much quicker than
+            capture(), and nothing is left on the camera. """
+        if sink == None:
+            sink = self.sink
+        if sink == None:
+            raise NameError("No sink to send previews to")
+
+        traceId = Trace.begin(Trace.CAT_CAMERA, "preview")
+        try:
+            with self.lock:
+                cam_file = ctypes.c_void_p()
+                self.gp.gp_file_new(ctypes.pointer(cam_file))
+                result = self.gp.gp_camera_capture_preview(self.camera,
+                                                      cam_file,
+                                                      self.context)
+            try:
+                if result < GP_OK:
+                    raise NameError("Couldn't take preview: ", name, result)
+                self.sendFile(cam_file, name, sink)
+            finally:
+                self.gp.gp_file_unref(cam_file)
+        finally:
+            Trace.end(Trace.CAT_CAMERA, "preview", traceId)
+
+    def sendFile(self, cam_file, name, sink):
+        """ Give the data in cam_file to sink, without copying it """
+        data = ctypes.POINTER(ctypes.c_char)()
+        size = ctypes.c_ulong()
+        self.gp.gp_file_get_data_and_size(cam_file,
+                                          ctypes.pointer(data),
+                                          ctypes.pointer(size))
+        if size.value == 0:
+            raise NameError("Camera sent an empty picture: ", name)
+        buffer = (ctypes.c_char * size.value).from_address(ctypes.addressof(data.contents))
+        sink(name, memoryview(buffer))
+
+    def getFile(self, cam_path, cam_file):
+        """ Copy a picture from the camera into cam_file, and delete it from
+            the camera. Call with the lock held. """
+        result = self.gp.gp_camera_file_get(self.camera,
+                                       cam_path.folder,
+                                       cam_path.name,
+                                       GP_FILE_TYPE_NORMAL,
+                                       cam_file,
+                                       self.context)
+        if result < GP_OK:
+            raise NameError("Couldn't download picture: ", cam_path.name, result)
         self.gp.gp_camera_file_delete(self.camera,
                                  cam_path.folder,
                                  cam_path.name,
                                  self.context)
-        self.gp.gp_file_unref(cam_file)
+
+
+class CapturePipeline():
+    """ Takes pictures with a camera, but only waits for the shutter.
+        Downloading and deleting them happens on a worker thread, so the
+        rig can start its next move while that goes on. """
+    def __init__(self, camera, queueSize = 4):
+        self.camera = camera
+
+        # Pictures waiting to be downloaded; capture() blocks once there
+        # are queueSize of them, so they don't pile up on the camera
+        self.queue = Queue.Queue(queueSize)
+
+        # Pictures that couldn't be saved, as (name, exception)
+        self.failures = []
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def capture(self, name):
+        """ Take a picture to be saved as name. Returns once the exposure is
+            done, when it is safe to move again. """
+        self.queue.put((self.camera.trigger(), name))
+
+    def run(self):
+        while True:
+            picture = self.queue.get()
+            try:
+                if picture == None:
+                    return
+                cam_path, name = picture
+                try:
+                    self.camera.download(cam_path, name)
+                except Exception, e:
+                    self.failures.append((name, e))
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """ Wait until every picture taken so far has been saved """
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
 
 """
 Usage:
@@ -75,4 +279,22 @@ myCam = CameraController()
 
 myCam.capture("test.jpg")
 myCam.capture("test2.jpg")
+
+# Or, to get on with something else while the pictures download:
+pipeline = CapturePipeline(myCam)
+pipeline.capture("test3.jpg")
+pipeline.close()
+
+# Pictures can go somewhere other than a file, without being copied first:
+def checkExposure(name, data):
+    histogram(data)
+
+myCam = CameraController(checkExposure)
+myCam = CameraController(QueueSink(Queue.Queue()))
+myCam = CameraController(DiskSink(), MockGphoto2())   # no camera needed
+
+# Quick, low resolution pictures, all in one video file:
+previews = MjpegSink("test.mjpeg")
+myCam.preview("test4", previews)
+previews.close()
 """
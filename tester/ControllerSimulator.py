@@ -0,0 +1,690 @@
+#!/usr/bin/python
+
+# Fake stepper controller that talks the ArduinoStepperController protocol
+# over a pseudo-terminal, so the host side can be exercised without a board.
+# Each axis is a StepperModel run tick for tick on a simulated clock, so moves
+# take as long as they would on the board, GET POS sees them in progress, and
+# HOME walks into a (simulated) limit switch and back out.
+#
+# Usage:
+# sim = ControllerSimulator()
+# sim.start()
+# handler = SerialHandler(port=sim.port, baud=9600)
+#
+# Or on its own, to point something else at it:
+# ControllerSimulator.py --speed 10 --limit 1:-500
+
+import optparse
+import os
+import pty
+import random
+import select
+import signal
+import sys
+import threading
+import time
+import tty
+from collections import deque
+
+from BinaryProtocol import crc8, decodeCommand, encodeReply, frameOverhead, \
+    frameStart, messageTypes
+from StepperModel import StepperModel, defaultMaxVelocity, tickFrequency
+
+# Number of axis the simulated board reports, same as MAX_STEPPERS
+controllerAxisCount = 4
+
+# Size of the Arduino HardwareSerial receive ring buffer, in characters
+rxBufferSize = 128
+
+# Size of the command buffer, same as CMD_BUF_LEN
+commandBufferSize = 64
+
+# Number of moves the board can queue up, same as QUEUE_LEN
+queueLength = 8
+
+# Rates BAUD accepts, and how long the board waits for an ALIVE at a new one
+# (BAUD_VERIFY_TIME) in seconds
+baudRates = [9600, 19200, 38400, 57600, 115200, 250000, 500000, 1000000]
+baudVerifyTime = 1.0
+
+# Shortest period WATCH will report at (MIN_WATCH_PERIOD), in ms
+minWatchPeriod = 20
+
+
+class ControllerSimulator:
+    def __init__(self, axisCount = controllerAxisCount, latency = 0, baud = None,
+                 maxBaud = None, speed = 1, maxVelocity = defaultMaxVelocity,
+                 limits = None, dropRate = 0, garbageRate = 0, seed = None):
+        self.axisCount = axisCount
+
+        # Simulated seconds per real second. Everything runs on the simulated
+        # clock: moves, latency, the link and the BAUD fallback.
+        self.speed = float(speed)
+        self.startTime = time.time()
+
+        # Seconds to wait before answering each command
+        self.latency = latency
+
+        # If set, characters take as long to cross the link as they would at
+        # this baud rate, and the board can't read while it is printing (the
+        # Arduino's Serial.print blocks)
+        self.baud = baud
+        self.linkFreeAt = 0
+        self.boardFreeAt = 0
+
+        # BAUD to anything faster than maxBaud "works" on the board's end, but
+        # nothing gets through until it gives up and goes back
+        self.maxBaud = maxBaud
+        self.garbled = False
+        self.oldBaud = None
+        self.baudDeadline = None
+
+        # Fraction of the bytes going either way that get lost, and how often
+        # a random byte gets added after one
+        self.dropRate = dropRate
+        self.garbageRate = garbageRate
+        self.random = random.Random(seed)
+        self.droppedBytes = 0
+        self.garbageBytes = 0
+
+        # Messages that have been written to us, with the time they finish
+        # arriving, and replies with the time they finish sending
+        self.inputLines = deque()
+        self.output = deque()
+
+        # Same as checkSerialInput: characters collect in the command buffer
+        # until there is a line, or (after BINARY) a frame. Replies go out the
+        # same way as the last command came in.
+        self.commandBuffer = bytearray()
+        self.inFrame = False
+        self.rxBinary = False
+        self.binary = False
+
+        # Most characters that were waiting in the receive buffer at once,
+        # and how many times that was more than the board could hold
+        self.maxRxBacklog = 0
+        self.overflows = 0
+
+        self.master, self.slave = pty.openpty()
+        # No echo, no newline translation; the board doesn't do either
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        self.index = 0
+
+        # Indexed by axis number, so there is nothing at 0. limits maps an
+        # axis to where its limit switch is; axis without one never find it.
+        if limits == None:
+            limits = {}
+        self.steppers = [None] + [StepperModel(maxVelocity, 0, limits.get(axis))
+                                  for axis in range(1, axisCount + 1)]
+
+        # Stepper interrupts run so far, and the simulated time the board has
+        # got up to
+        self.ticks = 0
+        self.now = 0
+
+        # Axis started by GOALL that haven't finished yet
+        self.groupAxes = set()
+
+        # Queued LINE moves as (positions, time), and the axis running one
+        self.queue = deque()
+        self.queueAxes = set()
+
+        # WATCH period in ms (0 for off), and the tick the next position
+        # report is due on
+        self.watchPeriod = 0
+        self.nextWatchTick = None
+
+        self.running = False
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def fork(self):
+        """ Run the simulator in a child process instead of a thread, so it
+            doesn't show up in the CPU time of whoever is benchmarking it """
+        self.pid = os.fork()
+        if self.pid == 0:
+            self.running = True
+            try:
+                self.run()
+            finally:
+                os._exit(0)
+
+    def stop(self):
+        self.running = False
+        if self.thread != None:
+            self.thread.join()
+        if self.pid != None:
+            os.kill(self.pid, signal.SIGTERM)
+            os.waitpid(self.pid, 0)
+        os.close(self.master)
+        os.close(self.slave)
+
+    def run(self):
+        while self.running:
+            readable, _, _ = select.select([self.master], [], [], self.nextTimeout())
+            if readable:
+                data = self.corrupt(os.read(self.master, 4096))
+                for message in self.parseInput(data):
+                    self.receiveLine(*message)
+
+            self.processInput()
+            self.advanceTo(self.clock())
+            self.sendOutput()
+
+    def clock(self):
+        """ Simulated time, in seconds since we started """
+        return (time.time() - self.startTime) * self.speed
+
+    def stepCounts(self):
+        """ Steps each axis has taken, over every move so far """
+        return [self.steppers[axis].stepCount for axis in range(1, self.axisCount + 1)]
+
+    def report(self):
+        lines = ["axis %d: %d steps, at %d" % (axis, stepper.stepCount, stepper.position)
+                 for axis, stepper in enumerate(self.steppers) if stepper != None]
+        lines.append("%.1f s simulated, receive buffer peaked at %d (%d overflows)" % (
+            self.now, self.maxRxBacklog, self.overflows))
+        lines.append("%d bytes dropped, %d bytes of garbage added" % (
+            self.droppedBytes, self.garbageBytes))
+        return "\n".join(lines)
+
+    def corrupt(self, data):
+        """ Lose and add bytes at the rates we were given """
+        if self.dropRate == 0 and self.garbageRate == 0:
+            return data
+
+        result = bytearray()
+        for byte in bytearray(data):
+            if self.random.random() < self.dropRate:
+                self.droppedBytes += 1
+            else:
+                result.append(byte)
+            if self.random.random() < self.garbageRate:
+                self.garbageBytes += 1
+                result.append(self.random.randint(0, 255))
+        return str(result)
+
+    def write(self, data):
+        os.write(self.master, self.corrupt(data))
+
+    def parseInput(self, data):
+        """ Split input into messages the way checkSerialInput does, a
+            character at a time. Returns (line, size, framed, error) for each,
+            where error is what the board would complain about instead of
+            running it. """
+        messages = []
+        for c in bytearray(data):
+            if len(self.commandBuffer) == 0:
+                self.inFrame = self.rxBinary and (c & frameStart) != 0
+            self.commandBuffer.append(c)
+            size = len(self.commandBuffer)
+
+            if self.inFrame:
+                if size < 2:
+                    continue
+                length = self.commandBuffer[1]
+                if length > commandBufferSize - frameOverhead:
+                    self.commandBuffer = bytearray()
+                    messages.append(("", size, True, "message too long"))
+                elif size == length + frameOverhead:
+                    line, error = self.decodeFrame(self.commandBuffer)
+                    self.commandBuffer = bytearray()
+                    messages.append((line, size, True, error))
+            elif c == ord("\n"):
+                line = str(self.commandBuffer[:-1])
+                self.commandBuffer = bytearray()
+                if line != "":
+                    self.rxBinary = line.startswith("BINARY")
+                messages.append((line, size, False, None))
+            elif size == commandBufferSize:
+                self.commandBuffer = bytearray()
+                messages.append(("", size, False, "message too long"))
+        return messages
+
+    def decodeFrame(self, frame):
+        """ Text of a command frame, and the ERROR processFrame would send
+            if it isn't valid """
+        if crc8(str(frame[:-1])) != frame[-1]:
+            return "", "frame failed CRC"
+        if frame[0] & ~frameStart >= len(messageTypes):
+            return "", "message had unknown prefix"
+        message = decodeCommand(frame)
+        if message == None:
+            return "", "message arguments did not parse"
+        return message, None
+
+    def checkBaud(self, now):
+        if self.baudDeadline != None and now > self.baudDeadline:
+            self.baudDeadline = None
+            self.garbled = False
+            if self.baud != None:
+                self.baud = self.oldBaud
+
+    def handleBAUD(self, rate):
+        if rate not in baudRates:
+            self.reply("ERROR baud rate not supported")
+            return
+        self.reply("ACK BAUD %d" % rate)
+
+        # Everything after the ACK is at the new rate
+        self.oldBaud = self.baud
+        if self.baud != None:
+            self.baud = rate
+        self.garbled = self.maxBaud != None and rate > self.maxBaud
+        self.baudDeadline = self.now + baudVerifyTime
+
+    def characterTime(self):
+        # 8N1: ten bits on the wire for every character
+        return 10.0 / self.baud
+
+    def receiveLine(self, line, size, framed, error):
+        arriveTime = self.clock()
+        if self.baud != None:
+            arriveTime = max(arriveTime, self.linkFreeAt) + size * self.characterTime()
+            self.linkFreeAt = arriveTime
+        self.inputLines.append((arriveTime + self.latency, line, size, framed, error))
+
+    def processInput(self):
+        while len(self.inputLines) > 0:
+            readyTime, line, size, framed, error = self.inputLines[0]
+            startTime = max(readyTime, self.boardFreeAt)
+            if startTime > self.clock():
+                return
+            self.inputLines.popleft()
+
+            # Catch the motors up to when the board gets to this message
+            self.advanceTo(startTime)
+
+            # Whatever else has arrived is sitting in the receive buffer
+            backlog = sum([m[2] for m in self.inputLines if m[0] <= startTime])
+            self.maxRxBacklog = max(self.maxRxBacklog, backlog)
+            if backlog > rxBufferSize:
+                self.overflows += 1
+
+            self.checkBaud(self.now)
+            if self.garbled:
+                continue
+
+            if error != None:
+                self.reply("ERROR " + error)
+                continue
+
+            # Text in, text out
+            if not framed and line != "":
+                self.binary = False
+
+            self.handleLine(line)
+
+    def advanceTo(self, t):
+        """ Run the stepper interrupt up to simulated time t, doing what
+            loop() does each time an axis stops """
+        target = int(t * tickFrequency)
+        while True:
+            tick = target
+            nextTick = self.nextEventTick()
+            if nextTick != None and nextTick < target:
+                tick = nextTick
+            if self.nextWatchTick != None:
+                tick = max(self.ticks, min(tick, self.nextWatchTick))
+
+            if tick > self.ticks:
+                for stepper in self.steppers[1:]:
+                    stepper.advance(tick - self.ticks)
+                self.ticks = tick
+                self.now = float(tick) / tickFrequency
+
+            self.checkFinished()
+            self.checkQueue()
+            self.checkWatch()
+            if tick >= target:
+                break
+        self.now = max(self.now, t)
+
+    def nextEventTick(self):
+        """ Tick the next axis will stop on, or None if none are moving """
+        ticks = [stepper.ticksLeft() for stepper in self.steppers[1:]]
+        ticks = [t for t in ticks if t != None]
+        if not ticks:
+            return None
+        return self.ticks + min(ticks)
+
+    def sendOutput(self):
+        now = self.clock()
+        while len(self.output) > 0 and self.output[0][0] <= now:
+            self.write(self.output.popleft()[1])
+
+    def nextTimeout(self):
+        """ Seconds until something needs doing, so replies go out on time """
+        pending = []
+        nextTick = self.nextEventTick()
+        if nextTick != None:
+            pending.append(float(nextTick) / tickFrequency)
+        if len(self.inputLines) > 0:
+            pending.append(max(self.inputLines[0][0], self.boardFreeAt))
+        if len(self.output) > 0:
+            pending.append(self.output[0][0])
+        if self.nextWatchTick != None:
+            pending.append(float(self.nextWatchTick) / tickFrequency)
+        if not pending:
+            return 0.1
+        return max(0, (min(pending) - self.clock()) / self.speed)
+
+    def checkFinished(self):
+        for axis in range(1, self.axisCount + 1):
+            if not self.steppers[axis].checkFinished():
+                continue
+            if axis in self.queueAxes:
+                self.queueAxes.discard(axis)
+                if len(self.queueAxes) == 0 and len(self.queue) == 0:
+                    self.reply("NOTICE DONE QUEUE")
+            elif axis in self.groupAxes:
+                self.groupAxes.discard(axis)
+                if len(self.groupAxes) == 0:
+                    self.reply("NOTICE DONE ALL")
+            else:
+                self.reply("NOTICE DONE " + str(axis))
+
+    def checkQueue(self):
+        """ Start the next queued move once everything has stopped """
+        if len(self.queue) == 0:
+            return
+
+        for axis in range(1, self.axisCount + 1):
+            if self.busy(axis):
+                return
+
+        # Everything has stopped, so if nothing starts now it never will
+        positions, moveTime = self.queue.popleft()
+        started, moveTime = self.moveAll(positions, moveTime, True)
+        if not started:
+            self.reply("NOTICE QUEUE REFUSED %d" % (queueLength - len(self.queue)))
+            if len(self.queueAxes) == 0 and len(self.queue) == 0:
+                self.reply("NOTICE DONE QUEUE")
+            return
+        self.queueAxes |= started
+        self.reply("NOTICE QUEUE %d" % (queueLength - len(self.queue)))
+
+    def checkWatch(self):
+        """ Send a position report if one is due, like checkWatch() """
+        if self.nextWatchTick == None or self.ticks < self.nextWatchTick:
+            return
+        self.nextWatchTick = self.ticks + self.watchPeriod * tickFrequency / 1000
+        steppers = self.steppers[1:]
+        self.reply("NOTICE POS %d %s %s" % (
+            self.ticks * 1000 / tickFrequency,
+            " ".join([str(stepper.position) for stepper in steppers]),
+            "".join([str(stepper.state) for stepper in steppers])))
+
+    def reply(self, message):
+        if self.binary:
+            data = str(encodeReply(message))
+        else:
+            data = message + "\n"
+
+        if self.baud == None:
+            self.write(data)
+            return
+
+        startTime = max(self.now, self.boardFreeAt)
+        self.boardFreeAt = startTime + len(data) * self.characterTime()
+        self.output.append((self.boardFreeAt, data))
+
+    def busy(self, axis):
+        return self.steppers[axis].busy()
+
+    def axisValid(self, axis):
+        return axis > 0 and axis <= self.axisCount
+
+    def handleLine(self, line):
+        # Blank lines are skipped
+        if line == "":
+            return
+        words = line.split() or [""]
+
+        try:
+            if words[0] == "ALIVE":
+                self.baudDeadline = None
+                self.reply("ACK ALIVE")
+            elif words[0] == "BAUD":
+                self.handleBAUD(int(words[1]))
+            elif words[0] == "WATCH":
+                self.handleWATCH(int(words[1]))
+            elif words[0] == "BINARY":
+                self.reply("ACK BINARY")
+                self.binary = True
+            elif words[0] == "STATE":
+                self.handleSTATE()
+            elif words[0] == "GOALL" or words[0] == "LINE":
+                self.handleGroupMove(words[0], [int(w) for w in words[1:self.axisCount + 1]],
+                                     int(words[self.axisCount + 1]))
+            elif words[0] == "QUEUE":
+                self.handleQUEUE([int(w) for w in words[1:self.axisCount + 1]],
+                                 int(words[self.axisCount + 1]))
+            elif words[0] == "FLUSH":
+                self.handleFLUSH()
+            elif words[0] == "GO":
+                self.handleGO(int(words[1]), int(words[2]), int(words[3]))
+            elif words[0] == "STOP":
+                self.handleSTOP()
+            elif words[0] == "HOME":
+                self.handleHOME(int(words[1]))
+            elif words[0] == "GET":
+                self.handleGET(words[1], words[2:])
+            elif words[0] == "SET":
+                self.handleSET(words[1], words[2:])
+            else:
+                self.reply("ERROR message had unknown prefix")
+        except (IndexError, ValueError):
+            self.reply("ERROR message arguments did not parse")
+
+    def handleSTATE(self):
+        for axis in range(1, self.axisCount + 1):
+            if self.busy(axis):
+                self.reply("ACK STATE GOING")
+                return
+        self.reply("ACK STATE READY")
+
+    def handleWATCH(self, period):
+        if period < 0:
+            self.reply("ERROR period out of bounds")
+            return
+        if period != 0 and period < minWatchPeriod:
+            period = minWatchPeriod
+        self.watchPeriod = period
+        self.reply("ACK WATCH %d" % period)
+
+        # First report straight away
+        self.nextWatchTick = None
+        if period != 0:
+            self.nextWatchTick = self.ticks
+
+    def handleGO(self, axis, position, moveTime):
+        if not self.axisValid(axis):
+            self.reply("ERROR Axis out of bounds")
+            return
+
+        moveTime = self.steppers[axis].moveAbsolute(position, moveTime)
+        if moveTime == None:
+            self.reply("ERROR Couldn't acheive desired motion")
+            return
+        self.reply("ACK GO %d %d %d" % (axis, position, moveTime))
+
+    def handleGroupMove(self, name, positions, moveTime):
+        started, moveTime = self.moveAll(positions, moveTime, name == "LINE")
+
+        # The axis that did start will still report DONE ALL when they finish
+        self.groupAxes |= started
+        if len(started) < self.axisCount:
+            self.reply("ERROR Couldn't acheive desired motion")
+            return
+        self.reply("ACK %s %s %d" % (name, " ".join([str(p) for p in positions]), moveTime))
+
+    def handleQUEUE(self, positions, moveTime):
+        if len(self.queue) >= queueLength:
+            self.reply("ERROR queue full")
+            return
+        self.queue.append((positions, moveTime))
+        self.reply("ACK QUEUE %d" % (queueLength - len(self.queue)))
+
+    def moveAll(self, positions, moveTime, coordinated):
+        """ Mirror of Stepper::moveAll. Returns the set of axis that started,
+            and the longest time (ms) any of them will take. """
+        for axis in range(1, self.axisCount + 1):
+            if self.busy(axis):
+                return set(), moveTime
+
+        # LINE slows everyone down to the pace of the slowest axis
+        if coordinated:
+            for axis in range(1, self.axisCount + 1):
+                moveTime = max(moveTime, self.steppers[axis].getMinimumTime(positions[axis - 1]))
+
+        started = set()
+        longestTime = 0
+        for axis in range(1, self.axisCount + 1):
+            axisTime = self.steppers[axis].moveAbsolute(positions[axis - 1], moveTime, coordinated)
+            if axisTime != None:
+                started.add(axis)
+                longestTime = max(longestTime, axisTime)
+        return started, longestTime
+
+    def handleFLUSH(self):
+        flushed = len(self.queue) > 0
+        self.queue.clear()
+        self.reply("ACK FLUSH")
+        self.finishFlush(flushed)
+
+    def handleSTOP(self):
+        flushed = len(self.queue) > 0
+        self.queue.clear()
+        for axis in range(1, self.axisCount + 1):
+            self.steppers[axis].stop()
+        self.reply("ACK STOP")
+        self.finishFlush(flushed)
+
+    def finishFlush(self, flushed):
+        """ With no queued move running, there's no DONE coming to finish
+            off the queue """
+        if flushed and len(self.queueAxes) == 0:
+            self.reply("NOTICE DONE QUEUE")
+
+    def handleHOME(self, axis):
+        if not self.axisValid(axis):
+            self.reply("ERROR Axis out of bounds")
+            return
+        if not self.steppers[axis].home():
+            self.reply("ERROR Couldn't home")
+            return
+        self.reply("ACK HOME %d" % axis)
+
+    def handleGET(self, param, args):
+        if param == "VERSION":
+            self.reply("ACK GET VERSION 2")
+            return
+        if param == "INDEX":
+            self.reply("ACK GET INDEX %d" % self.index)
+            return
+        if param == "QUEUE":
+            self.reply("ACK GET QUEUE %d" % (queueLength - len(self.queue)))
+            return
+
+        attribute = self.parameterAttribute(param)
+        if attribute == None:
+            self.reply("ERROR message arguments did not parse")
+            return
+        axis = int(args[0])
+        if not self.axisValid(axis):
+            self.reply("ERROR parameter axis out of bounds")
+            return
+        value = getattr(self.steppers[axis], attribute)
+        self.reply("ACK GET %s %d %d" % (param, axis, value))
+
+    def handleSET(self, param, args):
+        if param == "VERSION":
+            self.reply("ERROR Can't change the version number!")
+            return
+        if param == "QUEUE":
+            self.reply("ERROR Can't set the queue size!")
+            return
+        if param == "INDEX":
+            self.index = int(args[0])
+            self.reply("ACK SET INDEX %d" % self.index)
+            return
+
+        attribute = self.parameterAttribute(param)
+        if attribute == None:
+            self.reply("ERROR message arguments did not parse")
+            return
+        axis = int(args[0])
+        value = int(args[1])
+        if not self.axisValid(axis):
+            self.reply("ERROR parameter axis out of bounds")
+            return
+        if param == "STOP_MODE" and value not in [0, 1]:
+            self.reply("ERROR stop mode not understood")
+            return
+        # The Stepper setters all refuse while the axis is moving
+        if self.busy(axis):
+            self.reply("ERROR invalid parameter")
+            return
+        if param == "POS":
+            # Moves the limit switch along with it
+            self.steppers[axis].setPosition(value)
+        else:
+            setattr(self.steppers[axis], attribute, value)
+        self.reply("ACK SET %s %d %d" % (param, axis, value))
+
+    def parameterAttribute(self, param):
+        """ StepperModel attribute behind an axis parameter """
+        return {"MAX_VEL":   "maxVelocity",
+                "ACCEL":     "acceleration",
+                "STOP_MODE": "stopMode",
+                "POS":       "position"}.get(param)
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--speed", type="float", default=1,
+                      help="simulated seconds per real second")
+    parser.add_option("--latency", type="float", default=0,
+                      help="seconds before each command is answered")
+    parser.add_option("--baud", type="int",
+                      help="take as long as this baud rate would on the wire")
+    parser.add_option("--max-vel", type="int", default=defaultMaxVelocity,
+                      help="starting MAX_VEL of every axis")
+    parser.add_option("--limit", action="append", default=[], metavar="AXIS:POS",
+                      help="put a limit switch on an axis")
+    parser.add_option("--drop", type="float", default=0,
+                      help="fraction of bytes lost each way")
+    parser.add_option("--garbage", type="float", default=0,
+                      help="chance of a random byte after each one")
+    parser.add_option("--seed", type="int")
+    options, args = parser.parse_args(argv)
+
+    limits = {}
+    for limit in options.limit:
+        axis, position = limit.split(":")
+        limits[int(axis)] = int(position)
+
+    sim = ControllerSimulator(latency=options.latency, baud=options.baud,
+                              speed=options.speed, maxVelocity=options.max_vel,
+                              limits=limits, dropRate=options.drop,
+                              garbageRate=options.garbage, seed=options.seed)
+    print sim.port
+
+    sim.running = True
+    try:
+        sim.run()
+    except KeyboardInterrupt:
+        pass
+    print sim.report()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,126 @@
+
+# Stands in for libgphoto2 (the parts of it CameraController uses), so the
+# camera code can be run, and timed, without a camera plugged in. Every
+# picture is the same block of bytes; taking and downloading one can be made
+# to take as long as it would on a real camera.
+#
+# Usage:
+# camera = CameraController(DiskSink(), MockGphoto2(imageSize=6 << 20))
+# camera.capture("test.jpg")
+
+from CameraController import GP_OK
+
+import ctypes
+import os
+import time
+
+# Defined in 'gphoto2-port-result.h' and 'gphoto2-result.h'
+GP_ERROR_BAD_PARAMETERS = -2
+GP_ERROR_FILE_NOT_FOUND = -108
+
+# libgphoto2 writes a picture to a file descriptor as it comes off the
+# camera, a USB transfer at a time
+transferSize = 1 << 16
+
+folder = "/store_00010001/DCIM/100CANON"
+
+
+class MockGphoto2:
+    def __init__(self, imageSize = 6 << 20, exposureTime = 0, downloadTime = 0,
+                 previewSize = 60 << 10, previewTime = 0):
+        self.image = os.urandom(imageSize)
+        self.exposureTime = exposureTime
+        self.downloadTime = downloadTime
+        self.preview = os.urandom(previewSize)
+        self.previewTime = previewTime
+
+        # Pictures on the camera, by (folder, name)
+        self.pictures = {}
+        self.pictureCount = 0
+
+        # CameraFiles, by handle: [fd, buffer]
+        self.files = {}
+        self.nextHandle = 1
+
+    def gp_context_new(self):
+        return 1
+
+    def gp_camera_new(self, camera):
+        camera[0] = 1
+        return GP_OK
+
+    def gp_camera_init(self, camera, context):
+        return GP_OK
+
+    def gp_camera_exit(self, camera, context):
+        return GP_OK
+
+    def gp_camera_unref(self, camera):
+        return GP_OK
+
+    def gp_camera_capture(self, camera, captureType, path, context):
+        time.sleep(self.exposureTime)
+        self.pictureCount += 1
+        name = "IMG_%04d.JPG" % self.pictureCount
+        path.contents.folder = folder
+        path.contents.name = name
+        self.pictures[(folder, name)] = self.image
+        return GP_OK
+
+    def gp_camera_capture_preview(self, camera, cameraFile, context):
+        entry = self.files.get(cameraFile.value)
+        if entry == None:
+            return GP_ERROR_BAD_PARAMETERS
+        time.sleep(self.previewTime)
+        entry[1] = ctypes.create_string_buffer(self.preview, len(self.preview))
+        return GP_OK
+
+    def newFile(self, cameraFile, fd):
+        handle = self.nextHandle
+        self.nextHandle += 1
+        self.files[handle] = [fd, None]
+        cameraFile[0] = handle
+        return GP_OK
+
+    def gp_file_new(self, cameraFile):
+        return self.newFile(cameraFile, None)
+
+    def gp_file_new_from_fd(self, cameraFile, fd):
+        return self.newFile(cameraFile, fd)
+
+    def gp_file_unref(self, cameraFile):
+        fd, buffer = self.files.pop(cameraFile.value)
+        if fd != None:
+            os.close(fd)
+        return GP_OK
+
+    def gp_camera_file_get(self, camera, pictureFolder, name, fileType, cameraFile, context):
+        image = self.pictures.get((pictureFolder, name))
+        if image == None:
+            return GP_ERROR_FILE_NOT_FOUND
+        entry = self.files.get(cameraFile.value)
+        if entry == None:
+            return GP_ERROR_BAD_PARAMETERS
+
+        time.sleep(self.downloadTime)
+        fd = entry[0]
+        # Either way, the picture is copied off the camera into memory first
+        if fd != None:
+            for offset in range(0, len(image), transferSize):
+                os.write(fd, image[offset:offset + transferSize])
+        else:
+            entry[1] = ctypes.create_string_buffer(image, len(image))
+        return GP_OK
+
+    def gp_file_get_data_and_size(self, cameraFile, data, size):
+        entry = self.files.get(cameraFile.value)
+        if entry == None or entry[1] == None:
+            return GP_ERROR_BAD_PARAMETERS
+        data[0] = ctypes.cast(entry[1], ctypes.POINTER(ctypes.c_char))
+        size[0] = len(entry[1])
+        return GP_OK
+
+    def gp_camera_file_delete(self, camera, pictureFolder, name, context):
+        if self.pictures.pop((pictureFolder, name), None) == None:
+            return GP_ERROR_FILE_NOT_FOUND
+        return GP_OK
@@ -0,0 +1,281 @@
+
+# Motion scripts (as written by gen_soa.py), compiled into flat arrays instead
+# of a list per line. The compiled form is cached next to the script, keyed on
+# a hash of it, so a script is only parsed again once it changes.
+#
+# Scripts too big to want in memory can be run straight from the file
+# instead; streamScript() parses a frame at a time, as they are asked for.
+#
+# Usage:
+# script = compileScript("soa_beetle")
+# for index, opcode, values in script.frames():
+#     if opcode == OP_GO: ...
+#
+# for index, opcode, values in streamScript("soa_beetle", start=1000): ...
+#
+# A GO can also give the time the move should take, in ms, after the
+# positions (see Planner.py); with none, or 0, every axis goes as fast as it
+# can.
+
+import array
+import hashlib
+import struct
+
+OP_GO = 0
+OP_HOME = 1
+OP_SNAP = 2
+
+opcodeNames = ["GO", "HOME", "SNAP"]
+opcodes = dict([(name, opcode) for opcode, name in enumerate(opcodeNames)])
+
+# Values each command takes: a position for every axis (A X Y Z) for GO, an
+# axis for HOME and a camera for SNAP, and the most it can take (GO can have
+# a time as well). Every frame has room for frameValues; the ones a command
+# doesn't use are 0.
+positionCount = 4
+valueCounts = [positionCount, 1, 1]
+maxValueCounts = [positionCount + 1, 1, 1]
+frameValues = 5
+
+# HOME can only be given an axis we have
+homeAxes = range(4)
+
+# Compiled scripts are saved as [magic] [hash] [frame count] [opcodes] [values]
+cacheMagic = "MSC2"
+cacheHeader = struct.Struct("<4s20sI")
+cacheSuffix = ".compiled"
+
+
+class MotionScript:
+    def __init__(self):
+        self.opcodes = array.array('B')
+        self.values = array.array('i')
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def __iter__(self):
+        for index in range(len(self.opcodes)):
+            yield self.frame(index)
+
+    def frames(self, start = 0):
+        """ (index, opcode, values) for each frame from start on, the same
+            as streamScript() gives """
+        for index in range(start, len(self.opcodes)):
+            opcode, values = self.frame(index)
+            yield index, opcode, values
+
+    def append(self, opcode, values):
+        self.opcodes.append(opcode)
+        self.values.extend(values + [0] * (frameValues - len(values)))
+
+    def frame(self, index):
+        """ Opcode and values of a frame """
+        start = index * frameValues
+        return self.opcodes[index], self.values[start:start + frameValues].tolist()
+
+    def frameText(self, index):
+        return frameText(*self.frame(index))
+
+    def save(self, path, digest):
+        output = open(path, "wb")
+        try:
+            output.write(cacheHeader.pack(cacheMagic, digest, len(self.opcodes)))
+            self.opcodes.tofile(output)
+            self.values.tofile(output)
+        finally:
+            output.close()
+
+    def saveText(self, path):
+        """ Write the script back out as a script file """
+        output = open(path, "w")
+        try:
+            output.write("".join([frameText(opcode, values) + "\n" for opcode, values in self]))
+        finally:
+            output.close()
+
+    def load(self, path, digest = None):
+        """ Read a cached script back. Returns False if it isn't there, or
+            isn't for a script with this hash (with digest None, any
+            script will do). """
+        try:
+            input = open(path, "rb")
+        except IOError:
+            return False
+
+        try:
+            magic, cachedDigest, count = cacheHeader.unpack(input.read(cacheHeader.size))
+            if magic != cacheMagic or (digest != None and cachedDigest != digest):
+                return False
+            self.opcodes.fromfile(input, count)
+            self.values.fromfile(input, count * frameValues)
+        except (struct.error, EOFError):
+            self.opcodes = array.array('B')
+            self.values = array.array('i')
+            return False
+        finally:
+            input.close()
+        return True
+
+
+def hashFile(filename):
+    digest = hashlib.sha1()
+    input = open(filename, "rb")
+    try:
+        for block in iter(lambda: input.read(1 << 16), ""):
+            digest.update(block)
+    finally:
+        input.close()
+    return digest.digest()
+
+
+def frameText(opcode, values):
+    """ A frame the way it was written in the script """
+    count = valueCounts[opcode]
+    if len(values) > count and count < maxValueCounts[opcode] and values[count] != 0:
+        count += 1
+    return " ".join([opcodeNames[opcode]] + [str(value) for value in values[:count]])
+
+
+def parseLines(lines):
+    """ Parse the lines of a script as they are asked for. Yields
+        (lineNumber, opcode, values) for each frame, with opcode None and a
+        message instead of values if the line is wrong. """
+    for lineNumber, line in enumerate(lines, 1):
+        words = line.split()
+        if not words or words[0].startswith("#"):
+            continue
+
+        opcode = opcodes.get(words[0])
+        if opcode == None:
+            yield lineNumber, None, "line %d: unknown command: %s" % (lineNumber, line.strip())
+            continue
+
+        if len(words) - 1 < valueCounts[opcode] or len(words) - 1 > maxValueCounts[opcode]:
+            counts = "%d" % valueCounts[opcode]
+            if maxValueCounts[opcode] > valueCounts[opcode]:
+                counts += " or %d" % maxValueCounts[opcode]
+            yield lineNumber, None, "line %d: %s takes %s values: %s" % (
+                lineNumber, words[0], counts, line.strip())
+            continue
+        try:
+            values = map(int, words[1:])
+        except ValueError:
+            yield lineNumber, None, "line %d: values must be whole numbers: %s" % (
+                lineNumber, line.strip())
+            continue
+
+        if opcode == OP_HOME and values[0] not in homeAxes:
+            yield lineNumber, None, "line %d: no such axis: %s" % (lineNumber, line.strip())
+            continue
+
+        if opcode == OP_GO and len(values) > positionCount and values[positionCount] < 0:
+            yield lineNumber, None, "line %d: time can't be negative: %s" % (lineNumber, line.strip())
+            continue
+
+        yield lineNumber, opcode, values
+
+
+def parseScript(lines):
+    """ Compile the lines of a script. Returns the script, and a message for
+        every line that was wrong. """
+    script = MotionScript()
+    errors = []
+
+    # Every frame takes frameValues values, whatever the command needs. They
+    # go into a flat list first; growing an array a value at a time is slower.
+    padding = [[0] * (frameValues - count) for count in range(frameValues + 1)]
+    values = []
+    addOpcode = script.opcodes.append
+    addValues = values.extend
+
+    for lineNumber, opcode, frame in parseLines(lines):
+        if opcode == None:
+            errors.append(frame)
+            continue
+        addOpcode(opcode)
+        addValues(frame)
+        addValues(padding[len(frame)])
+
+    script.values = array.array('i', values)
+    return script, errors
+
+
+def mergeMoves(frames):
+    """ Drop every GO frame that is followed straight away by another GO, so
+        each run of them (with no SNAP or HOME in between) becomes one move
+        to where the run ends up. Only for scripts where the path between
+        pictures doesn't matter. """
+    previous = None
+    for frame in frames:
+        if previous != None and not (previous[1] == OP_GO and frame[1] == OP_GO):
+            yield previous
+        previous = frame
+    if previous != None:
+        yield previous
+
+
+def streamScript(filename, start = 0):
+    """ (index, opcode, values) for each frame of a script file from start
+        on, read and checked only as they are asked for, so memory use
+        doesn't grow with the script. Frames are numbered the same as in the
+        compiled script. Raises NameError on reaching a bad line. """
+    input = open(filename)
+    try:
+        index = 0
+        for lineNumber, opcode, values in parseLines(input):
+            if opcode == None:
+                raise NameError("error in %s, %s" % (filename, values))
+            if index >= start:
+                yield index, opcode, values + [0] * (frameValues - len(values))
+            index += 1
+    finally:
+        input.close()
+
+
+def compileScript(filename, useCache = True):
+    """ Compile a script file, or load it from the cache if it hasn't
+        changed. Raises NameError listing every bad line if it doesn't
+        compile. A file that is already compiled (ending in .compiled, as
+        written by Trajectory.py) is loaded as it is. """
+    if filename.endswith(cacheSuffix):
+        script = MotionScript()
+        if not script.load(filename):
+            raise NameError("%s isn't a compiled script" % filename)
+        return script
+
+    digest = hashFile(filename)
+    cachePath = filename + cacheSuffix
+
+    script = MotionScript()
+    if useCache and script.load(cachePath, digest):
+        return script
+
+    input = open(filename)
+    try:
+        script, errors = parseScript(input)
+    finally:
+        input.close()
+
+    if errors:
+        raise NameError("%d errors in %s:\n%s" % (len(errors), filename, "\n".join(errors)))
+
+    if useCache:
+        try:
+            script.save(cachePath, digest)
+        except IOError:
+            # Nowhere to put it; we'll just have to compile it again next time
+            pass
+    return script
+
+
+if __name__ == "__main__":
+    # Check a script, and compile it into the cache:
+    # MotionScript.py script
+    import sys
+    try:
+        script = compileScript(sys.argv[1])
+    except NameError, e:
+        print e.args[0]
+        sys.exit(2)
+    print len(script), "frames"
@@ -0,0 +1,234 @@
+
+# How long a motion script will take, worked out without running it, the way
+# the controller plans each move (Stepper::planMove, mirrored by planMove()
+# in StepperModel.py) but for every frame and axis at once. It also says
+# which axis holds up each frame, and can give every GO a time, so each axis
+# takes as long as the slowest one instead of getting there first and
+# waiting (see the GO time in MotionScript.py).
+#
+# Usage:
+# script = compileScript("soa_beetle")
+# plan = planScript(script, maxVelocity=[200, 400, 400, 200])
+# print plan.totalTime()
+# for axis, frames, waiting, keepUp in plan.bottlenecks(): ...
+# retimeScript(script, plan).saveText("soa_beetle.timed")
+#
+# Or: Planner.py --max-vel 200,400,400,200 soa_beetle
+
+from MotionScript import MotionScript, OP_GO, OP_HOME, OP_SNAP, frameValues, positionCount
+from StepperModel import defaultMaxVelocity
+
+import array
+import numpy
+
+axisNames = ["A", "X", "Y", "Z"]
+
+
+def planMoves(steps, moveTimes, maxVelocity, acceleration):
+    """ planMove() for arrays of moves at once. maxVelocity and
+        acceleration can be given per axis. Returns the time each move
+        takes, in ms (0 for moves that don't go anywhere). """
+    steps = numpy.asarray(steps, dtype=float)
+    moveTimes = numpy.asarray(moveTimes, dtype=float)
+    maxVelocity = numpy.asarray(maxVelocity, dtype=float)
+    acceleration = numpy.asarray(acceleration, dtype=float)
+
+    # Without acceleration, constant speed: the time asked for, unless that
+    # would be faster than maxVelocity
+    fastest = numpy.floor(steps * 1000 / maxVelocity)
+    tooFast = (moveTimes <= 0) | (steps * 1000 > maxVelocity * moveTimes)
+    times = numpy.where(tooFast, fastest, moveTimes)
+
+    if numpy.any(acceleration > 0):
+        # T = S/v + v/a for a trapezoid; the slowest v that makes it in time
+        a = numpy.where(acceleration > 0, acceleration, 1)
+        t = moveTimes / 1000
+        discriminant = a * a * t * t - 4 * a * steps
+        slowest = (a * t - numpy.sqrt(numpy.maximum(discriminant, 0))) / 2
+        v = numpy.where((moveTimes > 0) & (discriminant >= 0),
+                        numpy.minimum(maxVelocity, slowest), maxVelocity)
+
+        # Short moves never get up to speed
+        v = numpy.maximum(numpy.minimum(v, numpy.sqrt(a * steps)), 1)
+        times = numpy.where(acceleration > 0, numpy.floor((steps / v + v / a) * 1000), times)
+
+    return numpy.where(steps > 0, times, 0)
+
+
+class Plan:
+    def __init__(self, opcodes, positions, steps, axisTimes, frameTimes):
+        # For every frame: what it is, where every axis is once it's done,
+        # how far each moved, and how long (ms) each axis and the frame took
+        self.opcodes = opcodes
+        self.positions = positions
+        self.steps = steps
+        self.axisTimes = axisTimes
+        self.frameTimes = frameTimes
+
+    def totalTime(self):
+        """ Seconds the whole script takes """
+        return self.frameTimes.sum() / 1000.0
+
+    def timeOf(self, opcode):
+        """ Seconds spent on one kind of frame """
+        return self.frameTimes[self.opcodes == opcode].sum() / 1000.0
+
+    def slowestAxes(self):
+        """ The axis that took longest in each frame, or -1 if none moved """
+        slowest = numpy.argmax(self.axisTimes, axis=1)
+        return numpy.where(self.axisTimes.max(axis=1) > 0, slowest, -1)
+
+    def bottlenecks(self, maxVelocity):
+        """ For each axis: (frames it was the slowest in, seconds the others
+            spent waiting for it, the MAX_VEL it would need to keep up with
+            the others everywhere they move too) """
+        slowest = self.slowestAxes()
+        results = []
+        for axis in range(self.axisTimes.shape[1]):
+            others = numpy.delete(self.axisTimes, axis, axis=1).max(axis=1)
+            held = slowest == axis
+            waiting = (self.axisTimes[held, axis] - others[held]).sum() / 1000.0
+
+            # Only counting moves with no acceleration, which is the fastest
+            # it could be
+            shared = held & (others > 0)
+            keepUp = maxVelocity[axis]
+            if numpy.any(shared):
+                keepUp = max(keepUp, int(numpy.ceil(
+                    (self.steps[shared, axis] * 1000.0 / others[shared]).max())))
+            results.append((axis, int(held.sum()), waiting, keepUp))
+        return results
+
+
+def scriptArrays(script):
+    """ The opcodes and values of a compiled script as NumPy arrays, without
+        copying them """
+    opcodes = numpy.frombuffer(script.opcodes, dtype=numpy.uint8)
+    values = numpy.frombuffer(script.values, dtype=numpy.int32).reshape(-1, frameValues)
+    return opcodes, values
+
+
+def planScript(script, maxVelocity = defaultMaxVelocity, acceleration = 0,
+               start = None, snapTime = 0, frameOverhead = 0):
+    """ Work out how long each frame of a compiled script takes. Axes start
+        at start (0 for all of them to begin with). HOME is taken to find the
+        limit switch at 0, and a SNAP to take snapTime ms. frameOverhead ms
+        are added to each move for getting the command there and the DONE
+        back. """
+    opcodes, values = scriptArrays(script)
+    count = len(opcodes)
+    axes = positionCount
+    maxVelocity = numpy.resize(numpy.asarray(maxVelocity, dtype=float), axes)
+    acceleration = numpy.resize(numpy.asarray(acceleration, dtype=float), axes)
+    if start is None:
+        start = numpy.zeros(axes)
+    start = numpy.asarray(start, dtype=float)
+
+    # Where each frame sends each axis: GO sends them all, HOME one of them
+    # to 0, and SNAP nowhere
+    isGo = opcodes == OP_GO
+    isHome = opcodes == OP_HOME
+    sets = numpy.zeros((count, axes), dtype=bool)
+    sets[isGo] = True
+    homes = numpy.nonzero(isHome)[0]
+    sets[homes, values[homes, 0]] = True
+    targets = numpy.where(isGo[:, None], values[:, :axes], 0)
+
+    # Each axis stays wherever the last frame that moved it sent it
+    lastSet = numpy.where(sets, numpy.arange(count)[:, None], -1)
+    lastSet = numpy.maximum.accumulate(lastSet, axis=0)
+    columns = numpy.arange(axes)
+    positions = numpy.where(lastSet >= 0, targets[numpy.maximum(lastSet, 0), columns], start)
+    previous = numpy.vstack([start[None, :], positions[:-1]])
+    steps = numpy.where(sets, numpy.abs(positions - previous), 0)
+
+    moveTimes = numpy.where(isGo, values[:, axes], 0)[:, None]
+    axisTimes = planMoves(steps, moveTimes, maxVelocity, acceleration)
+
+    frameTimes = axisTimes.max(axis=1)
+    frameTimes[(isGo | isHome) & (frameTimes > 0)] += frameOverhead
+    frameTimes[opcodes == OP_SNAP] = snapTime
+    return Plan(opcodes, positions, steps, axisTimes, frameTimes)
+
+
+def retimeScript(script, plan):
+    """ A copy of the script with each GO that moves given the time its
+        slowest axis takes, so the rest take that long as well """
+    opcodes, values = scriptArrays(script)
+    values = values.copy()
+    moving = (opcodes == OP_GO) & (plan.axisTimes.max(axis=1) > 0)
+    values[moving, positionCount] = plan.axisTimes[moving].max(axis=1)
+
+    retimed = MotionScript()
+    retimed.opcodes = array.array('B', script.opcodes)
+    retimed.values = array.array('i', values.tobytes())
+    return retimed
+
+
+def formatDuration(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return "%d:%02d:%04.1f" % (hours, minutes, seconds)
+
+
+if __name__ == "__main__":
+    import optparse
+    import sys
+
+    from MotionScript import cacheSuffix, compileScript
+
+    def axisValues(text):
+        values = [int(value) for value in text.split(",")]
+        if len(values) == 1:
+            values = values * positionCount
+        if len(values) != positionCount:
+            raise ValueError("need 1 or %d values: %s" % (positionCount, text))
+        return values
+
+    parser = optparse.OptionParser(usage="%prog [options] script")
+    parser.add_option("--max-vel", default=str(defaultMaxVelocity),
+                      help="MAX_VEL of each axis, or of all of them (steps/s)")
+    parser.add_option("--accel", default="0",
+                      help="ACCEL of each axis, or of all of them (steps/s/s)")
+    parser.add_option("--from", dest="start", help="where each axis starts")
+    parser.add_option("--snap-time", type="int", default=0,
+                      help="ms each picture takes")
+    parser.add_option("--overhead", type="int", default=0,
+                      help="ms each move takes on top of the move itself")
+    parser.add_option("--retime", metavar="OUTPUT",
+                      help="write the script with a time for every GO")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("which script?")
+
+    try:
+        maxVelocity = axisValues(options.max_vel)
+        acceleration = axisValues(options.accel)
+        start = axisValues(options.start) if options.start else None
+        script = compileScript(args[0])
+    except (ValueError, NameError), e:
+        parser.error(str(e))
+
+    plan = planScript(script, maxVelocity, acceleration, start, options.snap_time,
+                      options.overhead)
+    print "%d frames: %s (moving %s, homing %s, pictures %s)" % (
+        len(script), formatDuration(plan.totalTime()), formatDuration(plan.timeOf(OP_GO)),
+        formatDuration(plan.timeOf(OP_HOME)), formatDuration(plan.timeOf(OP_SNAP)))
+
+    moves = plan.frameTimes[plan.opcodes == OP_GO]
+    if len(moves) > 0:
+        moves = numpy.sort(moves)
+        print "moves: p50 %d ms  p95 %d ms  max %d ms" % (
+            moves[len(moves) / 2], moves[int(len(moves) * 0.95)], moves[-1])
+
+    for axis, frames, waiting, keepUp in plan.bottlenecks(maxVelocity):
+        print "%s: slowest in %6d frames, others wait %s for it, keeps up at MAX_VEL %d" % (
+            axisNames[axis], frames, formatDuration(waiting), keepUp)
+
+    if options.retime:
+        retimed = retimeScript(script, plan)
+        if options.retime.endswith(cacheSuffix):
+            retimed.save(options.retime, "\0" * 20)
+        else:
+            retimed.saveText(options.retime)
+        print "retimed script written to", options.retime
@@ -0,0 +1,174 @@
+
+# A rig is every controller board, and the axis on them, as one machine.
+# Which board each axis is on comes from a config file:
+#
+# [board xyz]
+# port = /dev/ttyUSB1
+# baud = 9600
+#
+# [board a]
+# port = /dev/ttyUSB0
+#
+# [axes]
+# # name = board axis, in the order positions are given
+# A = a 1
+# X = xyz 1
+# Y = xyz 2
+# Z = xyz 3
+#
+# Boards can also have binary = yes, to use the binary protocol, and
+# rates = 115200 250000 to pick which faster link speeds to try (leave it
+# empty to stay at baud), and transcript = xyz.transcript to record
+# everything sent to and from the board, for replay_transcript.py.
+#
+# Usage:
+# rig = loadRig("rig.cfg")
+# rig.moveTo([0, 100, 200, 300])
+# rig.wait(60)
+# rig.report()
+
+from StepperAxis import *
+from Transcript import TranscriptWriter
+
+import ConfigParser
+import threading
+
+boardPrefix = "board "
+
+
+class Rig:
+    def __init__(self, boards, axes):
+        """ boards maps each board's name to its SerialHandler, and axes is
+            a list of (name, board name, axis on the board) """
+        self.boards = boards
+        self.names = []
+        self.steppers = []
+        self.axes = {}
+        for name, board, axis in axes:
+            if name in self.axes:
+                raise NameError("Axis listed twice: ", name)
+            if board not in boards:
+                raise NameError("No such board: ", board)
+            if axis < 1 or axis > controllerAxisCount:
+                raise NameError("No such axis on the board: ", name, axis)
+            stepper = stepperAxis(axis, boards[board])
+            self.names.append(name)
+            self.steppers.append(stepper)
+            self.axes[name] = stepper
+
+    def axis(self, name):
+        return self.axes[name]
+
+    def moveTo(self, positions, coordinated = False, moveTime = 0):
+        """ Start every axis towards its position. Each board gets one
+            command, and they are all sent before waiting for the answers.
+            See moveAxesAbsolute() for moveTime. """
+        moveAxesAbsolute(self.steppers, positions, coordinated, moveTime)
+
+    def stream(self, frames, moveTime = 0, timeout = None):
+        """ Queue up frames of positions on every board, see
+            streamAxesAbsolute() """
+        streamAxesAbsolute(self.steppers, frames, moveTime, timeout)
+
+    def home(self, name):
+        self.axes[name].home()
+
+    def wait(self, timeout = None):
+        """ Block until every axis is done moving. Returns False on timeout. """
+        return len(waitForAxes(self.steppers, timeout)) == len(self.steppers)
+
+    def latencies(self):
+        """ Round trip times of each board's recent commands, in seconds, as
+            {board: (count, mean, median, 99th percentile, max)} """
+        latencies = {}
+        for name, handler in self.boards.items():
+            times = sorted(handler.roundTrips)
+            if len(times) == 0:
+                continue
+            latencies[name] = (len(times), sum(times) / len(times),
+                               times[len(times) / 2],
+                               times[int(len(times) * 0.99)], times[-1])
+        return latencies
+
+    def report(self):
+        latencies = self.latencies()
+        for name in sorted(self.boards):
+            if name not in latencies:
+                print "%-8s no commands yet" % name
+                continue
+            print "%-8s %5d commands  round trip mean %6.2f ms  p50 %6.2f ms  p99 %6.2f ms  max %6.2f ms" % (
+                (name, latencies[name][0]) + tuple([1000 * t for t in latencies[name][1:]]))
+
+    def disconnect(self):
+        for handler in self.boards.values():
+            handler.disconnect()
+
+
+def connectBoards(settings):
+    """ Open every board at once, since finding the link speed takes a few
+        seconds for each. settings maps names to SerialHandler arguments,
+        except that transcript is the file to record to. Returns a map of
+        names to handlers. """
+    boards = {}
+    errors = []
+
+    def connect(name, arguments):
+        try:
+            if "transcript" in arguments:
+                arguments = dict(arguments, transcript=TranscriptWriter(arguments["transcript"]))
+            boards[name] = SerialHandler(**arguments)
+        except Exception, e:
+            errors.append((name, e))
+
+    threads = [threading.Thread(target=connect, args=item) for item in settings.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if len(errors) > 0:
+        for handler in boards.values():
+            handler.disconnect()
+        raise NameError("Couldn't connect to board: ", errors)
+    return boards
+
+
+def loadRig(filename):
+    config = ConfigParser.SafeConfigParser()
+    # Axis names keep their case
+    config.optionxform = str
+    if len(config.read(filename)) == 0:
+        raise NameError("Couldn't read rig config: ", filename)
+
+    try:
+        settings = {}
+        for section in config.sections():
+            if not section.startswith(boardPrefix):
+                continue
+            arguments = {"port": config.get(section, "port"), "baud": 9600}
+            if config.has_option(section, "baud"):
+                arguments["baud"] = config.getint(section, "baud")
+            if config.has_option(section, "binary"):
+                arguments["binary"] = config.getboolean(section, "binary")
+            if config.has_option(section, "rates"):
+                arguments["rates"] = [int(rate) for rate in config.get(section, "rates").split()]
+            if config.has_option(section, "transcript"):
+                arguments["transcript"] = config.get(section, "transcript")
+            settings[section[len(boardPrefix):].strip()] = arguments
+
+        axes = []
+        for name, value in config.items("axes"):
+            board, axis = value.split()
+            if board not in settings:
+                raise NameError("No such board: ", name, board)
+            axes.append((name, board, int(axis)))
+    except (ConfigParser.Error, ValueError), e:
+        raise NameError("Bad rig config: ", filename, str(e))
+
+    boards = connectBoards(settings)
+    try:
+        return Rig(boards, axes)
+    except NameError:
+        for handler in boards.values():
+            handler.disconnect()
+        raise
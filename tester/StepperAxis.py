@@ -1,118 +1,944 @@
 
+import os
 import time
+import fcntl
+import logging
+import select
 import serial
+import threading
 import Queue
+from collections import deque
+
+from BinaryProtocol import FrameDecoder, encodeCommand
+import Trace
+import Transcript
+
+# Everything sent and received is logged at DEBUG. Nothing is shown unless
+# the program sets up logging.
+log = logging.getLogger("StepperAxis")
+log.addHandler(logging.NullHandler())
+
+# Number of stepper axis on each controller (MAX_STEPPERS)
+controllerAxisCount = 4
+
+# Size of the controller's message buffer (CMD_BUF_LEN), in characters
+controllerMessageBufferSize = 64
+
+# Size of the Arduino's serial receive buffer, in characters. Commands that
+# are in flight but not yet answered must all fit in here, since the board
+# can't read while it's busy printing a reply.
+controllerRxBufferSize = 128
+
+# Default number of commands allowed in flight at once
+defaultWindow = 4
+
+# Number of moves the controller can queue up ahead of the running one
+# (QUEUE_LEN)
+controllerQueueLength = 8
+
+# Link speeds to try when connecting, fastest first. The controller boots at
+# 9600, and goes back to the old rate if it doesn't hear an ALIVE at the new
+# one within BAUD_VERIFY_TIME (seconds).
+linkRates = [1000000, 500000, 250000, 115200]
+baudVerifyTime = 1.0
+
+# Number of recent round trip times each SerialHandler keeps
+roundTripSamples = 1000
+
+# Number of position reports (from WATCH) each SerialHandler keeps
+telemetrySamples = 1000
+
+# STEPPER_STATE, as it comes in position reports, and the ones where the axis
+# is going somewhere
+stepperStates = ["READY", "MOVING", "FINISHED_MOVING", "HOMING_A", "HOMING_B",
+                 "FINISHED_HOMING", "USER_STOP", "ERROR"]
+movingStates = set([1, 3, 4])
+
+# Seconds an axis can say it's moving without getting anywhere before
+# stalledAxes() gives up on it
+defaultStallTime = 2.0
+
+# Axis parameters each SerialHandler keeps a copy of, so reading them doesn't
+# have to ask the controller
+cachedParameters = ["POS", "MAX_VEL", "ACCEL", "STOP_MODE"]
+
+# Seconds a cached parameter is trusted for; after that, the next read asks
+# the controller and checks the cache against the answer
+defaultCacheCheckPeriod = 30.0
+
+class Waiter:
+    """ Wakes up a thread sleeping in select() when a message it might care
+        about arrives. Python 2's Event.wait(timeout) polls, this doesn't. """
+    def __init__(self):
+        self.readFd, self.writeFd = os.pipe()
+        fcntl.fcntl(self.readFd, fcntl.F_SETFL, os.O_NONBLOCK)
+        fcntl.fcntl(self.writeFd, fcntl.F_SETFL, os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.readFd
+
+    def notify(self):
+        try:
+            os.write(self.writeFd, "x")
+        except OSError:
+            # The pipe is full, so there's already a wakeup pending
+            pass
+
+    def wait(self, timeout = None):
+        """ Sleep until notify() is called, or timeout seconds pass """
+        readable, _, _ = select.select([self], [], [], timeout)
+        self.clear()
+        return len(readable) > 0
+
+    def clear(self):
+        try:
+            while os.read(self.readFd, 4096):
+                pass
+        except OSError:
+            pass
+
+    def close(self):
+        os.close(self.readFd)
+        os.close(self.writeFd)
+
+
+class PendingCommand:
+    """ A command that has been sent, and maybe answered """
+    def __init__(self, handler, command):
+        self.handler = handler
+        self.command = command
+        self.response = None
+
+        # When it went out, and how long the response took
+        self.sentTime = None
+        self.roundTrip = None
+
+        # Ties the send and the response together in a trace
+        self.traceId = 0
+
+        # For a GET or SET of a cached parameter, its AxisState version when
+        # this went out
+        self.cacheVersion = None
+
+        # For anything that moves axes, where it sends each one (None where
+        # we can't tell), to go in the handler's targets once it's ACKed
+        self.targets = None
+
+    def done(self):
+        return self.response != None
+
+    def result(self, timeout = None):
+        """ Wait for the immediate response (ACK, ERROR) to this command """
+        if (timeout == None):
+            timeout = self.handler.timeout
+        if (not self.handler.waitUntil(self.done, timeout)):
+            # Timed out. TODO: throw exception
+            raise NameError("timed out waiting for response from Arduino!")
+        return self.response
+
+
+class PositionReport:
+    """ Where every axis on a controller was, and what it was doing, from a
+        NOTICE POS """
+    def __init__(self, message, receivedTime):
+        words = message.split()
+        # millis() on the controller when it was taken
+        self.time = int(words[2])
+        self.positions = [int(word) for word in words[3:-1]]
+        self.states = [int(state) for state in words[-1]]
+        if len(self.positions) != len(self.states):
+            raise ValueError("Position report doesn't add up: " + message)
+        self.receivedTime = receivedTime
+
+    def position(self, axis):
+        return self.positions[axis - 1]
+
+    def state(self, axis):
+        return self.states[axis - 1]
+
+    def moving(self, axis):
+        return self.states[axis - 1] in movingStates
+
+
+class AxisState:
+    """ What a SerialHandler last heard about one axis's parameters """
+    def __init__(self):
+        # parameter -> (value, time.time() when it was heard)
+        self.values = {}
+
+        # Bumped each time a parameter is forgotten, so the answer to a GET
+        # that was overtaken by a GO or SET isn't taken as the new value
+        self.versions = {}
+
+        # Where the axis will be when it reports DONE, if we know
+        self.arrival = None
+
+    def version(self, name):
+        return self.versions.get(name, 0)
+
+    def forget(self, name):
+        self.values.pop(name, None)
+        self.versions[name] = self.version(name) + 1
+
+    def learn(self, name, value, version = None):
+        """ Returns False if value was out of date """
+        if (version != None and version != self.version(name)):
+            return False
+        self.values[name] = (value, time.time())
+        return True
+
 
 class SerialHandler:
-    def __init__(self, port = "", baud = "", timeout = 10):
+    def __init__(self, port = "", baud = "", timeout = 10, binary = False, rates = linkRates,
+                 transcript = None):
         self.clientMap = {}
         # mapping from clients to axis
         # Queue of return messages (DONE, etc) to send to clients
-        if (port <> ""):
-            self.connect(port, baud)
-
         self.timeout = 15
-        self.messageBuffer = ""
-        self.messages = []
 
-    def connect(self, port, baud=9600):
+        # Splits what the controller sends into messages, whether it's
+        # talking text or binary frames
+        self.decoder = FrameDecoder(maxPayload = controllerMessageBufferSize - 3)
+
+        # True once the controller has agreed to take binary frames
+        self.binary = False
+        self.useBinary = False
+
+        # Commands waiting for an immediate response (ACK, ERROR), oldest
+        # first. The controller answers in order, so replies match up FIFO.
+        self.inFlight = deque()
+        self.inFlightBytes = 0
+        self.window = defaultWindow
+        self.resyncing = False
+        # Delayed responses that aren't for a specific axis
+        self.messages = Queue.Queue()
+
+        # Axis that have been sent a motion and haven't reported DONE yet,
+        # and the time each axis last reported DONE
+        self.pendingAxes = set()
+        self.doneTimes = {}
+
+        # Axis started together by GOALL, which all finish with one DONE ALL
+        self.groupAxes = set()
+
+        # Free slots in the controller's move queue, as of the last ACK QUEUE
+        # or NOTICE QUEUE, and the axis that are running queued moves
+        self.queueFree = controllerQueueLength
+        self.queueAxes = set()
+
+        # Queued moves the controller threw away because none of the axis
+        # would start them (all at their limit switches, say)
+        self.queueRefusals = 0
+
+        # Last position each axis was told to go to, as of the ACK. With
+        # elideMoves set, a move to where an axis was already sent isn't sent
+        # at all. Anything that might leave an axis somewhere else takes its
+        # target away.
+        self.targets = {}
+        self.elideMoves = True
+
+        # Commands sent so far, and how long the latest ones took to be
+        # answered, in seconds
+        self.commandsSent = 0
+        self.roundTrips = deque(maxlen=roundTripSamples)
+
+        # Messages received so far, not counting position reports
+        self.messagesReceived = 0
+
+        # An AxisState for each axis, kept up to date from ACKs, DONEs and
+        # position reports, and forgotten by whatever changes it. Reads older
+        # than cacheCheckPeriod seconds go to the controller (None to trust
+        # the cache forever, 0 to always ask).
+        self.axisStates = {}
+        self.cacheCheckPeriod = defaultCacheCheckPeriod
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        self.cacheMismatches = 0
+
+        # Seconds between checks of the cache on a thread of its own (see
+        # checkCacheEvery), 0 for none
+        self.cacheCheckInterval = 0
+        self.cacheChecker = None
+        self.cacheCheckWake = threading.Event()
+
+        # If set, a TranscriptWriter that gets a copy of every byte sent and
+        # received. It's closed on disconnect.
+        self.transcript = transcript
+
+        # Position reports, newest last, and everyone who wants to hear about
+        # them as they come in. Reports are only sent after a WATCH.
+        self.telemetry = deque(maxlen=telemetrySamples)
+        self.telemetryCallbacks = []
+        self.watchPeriod = 0
+
+        # Everyone who wants to hear about new messages
+        self.lock = threading.Lock()
+        self.waiters = set()
+        self.threadWaiters = threading.local()
+        self.commandLock = threading.Lock()
+
+        self.reader = None
+        self.running = False
+
+        if (port <> ""):
+            self.connect(port, baud, binary, rates)
+
+    def connect(self, port, baud=9600, binary=False, rates=linkRates):
+        """ Open the port at baud, then move up to the fastest of rates that
+            the link will carry (pass [] to stay at baud) """
         self.ser = serial.Serial(port, baud)
+        self.startReader()
+        if (len(rates) > 0):
+            self.negotiateBaud(rates)
+        if (binary):
+            self.enableBinary()
+
+    def negotiateBaud(self, rates):
+        """ Try each rate, fastest first, until one works. Returns the rate
+            the link ended up at. """
+        for rate in sorted(rates, reverse=True):
+            if (rate <= self.ser.baudrate):
+                break
+            if (self.changeBaud(rate)):
+                break
+        return self.ser.baudrate
+
+    def changeBaud(self, rate):
+        """ Switch the link to rate, checking it with an ALIVE. If that
+            doesn't get through, wait for the controller to go back to the
+            old rate and go back with it. Returns True if it worked. """
+        oldRate = self.ser.baudrate
+        message = self.sendCommand("BAUD " + str(rate) + "\n")
+        if (message != "ACK BAUD " + str(rate)):
+            return False
+
+        # Give the controller time to finish the ACK and switch over
+        self.ser.flush()
+        time.sleep(0.01)
+        self.ser.baudrate = rate
+
+        if (self.flushSerial(baudVerifyTime / 2) == ""):
+            return True
+
+        self.ser.baudrate = oldRate
+        time.sleep(baudVerifyTime)
+        if (self.flushSerial() != ""):
+            raise NameError("Lost the controller changing baud rate!")
+        return False
+
+    def enableBinary(self):
+        """ Ask the controller to switch to binary frames. Older firmware
+            doesn't know how, in which case we stay with text. Call it while
+            nothing else is being sent. Returns True if it worked. """
+        self.useBinary = True
+        message = self.sendCommand("BINARY\n")
+        self.binary = (message == "ACK BINARY")
+        return self.binary
     def disconnect(self):
+        self.stopCacheChecker()
+        self.stopReader()
         self.ser.close()
+        if (self.transcript != None):
+            self.transcript.close()
+
+    def write(self, data):
+        if (self.transcript != None):
+            self.transcript.record(Transcript.SENT, data)
+        self.ser.write(data)
+
+    def startReader(self):
+        """ Start the thread that owns the read side of the serial port """
+        self.running = True
+        self.reader = threading.Thread(target=self.readLoop)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def stopReader(self):
+        self.running = False
+        if (self.reader != None):
+            self.reader.join()
+            self.reader = None
+
     def sendCommand(self, command):
-        self.ser.write(command)
-        print(command)
-        
-        message = self.getImmediateResponse()
+        message = self.sendCommandAsync(command).result()
         return message
 
-    def getImmediateResponse(self):
-        """ Wait for an immediate response (ACK, ERROR) from the serial port.
-            If we find a delayed response along the way (NOTICE), save it for
-            later. """
-        
-        # Calculate when we should time out
-        timeoutTime = time.time() + self.timeout
-        gotImmediate = False
-
-        # While there is still time, and we haven't received an immediate
-        # response
-        while ( time.time() < timeoutTime ):
-            message = self.checkForResponse()
-            if (message != ""):
-                return message
-                        
-        # Timed out. TODO: throw exception
-        raise NameError("timed out waiting for response from Arduino!")
-
-    def checkForResponse(self):
-        # Read new characters in one at a time, and if we get an \n,
-        # check if we understand the message
-        message = ""
-
-        while (self.ser.inWaiting() > 0):
-            self.messageBuffer += self.ser.read(1)
-
-            if (self.messageBuffer.endswith("\n")):
-                message = self.messageBuffer.split('\n',1)[0]
-                self.messageBuffer = ""
-
-                print "Got: >>", message, "<<"
-
-                if (message.startswith("ACK ") or message.startswith("ERROR ")):
-                    print "Got immediate response, returning."
-                    return message
-                elif (message.startswith("NOTICE ")):
-                    print "Binning message."
-                    self.messages.append(message)
-                    print self.messages
+    def sendCommands(self, commands):
+        """ Send a list of commands, keeping up to self.window of them in
+            flight, and return the list of responses """
+        pending = [self.sendCommandAsync(command) for command in commands]
+        return [command.result() for command in pending]
+
+    def sendCommandAsync(self, command):
+        """ Send a command without waiting for the response. Blocks while the
+            window is full. Returns a PendingCommand. """
+        if (len(command) > controllerMessageBufferSize):
+            raise NameError("Command too long for the controller: ", command)
+
+        pending = PendingCommand(self, command)
+
+        # Only one sender at a time, so commands go out in the order they are
+        # queued for replies
+        with self.commandLock:
+            if (not self.waitUntil(lambda: self.windowHasRoom(command), self.timeout)):
+                raise NameError("timed out waiting for response from Arduino!")
+
+            data = command
+            if (self.binary):
+                data = encodeCommand(command)
+
+            with self.lock:
+                self.inFlight.append(pending)
+                self.inFlightBytes += len(command)
+                self.commandsSent += 1
+                self.forgetChanged(pending)
+            recorder = Trace.recorder
+            if (recorder != None):
+                pending.traceId = recorder.newId()
+                recorder.begin(Trace.CAT_COMMAND, command.split()[0], pending.traceId)
+            pending.sentTime = time.time()
+            self.write(data)
+            log.debug("sent: %s", command.rstrip())
+
+        return pending
+
+    def setWindow(self, window):
+        """ Number of commands allowed in flight at once (1 to disable
+            pipelining) """
+        self.window = max(1, window)
+
+    def windowHasRoom(self, command):
+        if (len(self.inFlight) == 0):
+            return True
+        return (len(self.inFlight) < self.window and
+                self.inFlightBytes + len(command) <= controllerRxBufferSize)
+
+    def getWaiter(self):
+        """ The calling thread's Waiter, so that threads don't steal each
+            other's wakeups """
+        waiter = getattr(self.threadWaiters, "waiter", None)
+        if (waiter == None):
+            waiter = Waiter()
+            self.threadWaiters.waiter = waiter
+            self.addWaiter(waiter)
+        return waiter
+
+    def waitUntil(self, condition, timeout):
+        """ Sleep until condition() is true, re-checking it whenever a message
+            arrives. Returns False on timeout. """
+        waiter = self.getWaiter()
+        timeoutTime = time.time() + timeout
+        while (not condition()):
+            remaining = timeoutTime - time.time()
+            if (remaining <= 0):
+                return False
+            waiter.wait(remaining)
+        return True
+
+    def readLoop(self):
+        while (self.running):
+            for message in self.readLines(0.1):
+                self.routeMessage(message)
+
+    def readLines(self, timeout = 0):
+        """ Read everything the serial port has for us, waiting up to timeout
+            seconds for the first byte, and return the complete lines. """
+        if (self.ser.inWaiting() == 0):
+            readable, _, _ = select.select([self.ser], [], [], timeout)
+            if not readable:
+                return []
+
+        data = self.ser.read(max(1, self.ser.inWaiting()))
+        if (self.transcript != None):
+            self.transcript.record(Transcript.RECEIVED, data)
+        return [message for message, size, framed in self.decoder.feed(data)]
+
+    def routeMessage(self, message):
+        """ Hand a message from the controller to whoever is waiting for it """
+        if (message.startswith("NOTICE POS ")):
+            # Too many of these to print
+            self.routeReport(message)
+            return
+
+        log.debug("got: %s", message)
+        self.messagesReceived += 1
+
+        if (message.startswith("NOTICE DONE ") and Trace.recorder != None):
+            Trace.recorder.instant(Trace.CAT_MOTION, message[len("NOTICE "):])
+
+        if (message.startswith("ACK QUEUE ") or message.startswith("NOTICE QUEUE ")):
+            # Both carry the free count at the time they were sent, so the
+            # newest one is right
+            try:
+                self.queueFree = int(message.split()[-1])
+            except ValueError:
+                log.warning("message not understood: %s", message)
+
+        if (message.startswith("ACK ") or message.startswith("ERROR ")):
+            with self.lock:
+                if (self.resyncing):
+                    # Drop everything up to the ALIVE from flushSerial()
+                    self.resyncing = (message != "ACK ALIVE")
+                elif (len(self.inFlight) > 0):
+                    pending = self.inFlight.popleft()
+                    self.inFlightBytes -= len(pending.command)
+                    pending.roundTrip = time.time() - pending.sentTime
+                    self.roundTrips.append(pending.roundTrip)
+                    self.learnAnswer(pending, message)
+                    pending.response = message
+                    recorder = Trace.recorder
+                    if (recorder != None and pending.traceId != 0):
+                        recorder.end(Trace.CAT_COMMAND, pending.command.split()[0], pending.traceId)
                 else:
-                    print "TODO: Message not understood, error?"
+                    log.warning("got a response when none was expected: %s", message)
+        elif (message.startswith("NOTICE DONE ALL")):
+            with self.lock:
+                for axis in self.groupAxes:
+                    self.pendingAxes.discard(axis)
+                    self.doneTimes[axis] = time.time()
+                    self.arrived(axis)
+                self.groupAxes = set()
+        elif (message.startswith("NOTICE DONE QUEUE")):
+            with self.lock:
+                # A QUEUE the controller hasn't answered yet was read after
+                # this went out, so that move is still to come
+                if (self.queueCommandsInFlight() == 0):
+                    for axis in self.queueAxes:
+                        self.pendingAxes.discard(axis)
+                        self.doneTimes[axis] = time.time()
+                        self.arrived(axis)
+                    self.queueAxes = set()
+        elif (message.startswith("NOTICE QUEUE REFUSED")):
+            log.warning("controller refused a queued move")
+            with self.lock:
+                self.queueRefusals += 1
+                # Whatever was queued after it still runs, but if it was the
+                # last one the axis won't get where they were sent
+                for axis in self.queueAxes:
+                    self.axisState(axis).arrival = None
+                    self.targets.pop(axis, None)
+        elif (message.startswith("NOTICE QUEUE ")):
+            pass
+        elif (message.startswith("NOTICE DONE ") or message.startswith("DONE ")):
+            try:
+                axis = int(message.split()[-1])
+            except ValueError:
+                log.warning("message not understood: %s", message)
+                return
+            with self.lock:
+                self.pendingAxes.discard(axis)
+                self.doneTimes[axis] = time.time()
+                self.arrived(axis)
+        elif (message.startswith("NOTICE ")):
+            self.messages.put(message)
+        else:
+            log.warning("message not understood: %s", message)
 
-        return ""
+        # Everyone waiting on something gets to check, even if this message
+        # wasn't it, since messagesReceived has gone up
+        self.notifyWaiters()
 
-    def pollSerial(self):
-        message = self.checkForResponse()
-        if (message <> ""):
-            raise NameError("Got immediate message when it wasn't expected: ", message)
-   
-    def getDelayedResponse(self, axis):
-        """ Get any messages that are waiting for this axis """
-        self.pollSerial()
-
-        for i in range(len(self.messages)):
-            if (int(self.messages[i].split()[2]) == axis):
-                message = self.messages[i]
-                print "Found message: ", message
-                self.messages.pop(i)
-                return message
-
-        # TODO: Throw?
-        return ""
+    def routeReport(self, message):
+        try:
+            report = PositionReport(message, time.time())
+        except (ValueError, IndexError):
+            log.warning("message not understood: %s", message)
+            return
+        self.telemetry.append(report)
+
+        # Axis that are standing still are where the report says
+        with self.lock:
+            for axis in range(1, len(report.positions) + 1):
+                if (not report.moving(axis) and axis not in self.pendingAxes):
+                    self.heardPosition(axis, report.position(axis))
 
+        for callback in list(self.telemetryCallbacks):
+            callback(report)
 
+    def watch(self, period, callback = None):
+        """ Have the controller report where every axis is, and what it's
+            doing, every period ms (0 to stop). Reports go into
+            self.telemetry, and to callback(report) on the reader thread.
+            Returns the period the controller agreed to. """
+        if (callback != None and callback not in self.telemetryCallbacks):
+            self.telemetryCallbacks.append(callback)
 
-    def flushSerial(self):
+        message = self.sendCommand("WATCH " + str(period) + "\n")
+        if (not message.startswith("ACK WATCH ")):
+            raise NameError("Controller won't WATCH: ", message)
+        self.watchPeriod = int(message.split()[-1])
+        return self.watchPeriod
+
+    def latestReport(self):
+        """ Newest position report, or None if there hasn't been one """
+        try:
+            return self.telemetry[-1]
+        except IndexError:
+            return None
+
+    def stalledAxes(self, stallTime = defaultStallTime):
+        """ Axis that have been moving for stallTime seconds without their
+            position changing, going by the position reports. If the reports
+            have stopped for that long, every axis that hasn't reported DONE
+            counts. The controller can't tell if a motor misses steps, but
+            this catches moves that stop getting anywhere. """
+        latest = self.latestReport()
+        if (self.watchPeriod == 0 or latest == None):
+            return set()
+
+        if (time.time() - latest.receivedTime > stallTime):
+            with self.lock:
+                return set(self.pendingAxes)
+
+        stalled = set()
+        for axis in range(1, len(latest.positions) + 1):
+            if (not latest.moving(axis)):
+                continue
+            # Go back through the reports until the axis was somewhere else
+            since = latest.time
+            for report in reversed(list(self.telemetry)):
+                if (not report.moving(axis) or report.position(axis) != latest.position(axis)):
+                    break
+                since = report.time
+            if (latest.time - since >= stallTime * 1000):
+                stalled.add(axis)
+        return stalled
+
+    def addWaiter(self, waiter):
+        with self.lock:
+            self.waiters.add(waiter)
+
+    def removeWaiter(self, waiter):
+        with self.lock:
+            self.waiters.discard(waiter)
+
+    def notifyWaiters(self):
+        with self.lock:
+            waiters = list(self.waiters)
+        for waiter in waiters:
+            waiter.notify()
+
+    def expectDone(self, axis):
+        """ Call before starting a motion on axis, so that a NOTICE DONE left
+            over from an earlier move doesn't look like this one finishing """
+        with self.lock:
+            self.pendingAxes.add(axis)
+
+    def goAll(self, positions, moveTime = 0):
+        """ Start every axis on the controller towards its position at once.
+            They report back with a single NOTICE DONE ALL. """
+        return self.startGroup("GOALL", positions, moveTime)
+
+    def moveLine(self, positions, moveTime = 0):
+        """ Like goAll, but every axis takes as long as the slowest one, so
+            they move in a straight line and arrive together. """
+        return self.startGroup("LINE", positions, moveTime)
+
+    def startGroup(self, name, positions, moveTime):
+        return self.finishGroup(self.startGroupAsync(name, positions, moveTime))
+
+    def startGroupAsync(self, name, positions, moveTime):
+        """ Send a GOALL or LINE without waiting for the response. Hand the
+            PendingCommand to finishGroup() once it's answered. """
+        if (len(positions) != controllerAxisCount):
+            raise NameError(name + " needs a position for every axis: ", positions)
+
+        axes = range(1, controllerAxisCount + 1)
+        with self.lock:
+            self.pendingAxes.update(axes)
+            self.groupAxes = set(axes)
+
+        command = name + " " + " ".join([str(p) for p in positions]) + " " + str(moveTime) + "\n"
+        return self.sendCommandAsync(command)
+
+    def finishGroup(self, pending):
+        message = pending.result()
+        axes = range(1, controllerAxisCount + 1)
+
+        if (not message.startswith("ACK ")):
+            # TODO: Some of the axis might have started anyway
+            with self.lock:
+                self.pendingAxes.difference_update(axes)
+                self.groupAxes = set()
+        return message
+
+    def queueMove(self, positions, moveTime = 0):
+        """ Add a LINE move to the back of the controller's move queue,
+            without waiting for the response. The controller runs queued moves
+            back to back and reports NOTICE DONE QUEUE once it runs dry.
+            Returns a PendingCommand. """
+        if (len(positions) != controllerAxisCount):
+            raise NameError("QUEUE needs a position for every axis: ", positions)
+
+        axes = range(1, controllerAxisCount + 1)
+        with self.lock:
+            self.pendingAxes.update(axes)
+            self.queueAxes = set(axes)
+
+        command = "QUEUE " + " ".join([str(p) for p in positions]) + " " + str(moveTime) + "\n"
+        return self.sendCommandAsync(command)
+
+    def queueHasRoom(self):
+        """ True if another QUEUE would fit, counting the ones that haven't
+            been answered yet """
+        with self.lock:
+            return self.queueFree - self.queueCommandsInFlight() > 0
+
+    def queueCommandsInFlight(self):
+        return len([p for p in self.inFlight if p.command.startswith("QUEUE ")])
+
+    def flushQueue(self):
+        """ Throw away the queued moves that haven't started yet """
+        return self.sendCommand("FLUSH\n")
+
+    def getTarget(self, axis):
+        """ Where the axis was last sent, or failing that where it was last
+            heard to be. The controller is only asked if neither is known. """
+        with self.lock:
+            if (axis in self.targets):
+                return self.targets[axis]
+            cached = self.axisState(axis).values.get("POS")
+            if (cached != None and axis not in self.pendingAxes):
+                return cached[0]
+        return self.readParameter("POS", axis)
+
+    def axisState(self, axis):
+        state = self.axisStates.get(axis)
+        if (state == None):
+            state = self.axisStates[axis] = AxisState()
+        return state
+
+    def forgetChanged(self, pending):
+        """ Forget the cached parameters and targets that a command is about
+            to change. Call with self.lock held. Sets the command's
+            cacheVersion for a GET or SET of a cached parameter, and its
+            targets if it moves anything. """
+        words = pending.command.split()
+        axes = range(1, controllerAxisCount + 1)
+        try:
+            if (words[0] == "GO"):
+                pending.targets = {int(words[1]): int(words[2])}
+            elif (words[0] in ("GOALL", "LINE", "QUEUE")):
+                pending.targets = dict([(axis, int(words[axis])) for axis in axes])
+            elif (words[0] == "HOME"):
+                # A HOME that doesn't find the limit switch reports DONE all
+                # the same, so where it ends up is left for a read to find out
+                pending.targets = {int(words[1]): None}
+            elif (words[0] == "SET" and words[1] == "POS"):
+                pending.targets = {int(words[2]): None}
+            elif (words[0] in ("STOP", "FLUSH")):
+                # They stop wherever they happen to be, or at the end of the
+                # queued move that's running
+                pending.targets = dict([(axis, None) for axis in axes])
+
+            if (pending.targets != None):
+                for axis, position in pending.targets.items():
+                    state = self.axisState(axis)
+                    # An axis sent to where it's known to be isn't going
+                    # anywhere, so its position stays good
+                    held = state.values.get("POS")
+                    if (position == None or held == None or held[0] != position):
+                        state.forget("POS")
+                    state.arrival = position
+                    self.targets.pop(axis, None)
+
+            if (words[0] in ("GET", "SET") and words[1] in cachedParameters):
+                state = self.axisState(int(words[2]))
+                if (words[0] == "SET"):
+                    state.forget(words[1])
+                pending.cacheVersion = state.version(words[1])
+        except (IndexError, ValueError):
+            log.warning("command not understood by the cache: %s", pending.command.rstrip())
+
+    def learnAnswer(self, pending, message):
+        """ Save the targets of a move that was ACKed, and cache the value a
+            GET or SET of a cached parameter was answered with. Call with
+            self.lock held. """
+        words = message.split()
+        if (pending.targets != None):
+            for axis, position in pending.targets.items():
+                if (words[0] == "ACK" and position != None):
+                    self.targets[axis] = position
+                else:
+                    # Anything ACKed since this went out might have put a
+                    # target back
+                    self.targets.pop(axis, None)
+            if (words[0] != "ACK" and pending.command.split()[0] in ("GO", "HOME")):
+                # It never started, so there's no DONE coming
+                self.pendingAxes.difference_update(pending.targets.keys())
+
+        if (pending.cacheVersion == None or len(words) != 5 or
+            words[0] != "ACK" or words[2] not in cachedParameters):
+            return
+        try:
+            axis = int(words[3])
+            value = int(words[4])
+        except ValueError:
+            return
+        if (words[2] != "POS"):
+            self.axisState(axis).learn(words[2], value, pending.cacheVersion)
+        elif (axis not in self.pendingAxes):
+            # The position of a moving axis is out of date as soon as it's read
+            self.heardPosition(axis, value, pending.cacheVersion)
+
+    def heardPosition(self, axis, position, version = None):
+        """ Cache where an axis that isn't moving is. If that isn't where it
+            was sent (a limit switch stopped it short, say), moves can't be
+            skipped by its target any more; if it is, the target that DONE
+            left unconfirmed is put back. Call with self.lock held. """
+        state = self.axisState(axis)
+        if (not state.learn("POS", position, version)):
+            return
+        if (self.targets.get(axis, position) != position):
+            log.info("axis %d stopped at %d instead of %d", axis, position, self.targets[axis])
+            del self.targets[axis]
+        elif (state.arrival == position):
+            self.targets[axis] = position
+
+    def arrived(self, axis):
+        """ The axis reported DONE. A limit switch might have stopped it
+            short of where it was sent, and DONE doesn't say, so unless it
+            was already there its position is left for the next read, and
+            its target isn't used until that read confirms it. Call with
+            self.lock held. """
+        if ("POS" not in self.axisState(axis).values):
+            self.targets.pop(axis, None)
+
+    def readParameter(self, name, axis, check = False):
+        """ One of an axis's cachedParameters, from the cache if it was heard
+            in the last cacheCheckPeriod seconds, otherwise from the
+            controller. With check, always ask the controller. A cached value
+            that turns out to be wrong is logged. """
+        with self.lock:
+            cached = self.axisState(axis).values.get(name)
+            if (name == "POS" and axis in self.pendingAxes):
+                cached = None
+
+            if (cached != None and not check and
+                (self.cacheCheckPeriod == None or
+                 time.time() - cached[1] < self.cacheCheckPeriod)):
+                self.cacheHits += 1
+                return cached[0]
+            self.cacheMisses += 1
+
+        message = self.sendCommand("GET " + name + " " + str(axis) + "\n")
+        if (not message.startswith("ACK GET " + name + " " + str(axis) + " ")):
+            raise NameError("Couldn't read " + name + ": ", message)
+        value = int(message.split()[-1])
+
+        if (cached != None and cached[0] != value):
+            with self.lock:
+                self.cacheMismatches += 1
+            log.warning("axis %d %s was cached as %d, but the controller says %d",
+                        axis, name, cached[0], value)
+        return value
+
+    def writeParameter(self, name, axis, value):
+        """ Set one of an axis's cachedParameters. The cache picks the new
+            value up from the ACK. """
+        message = self.sendCommand("SET " + name + " " + str(axis) + " " + str(value) + "\n")
+        if (not message.startswith("ACK SET ")):
+            raise NameError("Couldn't set " + name + ": ", message)
+        return message
+
+    def checkCache(self, olderThan = 0):
+        """ Read the cached parameters that haven't been heard from the
+            controller in olderThan seconds back from it, and return the
+            number that were wrong. Positions of moving axis are skipped. """
+        heardBefore = time.time() - olderThan
+        with self.lock:
+            cached = [(name, axis) for axis, state in self.axisStates.items()
+                      for name, (value, heardTime) in state.values.items()
+                      if heardTime <= heardBefore and
+                      not (name == "POS" and axis in self.pendingAxes)]
+            mismatches = self.cacheMismatches
+        for name, axis in sorted(cached):
+            self.readParameter(name, axis, check=True)
+        return self.cacheMismatches - mismatches
+
+    def checkCacheEvery(self, interval):
+        """ Check the cache against the controller every interval seconds on
+            a thread of its own, reading back whatever hasn't been heard from
+            the controller in that time. 0 stops the checks. """
+        self.cacheCheckInterval = interval
+        if (self.cacheChecker == None):
+            self.cacheChecker = threading.Thread(target=self.cacheCheckLoop)
+            self.cacheChecker.daemon = True
+            self.cacheChecker.start()
+        else:
+            # Start waiting again, with the new interval
+            self.cacheCheckWake.set()
+
+    def stopCacheChecker(self):
+        if (self.cacheChecker != None):
+            self.cacheCheckInterval = -1
+            self.cacheCheckWake.set()
+            self.cacheChecker.join()
+            self.cacheChecker = None
+
+    def cacheCheckLoop(self):
+        while (self.cacheCheckInterval >= 0):
+            interval = self.cacheCheckInterval
+            self.cacheCheckWake.wait(interval if interval > 0 else None)
+            if (self.cacheCheckWake.is_set()):
+                self.cacheCheckWake.clear()
+                continue
+            try:
+                self.checkCache(interval)
+            except NameError, e:
+                log.warning("cache check failed: %s", e)
+
+    def isTarget(self, axis, position):
+        """ True if a move of axis to position can be skipped, since that's
+            where it was last sent """
+        return self.elideMoves and self.targets.get(axis) == position
+
+    def isDone(self, axis):
+        return axis not in self.pendingAxes
+
+    def getDoneTime(self, axis):
+        """ When the axis last reported DONE, from time.time() """
+        return self.doneTimes.get(axis)
+
+    def waitForDone(self, axis, timeout = None):
+        """ Block until the axis reports DONE. Returns False on timeout. """
+        if (timeout == None):
+            timeout = 1e9
+        return self.waitUntil(lambda: self.isDone(axis), timeout)
+
+    def flushSerial(self, timeout = 10):
         """ Bring the stepper motor controller serial interface to a known state """
 
-        # First, write a newline to flush out anything that was in stepper's
-        # receive buffer
-        self.ser.write("\n")
+        # Anything still waiting for a reply isn't going to get one
+        with self.lock:
+            for pending in self.inFlight:
+                pending.response = "ERROR flushed"
+            self.inFlight.clear()
+            self.inFlightBytes = 0
+            self.resyncing = True
+
+        with self.commandLock:
+            # First, write a newline to flush out anything that was in stepper's
+            # receive buffer. In binary mode that might be a partial frame,
+            # which could need a whole buffer's worth of bytes to finish off
+            # (the controller ignores blank lines).
+            if (self.binary):
+                self.write("\n" * controllerMessageBufferSize)
+            else:
+                self.write("\n")
 
-        # Then, send an ALIVE message to be sure we are talking to something
-        self.ser.write("ALIVE\n")
+            # Then, send an ALIVE message to be sure we are talking to something.
+            # Being text, it also puts the controller back in text mode.
+            self.binary = False
+            self.write("ALIVE\n")
 
-        # Keep reading data until we get a newline, or time out after 10 seconds
-        timeoutTime = time.time() + 10
-        gotAckAlive = False
-        message = ""
-        while ( time.time() < timeoutTime and gotAckAlive == False ):
-            message += self.ser.read()
-            if ( message.endswith("ACK ALIVE\n") ):
-                gotAckAlive = True
+        # Throw away responses until we see the ACK, or time out
+        if (not self.waitUntil(lambda: not self.resyncing, timeout)):
+            return "ERROR timeout waiting for response from stepper"
 
-                if ( gotAckAlive == False ):
-                    return "ERROR timeout waiting for response from stepper"
+        if (self.useBinary):
+            self.enableBinary()
+        return ""
 
 
 class stepperAxis:
@@ -128,15 +954,35 @@ class stepperAxis:
 
     def update(self):
         # TODO: Drop this function???
+        self.finishUpdate(self.startUpdate())
+
+    def startUpdate(self, moveTime = 0):
+        """ Send the GO for update() without waiting for the response, taking
+            moveTime ms (0 for as fast as it goes). Returns the
+            PendingCommand for finishUpdate(), or None if there was nothing
+            to send. """
         if (self.busy()):
             raise NameError("Stepper busy!")
 
+        # Already there (or on the way); the controller would just send DONE
+        if (self.handler.isTarget(self.axis, self.requestedPosition)):
+            return None
+
         self.isBusy = True
+        self.handler.expectDone(self.axis)
 
-#        if ( self.lastPosition != self.currentPosition ):
-        command = "GO " + str(self.axis) + " " + str(self.requestedPosition) + " 0\n"
-        # TODO: handle failures here
-        self.handler.sendCommand(command)
+        command = "GO " + str(self.axis) + " " + str(self.requestedPosition) + " " + str(moveTime) + "\n"
+        return self.handler.sendCommandAsync(command)
+
+    def finishUpdate(self, pending):
+        if (pending != None):
+            # The handler saves the target, or takes it away on an ERROR
+            message = pending.result()
+            if (not message.startswith("ACK ")):
+                log.warning("axis %d couldn't go to %d: %s", self.axis,
+                            self.requestedPosition, message)
+                self.isBusy = False
+                return
         self.lastPosition = self.requestedPosition
 
     def moveRelative(self, counts):
@@ -154,34 +1000,281 @@ class stepperAxis:
         self.update()
 
     def getPosition(self):
-        return self.currentPosition
+        """ Where the axis is, from the cache when it can be """
+        return self.handler.readParameter("POS", self.axis)
 
     def home(self):
         if (self.busy()):
             raise NameError("Stepper busy!")
 
+        self.isBusy = True
+        self.handler.expectDone(self.axis)
+
         command = "HOME " + str(self.axis) + "\n"
         message = self.handler.sendCommand(command)
         # TODO check return values
 
     def readPosition(self):
-        command = "GET POS " + str(self.axis) + "\n"
-        message = self.handler.sendCommand(command)
+        """ Where the axis is, asking the controller """
+        return self.handler.readParameter("POS", self.axis, check=True)
 
-        if ( message[:12] == "ACK GET POS " + str(self.axis) ):
-            self.currentPosition = int(message[13:])
+    def getMaxVelocity(self):
+        return self.handler.readParameter("MAX_VEL", self.axis)
+
+    def setMaxVelocity(self, maxVelocity):
+        self.handler.writeParameter("MAX_VEL", self.axis, maxVelocity)
+
+    def getAcceleration(self):
+        return self.handler.readParameter("ACCEL", self.axis)
+
+    def setAcceleration(self, acceleration):
+        self.handler.writeParameter("ACCEL", self.axis, acceleration)
+
+    def getStopMode(self):
+        return self.handler.readParameter("STOP_MODE", self.axis)
+
+    def setStopMode(self, stopMode):
+        self.handler.writeParameter("STOP_MODE", self.axis, stopMode)
 
     def busy(self):
         if (not self.isBusy):
             return False
         
         # Check if we finished and just don't know
-        message = self.handler.getDelayedResponse(self.axis)
-        
-        if (message == ""):
+        if (not self.handler.isDone(self.axis)):
             return True
 
-        # TODO: Actually check the message
         self.isBusy = False
         return False
 
+    def waitUntilDone(self, timeout = None):
+        """ Block until the current move finishes. Returns False on timeout. """
+        if (self.isBusy and not self.handler.waitForDone(self.axis, timeout)):
+            return False
+
+        self.isBusy = False
+        return True
+
+
+
+def moveAxesAbsolute(axes, positions, coordinated = False, moveTime = 0):
+    """ Move several axis at once. Axis that share a controller are started
+        together with one GOALL, instead of a GO (and a round trip) each. If
+        coordinated, they use LINE so they also finish together. Every
+        controller is sent its command before any of the answers are waited
+        for, so the round trips to each of them overlap. With moveTime (in
+        ms), every axis takes that long, or as long as it has to if it
+        can't go that fast. """
+    moves = {}
+    handlers = []
+    for axis, position in zip(axes, positions):
+        if axis.handler not in moves:
+            moves[axis.handler] = []
+            handlers.append(axis.handler)
+        moves[axis.handler].append((axis, position))
+
+    # Commands sent, waiting for their answers
+    singles = []
+    groups = []
+
+    for handler in handlers:
+        # Leave out the axis that are already headed where they're going
+        moving = [(axis, position) for axis, position in moves[handler]
+                  if not handler.isTarget(axis.axis, position)]
+        if (len(moving) == 0):
+            for axis, position in moves[handler]:
+                axis.moveAbsolute(position)
+            continue
+        if (len(moving) == 1):
+            axis, position = moving[0]
+            if (axis.busy()):
+                raise NameError("Stepper busy!")
+            axis.requestedPosition = position
+            singles.append((axis, axis.startUpdate(moveTime)))
+            continue
+
+        for axis, position in moves[handler]:
+            if (axis.busy()):
+                raise NameError("Stepper busy!")
+
+        # Axis we weren't asked to move stay where they are
+        targets = [None] * controllerAxisCount
+        for axis, position in moves[handler]:
+            targets[axis.axis - 1] = position
+        for axis in range(1, controllerAxisCount + 1):
+            if (targets[axis - 1] == None):
+                targets[axis - 1] = handler.getTarget(axis)
+
+        pending = handler.startGroupAsync(["GOALL", "LINE"][coordinated], targets, moveTime)
+        groups.append((handler, pending))
+
+    for axis, pending in singles:
+        axis.finishUpdate(pending)
+
+    for handler, pending in groups:
+        message = handler.finishGroup(pending)
+        # TODO: handle failures here
+        if (message.startswith("ACK ")):
+            for axis, position in moves[handler]:
+                axis.requestedPosition = position
+                axis.lastPosition = position
+                axis.isBusy = True
+
+
+def streamAxesAbsolute(axes, frames, moveTime = 0, timeout = None):
+    """ Run the axis through frames (each a list of positions, one per axis)
+        without stopping in between. Each frame becomes a QUEUE on every
+        controller involved, and the queues are kept topped up as the
+        controllers report free space, so there's no round trip between
+        moves. Frames can come from any iterable, and are only taken from it
+        as there is room for them, so a script can be streamed straight in.
+        timeout is the longest to wait for room at any one time. Returns once
+        everything is queued; use waitForAxes() to wait for the end of the
+        motion. If a controller refuses a move (none of its axis would
+        start it), the queues are flushed and NameError raised. A frame can have one more value after the positions, the
+        time its move takes in ms, instead of moveTime. """
+    handlers = []
+    for axis in axes:
+        if (axis.busy()):
+            raise NameError("Stepper busy!")
+        if (axis.axis < 1 or axis.axis > controllerAxisCount):
+            raise NameError("Can't queue moves for axis: ", axis.axis)
+        if axis.handler not in handlers:
+            handlers.append(axis.handler)
+    refusals = dict([(handler, handler.queueRefusals) for handler in handlers])
+
+    # Axis we weren't asked to move stay where they are; the rest are
+    # filled in by the first frame
+    targets = {}
+    for handler in handlers:
+        streamed = [axis.axis for axis in axes if axis.handler is handler]
+        targets[handler] = [None if axis in streamed else handler.getTarget(axis)
+                            for axis in range(1, controllerAxisCount + 1)]
+
+    for axis in axes:
+        axis.isBusy = True
+
+    frames = iter(frames)
+    lastFrame = None
+
+    waiter = Waiter()
+    for handler in handlers:
+        handler.addWaiter(waiter)
+    try:
+        timeoutTime = time.time() + (timeout if timeout != None else 1e9)
+        pending = deque()
+        finished = False
+        while (not finished):
+            # Every controller gets every frame, so only take one when they
+            # all have room for it
+            sent = False
+            while (len([h for h in handlers if not h.queueHasRoom()]) == 0):
+                frame = next(frames, None)
+                if (frame == None):
+                    finished = True
+                    break
+                frameTime = moveTime
+                if (len(frame) > len(axes)):
+                    frameTime = frame[len(axes)]
+                for handler in handlers:
+                    changed = False
+                    for axis, position in zip(axes, frame):
+                        if (axis.handler is handler and targets[handler][axis.axis - 1] != position):
+                            targets[handler][axis.axis - 1] = position
+                            changed = True
+                    # A frame that doesn't move anything on this controller
+                    # would just take up a slot in its queue
+                    if (changed or not handler.elideMoves):
+                        pending.append(handler.queueMove(list(targets[handler]), frameTime))
+                lastFrame = frame
+                sent = True
+
+            while (len(pending) > 0 and pending[0].done()):
+                message = pending.popleft().response
+                if (not message.startswith("ACK ")):
+                    raise NameError("Couldn't queue move: ", message)
+
+            # The rest of the frames would carry on from somewhere the axis
+            # never got to, so stop them too
+            refused = [h for h in handlers if h.queueRefusals != refusals[h]]
+            if (len(refused) > 0):
+                for handler in handlers:
+                    handler.flushQueue()
+                raise NameError("controller refused a queued move")
+
+            if (sent):
+                timeoutTime = time.time() + (timeout if timeout != None else 1e9)
+            elif (not finished):
+                remaining = timeoutTime - time.time()
+                if (remaining <= 0):
+                    raise NameError("timed out waiting for room in the move queue!")
+                waiter.wait(remaining)
+
+        for command in pending:
+            message = command.result()
+            if (not message.startswith("ACK ")):
+                raise NameError("Couldn't queue move: ", message)
+    finally:
+        for handler in handlers:
+            handler.removeWaiter(waiter)
+        waiter.close()
+
+    if (lastFrame != None):
+        for axis, position in zip(axes, lastFrame):
+            axis.requestedPosition = position
+            axis.lastPosition = position
+
+
+class MotionWaiter:
+    """ Waits for a group of axis, possibly on different controllers, to
+        finish moving. The waiter has a fileno(), so it can also go into the
+        caller's own select() along with other files. """
+    def __init__(self, axes):
+        self.axes = list(axes)
+        self.handlers = set([axis.handler for axis in self.axes])
+
+        self.waiter = Waiter()
+        for handler in self.handlers:
+            handler.addWaiter(self.waiter)
+
+    def fileno(self):
+        return self.waiter.fileno()
+
+    def finished(self):
+        """ Map of the axis that are done to the time they reported DONE (or
+            None if they weren't moving) """
+        finished = {}
+        for axis in self.axes:
+            if not axis.busy():
+                finished[axis] = axis.handler.getDoneTime(axis.axis)
+        return finished
+
+    def pending(self):
+        return [axis for axis in self.axes if axis.busy()]
+
+    def wait(self, timeout = None):
+        """ Sleep until every axis is done, or timeout seconds pass. Returns
+            True if everything finished. """
+        timeoutTime = time.time() + (timeout if timeout != None else 1e9)
+        while (len(self.pending()) > 0):
+            remaining = timeoutTime - time.time()
+            if (remaining <= 0):
+                return False
+            self.waiter.wait(remaining)
+        return True
+
+    def close(self):
+        for handler in self.handlers:
+            handler.removeWaiter(self.waiter)
+        self.waiter.close()
+
+
+def waitForAxes(axes, timeout = None):
+    """ Block until all of the axis are done moving, with one deadline for the
+        whole group. Returns the finished map from MotionWaiter.finished(). """
+    waiter = MotionWaiter(axes)
+    try:
+        waiter.wait(timeout)
+        return waiter.finished()
+    finally:
+        waiter.close()
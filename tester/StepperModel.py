@@ -0,0 +1,371 @@
+
+# Host-side model of the Stepper class in stepper.pde, for working out how
+# long moves take on the controller without a board attached.
+#
+# Usage:
+# stepper = StepperModel()
+# moveTime = stepper.moveRelative(400, 0)
+# ticks = stepper.run()
+#
+# With acceleration set, this is also the reference for the trapezoidal
+# profile; stepTicks() gives the tick each step should happen on.
+#
+# It also follows the STEPPER_STATE machine, including homing against a limit
+# switch, so ControllerSimulator can run it tick for tick with advance().
+
+import copy
+import math
+
+# Stepper interrupt rate, in Hz (see Stepper::moveRelative)
+tickFrequency = 10000
+
+# Default maximum velocity of each axis, in steps/second
+defaultMaxVelocity = 200
+
+# STEPPER_STATE from stepper.h
+S_READY, S_MOVING, S_FINISHED_MOVING, S_HOMING_A, S_HOMING_B, \
+    S_FINISHED_HOMING, S_USER_STOP, S_ERROR = range(8)
+
+# Distance Stepper::home walks looking for the limit switch
+homeSteps = 11000
+
+
+def planMove(steps, moveTime, maxVelocity, acceleration):
+    """ Mirror of Stepper::planMove. Returns the time a move of steps will
+        take (ms) and the speed it cruises at (steps/s). """
+    # Without acceleration, we just go at a constant speed
+    if acceleration <= 0:
+        if moveTime <= 0 or (float(steps) / moveTime) * 1000 > maxVelocity:
+            moveTime = int(steps * 1000.0 / maxVelocity)
+        return moveTime, int(steps * 1000.0 / max(moveTime, 1))
+
+    # T = S/v + v/a for a trapezoid; find the slowest v that makes it in time
+    a = float(acceleration)
+    v = float(maxVelocity)
+    if moveTime > 0:
+        t = moveTime / 1000.0
+        discriminant = a*a*t*t - 4*a*steps
+        if discriminant >= 0:
+            v = min(v, (a*t - math.sqrt(discriminant)) / 2)
+
+    # Short moves never get up to speed
+    v = min(v, math.sqrt(a * steps))
+    v = max(v, 1.0)
+
+    return int((steps / v + v / a) * 1000), int(v)
+
+
+class StepperModel:
+    def __init__(self, maxVelocity = defaultMaxVelocity, acceleration = 0,
+                 limitPosition = None):
+        self.maxVelocity = maxVelocity
+        self.acceleration = acceleration
+        self.stopMode = 1
+        self.position = 0
+
+        # The limit switch reads LOW at or behind this position (it moves with
+        # the position whenever that is set, since the switch doesn't). Homing is
+        # always backward (settings.homeDirection defaults to H_BACKWARD, and
+        # nothing changes it).
+        self.canHome = True
+        self.limitPosition = limitPosition
+
+        self.state = S_READY
+        self.forceStop = False
+
+        # Steps taken over every move so far, and ticks run in this one
+        self.stepCount = 0
+        self.ticksRun = 0
+        self.endTick = None
+
+        self.stepsLeft = 0
+        self.direction = 1
+        self.deltax = 0
+        self.deltay = 0
+        self.error = 0
+
+        self.ramped = False
+        self.cruiseRate = 0
+        self.rate = 0
+        self.rateRemainder = 0
+        self.phase = 0
+        self.rampSteps = 0
+        self.startRate = 0
+
+    def getMinimumTime(self, newPosition):
+        return planMove(abs(newPosition - self.position), 0,
+                        self.maxVelocity, self.acceleration)[0]
+
+    def moveAbsolute(self, newPosition, moveTime, alignToEnd = False):
+        return self.moveRelative(newPosition - self.position, moveTime, alignToEnd)
+
+    def moveRelative(self, steps, moveTime, alignToEnd = False):
+        """ Set up a move the way Stepper::moveRelative does. Returns the time
+            the move will take, in milliseconds, or None if it won't go. """
+        if self.busy():
+            return None
+
+        if steps == 0:
+            self.stepsLeft = 0
+            self.state = S_FINISHED_MOVING
+            return moveTime
+
+        # Don't drive any further into the limit switch
+        if steps < 0 and self.limitPressed():
+            return None
+
+        moveTime, self.cruiseRate = planMove(abs(steps), moveTime,
+                                             self.maxVelocity, self.acceleration)
+
+        if steps > 0:
+            self.direction = 1
+        else:
+            self.direction = -1
+
+        self.stepsLeft = abs(steps)
+        self.deltax = int(float(tickFrequency) * moveTime / 1000)
+        self.deltay = abs(steps)
+        if alignToEnd:
+            self.error = self.deltax - 1
+        else:
+            self.error = self.deltax / 2
+
+        self.ramped = self.acceleration > 0
+        self.rate = 0
+        self.rateRemainder = 0
+        self.phase = 0
+        self.rampSteps = 0
+        self.startRate = 0
+
+        self.state = S_MOVING
+        self.ticksRun = 0
+        self.endTick = None
+        return moveTime
+
+    def home(self):
+        """ Mirror of Stepper::home """
+        if self.moveRelative(-homeSteps, 0) == None:
+            return False
+        self.state = S_HOMING_A
+        return True
+
+    def stop(self):
+        if not self.busy():
+            return
+        self.forceStop = True
+        self.endTick = None
+
+    def setPosition(self, position):
+        if self.busy():
+            return False
+        self.setCounter(position)
+        return True
+
+    def setCounter(self, position):
+        if self.limitPosition != None:
+            self.limitPosition += position - self.position
+        self.position = position
+
+    def busy(self):
+        return self.state != S_READY
+
+    def moving(self):
+        """ True while the interrupt is still doing something """
+        return self.state in (S_MOVING, S_HOMING_A, S_HOMING_B)
+
+    def checkFinished(self):
+        """ Mirror of Stepper::checkFinished """
+        if self.state in (S_FINISHED_MOVING, S_FINISHED_HOMING, S_USER_STOP):
+            self.state = S_READY
+            return True
+        return False
+
+    def limitPressed(self):
+        return (self.canHome and self.limitPosition != None
+                and self.position <= self.limitPosition)
+
+    def tick(self):
+        """ One pass of Stepper::doInterrupt. Returns True if a step was taken. """
+        if not self.moving():
+            return False
+        self.ticksRun += 1
+
+        if self.forceStop:
+            self.state = S_USER_STOP
+            self.forceStop = False
+            return False
+        elif self.limitPressed():
+            if self.direction < 0:
+                if self.state == S_HOMING_A:
+                    # Walk back out until the switch lets go
+                    self.state = S_HOMING_B
+                    self.direction = 1
+                elif self.state == S_MOVING:
+                    self.state = S_FINISHED_MOVING
+                    return False
+        elif self.state == S_HOMING_B:
+            self.state = S_FINISHED_HOMING
+            self.setCounter(0)
+            return False
+
+        if self.ramped:
+            doStep = self.doRamp()
+        else:
+            self.error -= self.deltay
+            doStep = self.error < 0
+            if doStep:
+                self.error += self.deltax
+
+        if doStep:
+            self.position += self.direction
+            self.stepsLeft -= 1
+            self.stepCount += 1
+            if self.stepsLeft == 0:
+                self.state = S_FINISHED_MOVING
+        return doStep
+
+    def idleTicks(self):
+        """ How many of the coming ticks are sure to do nothing but count """
+        if self.forceStop:
+            return 0
+        # The switch only changes when we step, so if it is going to do
+        # something, it does it on the very next tick
+        if self.limitPressed():
+            if self.direction < 0:
+                return 0
+        elif self.state == S_HOMING_B:
+            return 0
+
+        if not self.ramped:
+            return self.error / self.deltay
+        # Cruising, only the phase accumulator moves
+        if self.rate >= self.cruiseRate and self.rate > 0 and self.stepsLeft > self.rampSteps:
+            return (tickFrequency - 1 - self.phase) / self.rate
+        return 0
+
+    def advance(self, ticks):
+        """ Same as calling tick() ticks times, but skips over the ticks that
+            can't take a step. Returns the number of ticks run before it
+            stopped moving. """
+        run = 0
+        while run < ticks and self.moving():
+            idle = min(self.idleTicks(), ticks - run)
+            if self.ramped:
+                self.phase += idle * self.rate
+            else:
+                self.error -= idle * self.deltay
+            self.ticksRun += idle
+            run += idle
+
+            if run < ticks:
+                self.tick()
+                run += 1
+        return run
+
+    def ticksLeft(self):
+        """ Ticks until the current move stops, or None if it isn't moving.
+            Nothing but stop() can change that once a move has started, so
+            it is worked out once by running a copy of the stepper. """
+        if not self.moving():
+            return None
+        if self.endTick == None:
+            model = copy.copy(self)
+            self.endTick = self.ticksRun + model.advance(1 << 62)
+        return self.endTick - self.ticksRun
+
+    def doRamp(self):
+        """ Mirror of Stepper::doRamp """
+        accelerating = False
+
+        if self.stepsLeft <= self.rampSteps:
+            self.rateRemainder += self.acceleration
+            while self.rateRemainder >= tickFrequency:
+                self.rateRemainder -= tickFrequency
+                if self.rate > self.startRate:
+                    self.rate -= 1
+        elif self.rate < self.cruiseRate:
+            accelerating = True
+            self.rateRemainder += self.acceleration
+            while self.rateRemainder >= tickFrequency and self.rate < self.cruiseRate:
+                self.rateRemainder -= tickFrequency
+                self.rate += 1
+
+        self.phase += self.rate
+        if self.phase < tickFrequency:
+            return False
+        self.phase -= tickFrequency
+
+        if self.startRate == 0:
+            self.startRate = self.rate
+        if accelerating:
+            self.rampSteps += 1
+        return True
+
+    def stepTicks(self):
+        """ Tick until the move finishes, returning the tick (counting from
+            1) that each step was taken on """
+        ticks = []
+        tick = 0
+        while self.moving():
+            tick += 1
+            if self.tick():
+                ticks.append(tick)
+        return ticks
+
+    def run(self):
+        """ Tick until the move finishes, returning the number of ticks """
+        ticks = 0
+        while self.moving():
+            self.tick()
+            ticks += 1
+        return ticks
+
+    def finishTick(self):
+        """ The tick that run() would finish on, without running it. The
+            k'th step is taken on the first tick n where
+            n * deltay - error0 > (k - 1) * deltax. """
+        if not self.moving():
+            return 0
+        if self.ramped or self.limitPosition != None:
+            return self.run()
+        ticks = ((self.stepsLeft - 1) * self.deltax + self.error) / self.deltay + 1
+        self.position += self.direction * self.stepsLeft
+        self.stepCount += self.stepsLeft
+        self.stepsLeft = 0
+        self.state = S_FINISHED_MOVING
+        return ticks
+
+
+class BoardModel:
+    """ All of the steppers on one controller """
+    def __init__(self, axisCount, maxVelocity = defaultMaxVelocity, acceleration = 0):
+        self.steppers = [StepperModel(maxVelocity, acceleration) for i in range(axisCount)]
+
+    def moveAll(self, positions, moveTime = 0, coordinated = False):
+        """ Mirror of Stepper::moveAll. Returns the number of ticks each axis
+            takes to finish. """
+        if coordinated:
+            for stepper, position in zip(self.steppers, positions):
+                moveTime = max(moveTime, stepper.getMinimumTime(position))
+
+        # loop() has long since noticed the last moves finishing
+        for stepper in self.steppers:
+            stepper.checkFinished()
+
+        ticks = []
+        for stepper, position in zip(self.steppers, positions):
+            stepper.moveAbsolute(position, moveTime, coordinated)
+            ticks.append(stepper.finishTick())
+        return ticks
+
+
+if __name__ == "__main__":
+    # Print the expected step timing for a move:
+    # StepperModel.py steps maxVelocity acceleration [time]
+    import sys
+    args = [int(arg) for arg in sys.argv[1:]]
+    stepper = StepperModel(args[1], args[2])
+    moveTime = stepper.moveRelative(args[0], (args + [0])[3])
+    print "# planned %d ms, cruise %d steps/s" % (moveTime, stepper.cruiseRate)
+    for step, tick in enumerate(stepper.stepTicks()):
+        print step + 1, tick
@@ -0,0 +1,196 @@
+
+# Timing of everything that happens during a run (commands, DONEs, pictures,
+# frames) for working out where the time goes. Events are kept in a ring
+# buffer that is allocated up front, so recording one is cheap. With tracing
+# off, recorder is None and each place that records an event only checks
+# that.
+#
+# Usage:
+# Trace.enable()
+# id = Trace.begin(Trace.CAT_CAMERA, "trigger")
+# ... take a picture ...
+# Trace.end(Trace.CAT_CAMERA, "trigger", id)
+# Trace.recorder.report()
+# Trace.recorder.saveChromeTrace("run.json")   # chrome://tracing or ui.perfetto.dev
+
+import array
+import ctypes
+import ctypes.util
+import itertools
+import json
+import threading
+import time
+
+# What an event is about; each gets its own row in the trace
+categories = ["command", "motion", "camera", "frame"]
+CAT_COMMAND, CAT_MOTION, CAT_CAMERA, CAT_FRAME = range(len(categories))
+
+# Start and end of something that took time, or something that just happened
+PH_BEGIN, PH_END, PH_INSTANT = range(3)
+
+defaultSize = 1 << 16
+
+# The recorder in use, or None if tracing is off
+recorder = None
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long),
+                ("tv_nsec", ctypes.c_long)]
+
+# From 'time.h'
+CLOCK_MONOTONIC = 1
+
+try:
+    librt = ctypes.CDLL(ctypes.util.find_library("rt") or "libc.so.6")
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def monotonic():
+        """ Seconds from some fixed point, that never jumps when the system
+            clock is changed """
+        now = timespec()
+        clock_gettime(CLOCK_MONOTONIC, ctypes.byref(now))
+        return now.tv_sec + now.tv_nsec * 1e-9
+except (OSError, AttributeError):
+    # No clock_gettime; close enough as long as nobody changes the clock
+    monotonic = time.time
+
+
+class Recorder:
+    def __init__(self, size = defaultSize):
+        self.size = size
+        self.times = array.array('d', [0]) * size
+        self.phases = array.array('B', [0]) * size
+        self.categories = array.array('B', [0]) * size
+        self.ids = array.array('l', [0]) * size
+        self.names = [None] * size
+        self.threads = array.array('l', [0]) * size
+
+        # Slots are handed out by a counter, which is safe to share between
+        # threads without a lock
+        self.counter = itertools.count()
+        self.newIds = itertools.count(1)
+        self.startTime = monotonic()
+
+    def newId(self):
+        """ Number to tie the begin and end of a span together """
+        return next(self.newIds)
+
+    def record(self, phase, category, name, id = 0):
+        index = next(self.counter) % self.size
+        self.times[index] = monotonic()
+        self.phases[index] = phase
+        self.categories[index] = category
+        self.names[index] = name
+        self.ids[index] = id
+        self.threads[index] = threading.current_thread().ident or 0
+
+    def begin(self, category, name, id):
+        self.record(PH_BEGIN, category, name, id)
+
+    def end(self, category, name, id):
+        self.record(PH_END, category, name, id)
+
+    def instant(self, category, name):
+        self.record(PH_INSTANT, category, name)
+
+    def events(self):
+        """ (time, phase, category, name, id, thread) for every event still
+            in the buffer, oldest first """
+        count = next(self.counter)
+        # That used up a slot; make sure nothing old is left in it
+        self.names[count % self.size] = None
+        first = max(0, count - self.size)
+        events = []
+        for n in range(first, count):
+            index = n % self.size
+            if self.names[index] == None:
+                continue
+            events.append((self.times[index] - self.startTime, self.phases[index],
+                           self.categories[index], self.names[index],
+                           self.ids[index], self.threads[index]))
+        events.sort()
+        return events
+
+    def spans(self):
+        """ (category, name, start, duration) for everything with both its
+            begin and end still in the buffer """
+        begins = {}
+        spans = []
+        for t, phase, category, name, id, thread in self.events():
+            if phase == PH_BEGIN:
+                begins[(category, id)] = (t, name)
+            elif phase == PH_END and (category, id) in begins:
+                start, name = begins.pop((category, id))
+                spans.append((category, name, start, t - start))
+        return spans
+
+    def statistics(self):
+        """ {(category, name): (count, p50, p95, p99, max)} of how long
+            each kind of span took, in seconds """
+        durations = {}
+        for category, name, start, duration in self.spans():
+            durations.setdefault((categories[category], name), []).append(duration)
+
+        statistics = {}
+        for key, times in durations.items():
+            times.sort()
+            statistics[key] = (len(times), times[len(times) / 2],
+                               times[int(len(times) * 0.95)],
+                               times[int(len(times) * 0.99)], times[-1])
+        return statistics
+
+    def report(self):
+        statistics = self.statistics()
+        for key in sorted(statistics):
+            count, p50, p95, p99, longest = statistics[key]
+            print "%-8s %-10s %6d  p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms  max %8.2f ms" % (
+                key + (count, 1000 * p50, 1000 * p95, 1000 * p99, 1000 * longest))
+
+    def chromeTrace(self):
+        """ The events in Chrome's trace event format. Spans are async
+            events, since commands in flight overlap. """
+        phases = {PH_BEGIN: "b", PH_END: "e", PH_INSTANT: "i"}
+        traceEvents = []
+        for t, phase, category, name, id, thread in self.events():
+            event = {"name": name, "cat": categories[category], "ph": phases[phase],
+                     "ts": t * 1e6, "pid": 1, "tid": thread}
+            if phase == PH_INSTANT:
+                event["s"] = "t"
+            else:
+                event["id"] = "%s-%d" % (categories[category], id)
+            traceEvents.append(event)
+        return {"traceEvents": traceEvents, "displayTimeUnit": "ms"}
+
+    def saveChromeTrace(self, filename):
+        output = open(filename, "w")
+        try:
+            json.dump(self.chromeTrace(), output)
+        finally:
+            output.close()
+
+
+def begin(category, name):
+    """ Start a span, if tracing is on. Returns the id to end it with. """
+    if recorder == None:
+        return 0
+    id = recorder.newId()
+    recorder.begin(category, name, id)
+    return id
+
+
+def end(category, name, id):
+    if recorder != None and id != 0:
+        recorder.end(category, name, id)
+
+
+def enable(size = defaultSize):
+    global recorder
+    recorder = Recorder(size)
+    return recorder
+
+
+def disable():
+    global recorder
+    recorder = None
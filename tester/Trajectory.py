@@ -0,0 +1,215 @@
+
+# Paths for every axis, worked out with NumPy for every frame at once instead
+# of a frame at a time, and written out as a motion script (see
+# MotionScript.py) in one go. A path is a float array with a row for each
+# frame and a column for each axis (A X Y Z), from a parameter t that goes
+# from 0 at the first frame to 1 at the last. Paths can be added together.
+#
+# Usage:
+# t = frameTimes(601)
+# positions = line(t, [-100, 0, 0, 0], [1700, 0, 0, 1200]) + \
+#             lissajous(t, [0, 3750, 4000, 0], [0, 3, 3, 0],
+#                       phases=[0, 0, math.pi / 2, 0], centers=[0, 3750, 4000, 0])
+# writeScript("soa_beetle", quantize(positions))
+
+from MotionScript import MotionScript, OP_GO, OP_SNAP, cacheSuffix, frameValues
+
+import array
+import hashlib
+import numpy
+
+# Frames formatted at a time when writing a text script, to keep the
+# temporary arrays small
+textBlockSize = 1 << 16
+
+# Text of every number from 0 to 9999 (with a byte in front for the sign),
+# so numbers can be turned into text four digits at a time: all four
+# digits, as the first digits of a number with no leading zeros, the same
+# for a negative number, and nothing at all for leading zeros
+digitTableWidth = 4
+tableSize = 10 ** digitTableWidth
+TABLE_DIGITS, TABLE_FIRST, TABLE_FIRST_NEGATIVE, TABLE_BLANK = range(4)
+digitTables = numpy.frombuffer(
+    "".join(["\0%04d" % n for n in range(tableSize)] +
+            ["%5d" % n for n in range(tableSize)] +
+            ["%5d" % -n if n else "    0" for n in range(tableSize)] +
+            ["     "] * tableSize).replace(" ", "\0"),
+    dtype=numpy.uint8).reshape(-1, digitTableWidth + 1)
+
+
+def frameTimes(count):
+    """ Parameter of each of count frames, evenly spaced from 0 to 1 """
+    if count < 2:
+        return numpy.zeros(count)
+    return numpy.arange(count, dtype=float) / (count - 1)
+
+
+def line(t, start, end):
+    """ Straight from start to end """
+    start = numpy.asarray(start, dtype=float)
+    end = numpy.asarray(end, dtype=float)
+    return start + numpy.outer(t, end - start)
+
+
+def lissajous(t, amplitudes, cycles, phases = None, centers = None):
+    """ Each axis swings amplitude either side of its center, going round
+        cycles times over the path. Phases are in radians. """
+    amplitudes = numpy.asarray(amplitudes, dtype=float)
+    if phases is None:
+        phases = numpy.zeros(len(amplitudes))
+    if centers is None:
+        centers = numpy.zeros(len(amplitudes))
+    positions = numpy.tile(numpy.asarray(centers, dtype=float), (len(t), 1))
+
+    # Only the axes that move need the sines worked out
+    moving = numpy.nonzero(amplitudes)[0]
+    angles = 2 * numpy.pi * numpy.outer(t, numpy.asarray(cycles, dtype=float)[moving])
+    angles += numpy.asarray(phases, dtype=float)[moving]
+    positions[:, moving] += amplitudes[moving] * numpy.sin(angles)
+    return positions
+
+
+def arc(t, center, radius, startAngle, endAngle, plane = (1, 2)):
+    """ Round part of a circle around center, from startAngle to endAngle
+        (in radians), in the plane of two axes (X and Y to start with).
+        The other axes stay at the center. """
+    center = numpy.asarray(center, dtype=float)
+    angles = startAngle + numpy.asarray(t) * (endAngle - startAngle)
+    positions = numpy.tile(center, (len(angles), 1))
+    positions[:, plane[0]] += radius * numpy.cos(angles)
+    positions[:, plane[1]] += radius * numpy.sin(angles)
+    return positions
+
+
+def spline(t, keyTimes, keyframes):
+    """ Smooth curve through every keyframe, which it passes at the matching
+        key time (going up, from 0 to 1). A Catmull-Rom spline: the
+        direction at each keyframe is from the one before it to the one
+        after, so there are no sudden turns. """
+    keyTimes = numpy.asarray(keyTimes, dtype=float)
+    keyframes = numpy.asarray(keyframes, dtype=float)
+    if len(keyTimes) != len(keyframes) or len(keyTimes) < 2:
+        raise NameError("Need a key time for each of at least two keyframes")
+    if numpy.any(numpy.diff(keyTimes) <= 0):
+        raise NameError("Key times have to go up")
+
+    # Slope at each keyframe, in position per unit of t
+    slopes = numpy.empty_like(keyframes)
+    slopes[1:-1] = (keyframes[2:] - keyframes[:-2]) / (keyTimes[2:] - keyTimes[:-2])[:, None]
+    slopes[0] = (keyframes[1] - keyframes[0]) / (keyTimes[1] - keyTimes[0])
+    slopes[-1] = (keyframes[-1] - keyframes[-2]) / (keyTimes[-1] - keyTimes[-2])
+
+    # Which pair of keyframes each frame is between, and how far along
+    t = numpy.asarray(t, dtype=float)
+    segments = numpy.clip(numpy.searchsorted(keyTimes, t, "right") - 1, 0, len(keyTimes) - 2)
+    width = keyTimes[segments + 1] - keyTimes[segments]
+    u = ((t - keyTimes[segments]) / width)[:, None]
+
+    # Hermite basis
+    u2 = u * u
+    u3 = u2 * u
+    return ((2 * u3 - 3 * u2 + 1) * keyframes[segments] +
+            (u3 - 2 * u2 + u) * width[:, None] * slopes[segments] +
+            (-2 * u3 + 3 * u2) * keyframes[segments + 1] +
+            (u3 - u2) * width[:, None] * slopes[segments + 1])
+
+
+def quantize(positions, stepsPerUnit = 1):
+    """ Positions as whole steps, rounded to the nearest one """
+    steps = numpy.rint(numpy.asarray(positions, dtype=float) * stepsPerUnit)
+    if len(steps) > 0 and (steps.max() >= 1 << 31 or steps.min() <= -(1 << 31)):
+        raise NameError("Position too far out for the controller")
+    return steps.astype(numpy.int32)
+
+
+def compileFrames(steps, snap = True):
+    """ A MotionScript going to each row of steps, with a SNAP 0 after each
+        one if snap is set """
+    steps = numpy.asarray(steps, dtype=numpy.int32)
+    framesPerPoint = 2 if snap else 1
+    opcodes = numpy.empty(len(steps) * framesPerPoint, dtype=numpy.uint8)
+    values = numpy.zeros((len(opcodes), frameValues), dtype=numpy.int32)
+    opcodes[::framesPerPoint] = OP_GO
+    values[::framesPerPoint, :steps.shape[1]] = steps
+    if snap:
+        opcodes[1::2] = OP_SNAP
+
+    script = MotionScript()
+    script.opcodes = array.array('B', opcodes.tobytes())
+    script.values = array.array('i', values.tobytes())
+    return script
+
+
+def formatNumbers(values, width):
+    """ values as right-aligned text, in a row of bytes each with 0 bytes
+        for padding instead of spaces. width is the most digits any of them
+        has. """
+    negative = values < 0
+    magnitude = numpy.abs(values.astype(numpy.int64))
+
+    # Four digits at a time, from the table. Each chunk gets a byte in front
+    # for the sign, which is only used by the first one with any digits.
+    chunks = max(1, (width + digitTableWidth - 1) / digitTableWidth)
+    text = numpy.empty(values.shape + (chunks, digitTableWidth + 1), dtype=numpy.uint8)
+    leading = numpy.ones(values.shape, dtype=bool)
+    for chunk in range(chunks):
+        power = tableSize ** (chunks - 1 - chunk)
+        value = magnitude // power % tableSize
+        table = numpy.where(leading, TABLE_FIRST + negative, TABLE_DIGITS)
+        if chunk < chunks - 1:
+            table[leading & (value == 0)] = TABLE_BLANK
+            leading &= (value == 0)
+        text[..., chunk, :] = digitTables[table * tableSize + value]
+    return text.reshape(values.shape + (-1,))
+
+
+def scriptText(steps, snap = True):
+    """ The text of a script going to each row of steps, the same as
+        compileFrames() but as a script file would have it """
+    steps = numpy.asarray(steps)
+    if len(steps) == 0:
+        return ""
+    width = len(str(numpy.abs(steps.astype(numpy.int64)).max()))
+    suffix = "\nSNAP 0\n" if snap else "\n"
+
+    blocks = []
+    for start in range(0, len(steps), textBlockSize):
+        block = steps[start:start + textBlockSize]
+
+        # A space and a number for each axis
+        numbers = formatNumbers(block, width)
+        fields = numpy.empty(numbers.shape[:-1] + (numbers.shape[-1] + 1,), dtype=numpy.uint8)
+        fields[..., 0] = ord(" ")
+        fields[..., 1:] = numbers
+
+        # GO, the numbers, then the rest
+        rows = numpy.empty((len(block), 2 + fields[0].size + len(suffix)), dtype=numpy.uint8)
+        rows[:, :2] = numpy.frombuffer("GO", dtype=numpy.uint8)
+        rows[:, 2:-len(suffix)] = fields.reshape(len(block), -1)
+        rows[:, -len(suffix):] = numpy.frombuffer(suffix, dtype=numpy.uint8)
+
+        # Squeeze out the padding
+        rows = rows.ravel()
+        blocks.append(rows[rows != 0].tobytes())
+    return "".join(blocks)
+
+
+def writeScript(filename, steps, snap = True, compiled = False):
+    """ Write a text script going to each row of steps. With compiled set,
+        the compiled script is saved alongside it too, so compileScript()
+        doesn't have to parse it. """
+    text = scriptText(steps, snap)
+    output = open(filename, "wb")
+    try:
+        output.write(text)
+    finally:
+        output.close()
+
+    if compiled:
+        compileFrames(steps, snap).save(filename + cacheSuffix, hashlib.sha1(text).digest())
+
+
+def writeCompiled(filename, steps, snap = True):
+    """ Write just the compiled script, for compileScript() to load as it
+        is. The filename should end in .compiled. """
+    compileFrames(steps, snap).save(filename, "\0" * hashlib.sha1().digest_size)
@@ -0,0 +1,146 @@
+
+# Every byte that went between the host and a controller, with the time it
+# went, so that a session can be played back later (see
+# replay_transcript.py). The log is binary to keep it small: a header, then
+# for each read or write the microseconds since the last one, which way it
+# went, its length and the bytes themselves.
+#
+# Usage:
+# handler = SerialHandler(port="/dev/ttyUSB0", baud=9600,
+#                         transcript=TranscriptWriter("run.transcript"))
+# ...
+# handler.disconnect()
+# for time, direction, data in readTranscript("run.transcript"):
+#     print time, directions[direction], repr(data)
+#
+# Or from rig.cfg, with transcript = run.transcript in a board's section.
+
+from BinaryProtocol import FrameDecoder
+from Trace import monotonic
+
+import struct
+import threading
+import time
+
+magic = "ASCT"
+version = 1
+
+# Magic, version, and the wall clock time the transcript was started
+headerLayout = struct.Struct("<4sBd")
+
+# Microseconds since the last record, direction, length
+recordLayout = struct.Struct("<IBH")
+maxRecordSize = (1 << 16) - 1
+maxDelay = (1 << 32) - 1
+
+# Which way the bytes went
+directions = ["sent", "received"]
+SENT, RECEIVED = range(len(directions))
+
+
+class TranscriptWriter:
+    def __init__(self, filename):
+        self.output = open(filename, "wb")
+        self.output.write(headerLayout.pack(magic, version, time.time()))
+
+        # The reader thread and whoever is sending both record
+        self.lock = threading.Lock()
+        self.lastTime = monotonic()
+
+    def record(self, direction, data):
+        with self.lock:
+            if self.output == None:
+                return
+            now = monotonic()
+            delay = min(maxDelay, int(round((now - self.lastTime) * 1e6)))
+            # Keep the rounding from adding up over a long session
+            self.lastTime += delay * 1e-6
+            for offset in range(0, len(data), maxRecordSize):
+                chunk = data[offset:offset + maxRecordSize]
+                self.output.write(recordLayout.pack(delay, direction, len(chunk)))
+                self.output.write(chunk)
+                delay = 0
+
+    def close(self):
+        with self.lock:
+            if self.output != None:
+                self.output.close()
+                self.output = None
+
+
+def readTranscript(filename):
+    """ List of (time, direction, data) for each read and write, with time in
+        seconds since the transcript was started """
+    input = open(filename, "rb")
+    try:
+        header = input.read(headerLayout.size)
+        if len(header) < headerLayout.size or header[:len(magic)] != magic:
+            raise NameError("Not a transcript: ", filename)
+        if headerLayout.unpack(header)[1] != version:
+            raise NameError("Unknown transcript version: ", filename)
+
+        records = []
+        delays = 0
+        while True:
+            header = input.read(recordLayout.size)
+            if len(header) == 0:
+                break
+            if len(header) < recordLayout.size:
+                raise NameError("Transcript is cut short: ", filename)
+            delay, direction, size = recordLayout.unpack(header)
+            data = input.read(size)
+            if len(data) < size or direction >= len(directions):
+                raise NameError("Transcript is cut short: ", filename)
+            delays += delay
+            records.append((delays * 1e-6, direction, data))
+        return records
+    finally:
+        input.close()
+
+
+def splitTranscript(records):
+    """ Pull the commands and replies out of a transcript, and work out what
+        each was waiting on, so they can be played back in the same order at
+        any speed. Returns (commands, replies, messages), where:
+
+        commands is (time, data, replies) for each command that was sent,
+        replies being how many messages had come back before it, and
+        replies is (time, data, commands) for each read, commands being how
+        many commands had been sent before it, and messages is how many
+        messages came back in all.
+
+        Blank lines (sent to flush out the controller) aren't commands, and
+        position reports aren't counted as messages, since how many of those
+        come back depends on how long things take. """
+    decoder = FrameDecoder()
+    commands = []
+    replies = []
+    messageCount = 0
+    for t, direction, data in records:
+        if direction == SENT:
+            if data.strip() != "":
+                commands.append((t, data, messageCount))
+        else:
+            replies.append((t, data, len(commands)))
+            for message, size, framed in decoder.feed(data):
+                if not message.startswith("NOTICE POS "):
+                    messageCount += 1
+    return commands, replies, messageCount
+
+
+def roundTrips(records):
+    """ Seconds between sending each command and getting its ACK or ERROR """
+    decoder = FrameDecoder()
+    sentTimes = []
+    times = []
+    for t, direction, data in records:
+        if direction == SENT:
+            if data.strip() != "":
+                sentTimes.append(t)
+            continue
+        for message, size, framed in decoder.feed(data):
+            if message.startswith("ACK ") or message.startswith("ERROR "):
+                # Answered in order, same as SerialHandler matches them up
+                if len(times) < len(sentTimes):
+                    times.append(t - sentTimes[len(times)])
+    return times
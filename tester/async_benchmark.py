@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+# Drive a dozen simulated boards from one thread with AsyncStepperAxis.py:
+# every board runs the same routine (single GOs, GOALL, LINE and a stream of
+# QUEUE moves, then reads back where the axis ended up), one board after
+# another and then all of them at once through gather(). A last run loses
+# some of what the boards send, to show that the lost ACKs and DONEs fail
+# their boards with a timeout instead of hanging the loop.
+#
+# Usage: async_benchmark.py [boards [drop rate]]
+
+from AsyncStepperAxis import *
+from ControllerSimulator import ControllerSimulator, controllerAxisCount
+
+import sys
+import time
+
+# Simulated seconds per real second, and seconds each board takes to answer
+# a command (simulated)
+simSpeed = 10
+latency = 0.2
+
+streamFrames = 20
+
+# Timeouts for the lossy run, so it doesn't take minutes
+lossyTimeout = 1
+lossyDoneTimeout = 5
+
+
+def routine(handler):
+    """ Result is "ok", or what went wrong """
+    axes = [asyncStepperAxis(axis, handler) for axis in range(1, controllerAxisCount + 1)]
+    try:
+        yield gather(*[axis.moveAbsolute(100 * axis.axis) for axis in axes])
+        yield handler.goAll([-100] * controllerAxisCount)
+        yield handler.moveLine([200, 100, 0, -100])
+        frames = [[10 * frame * axis for axis in range(1, controllerAxisCount + 1)]
+                  for frame in range(1, streamFrames + 1)]
+        yield handler.streamMoves(frames)
+        positions = yield gather(*[axis.readPosition() for axis in axes])
+    except NameError, e:
+        raise StopIteration(str(e))
+
+    if positions != frames[-1]:
+        raise StopIteration("ended up at %s instead of %s" % (positions, frames[-1]))
+    raise StopIteration("ok")
+
+
+def run(boardCount, parallel, dropRate = 0):
+    sims = [ControllerSimulator(speed=simSpeed, latency=latency, dropRate=dropRate, seed=board)
+            for board in range(boardCount)]
+    for sim in sims:
+        sim.start()
+
+    loop = EventLoop()
+    handlers = [AsyncSerialHandler(loop, sim.port) for sim in sims]
+    if dropRate > 0:
+        for handler in handlers:
+            handler.timeout = lossyTimeout
+            handler.doneTimeout = lossyDoneTimeout
+
+    startTime = time.time()
+    if parallel:
+        results = loop.runUntilComplete(gather(*[routine(handler) for handler in handlers]))
+    else:
+        results = [loop.runUntilComplete(routine(handler)) for handler in handlers]
+    elapsed = time.time() - startTime
+
+    for handler in handlers:
+        handler.disconnect()
+    for sim in sims:
+        sim.stop()
+    return elapsed, results
+
+
+def main(argv):
+    boardCount = int((argv + [12])[0])
+    dropRate = float((argv[1:] + [0.002])[0])
+
+    for name, parallel, rate in [("one at a time", False, 0),
+                                 ("gather", True, 0),
+                                 ("gather, lossy", True, dropRate)]:
+        elapsed, results = run(boardCount, parallel, rate)
+        failures = [result for result in results if result != "ok"]
+        print "%-14s %2d boards %6.2f s, %d failed" % (name, boardCount, elapsed, len(failures))
+        for failure in failures:
+            print "    " + failure
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
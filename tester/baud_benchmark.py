@@ -0,0 +1,51 @@
+#!/usr/bin/python
+
+# Measure round trip latency and command throughput of SerialHandler at each
+# link speed, against a simulated controller that models the time characters
+# take on the wire. The board starts at 9600 and is switched up with BAUD.
+
+from ControllerSimulator import *
+from StepperAxis import *
+
+import sys
+import time
+
+commandCount = 200
+bootBaud = 9600
+
+
+def benchmark(rate):
+    sim = ControllerSimulator(baud=bootBaud)
+    sim.start()
+
+    handler = SerialHandler(port=sim.port, baud=bootBaud, rates=[rate])
+    if handler.ser.baudrate != rate:
+        raise NameError("Couldn't switch to: ", rate)
+
+    latencies = []
+    for i in range(commandCount):
+        sent = time.time()
+        handler.sendCommand("GET POS 1\n")
+        latencies.append(time.time() - sent)
+
+    startTime = time.time()
+    handler.sendCommands(["GET POS 1\n"] * commandCount)
+    elapsed = time.time() - startTime
+
+    handler.disconnect()
+    sim.stop()
+
+    latencies.sort()
+    print "%7d baud: round trip mean %6.2f ms  p50 %6.2f ms  p99 %6.2f ms  pipelined %7.1f commands/s" % (
+        rate, 1000 * sum(latencies) / len(latencies),
+        1000 * latencies[len(latencies) / 2],
+        1000 * latencies[int(len(latencies) * 0.99)],
+        commandCount / elapsed)
+
+
+def main(argv):
+    for rate in [bootBaud] + sorted(linkRates):
+        benchmark(rate)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
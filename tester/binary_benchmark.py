@@ -0,0 +1,61 @@
+#!/usr/bin/python
+
+# Compare the text and binary protocols against a simulated controller on a
+# 9600 baud link: bytes on the wire for a GO (command, ACK and DONE), and how
+# many GOs and GETs a second each one manages.
+
+from BinaryProtocol import *
+from ControllerSimulator import *
+from StepperAxis import *
+
+import sys
+import time
+
+commandCount = 100
+baud = 9600
+
+
+def goBytes(binary):
+    """ Bytes both ways for one GO, from sending it to NOTICE DONE """
+    messages = ["GO 3 -12345 0\n", "ACK GO 3 -12345 1000", "NOTICE DONE 3"]
+    if binary:
+        return len(encodeCommand(messages[0])) + len(encodeReply(messages[1])) + len(encodeReply(messages[2]))
+    return len(messages[0]) + len(messages[1]) + 1 + len(messages[2]) + 1
+
+
+def benchmark(binary):
+    sim = ControllerSimulator(baud=baud)
+    sim.start()
+    handler = SerialHandler(port=sim.port, baud=baud, rates=[])
+    axis = stepperAxis(3, handler)
+
+    if binary and not handler.enableBinary():
+        raise NameError("Controller didn't take BINARY")
+
+    # Moves that don't go anywhere finish right away, so this is all
+    # serial link. They have to be sent for that, though.
+    handler.elideMoves = False
+    handler.sendCommand("SET POS 3 -12345\n")
+    startTime = time.time()
+    for i in range(commandCount):
+        axis.moveAbsolute(-12345)
+        axis.waitUntilDone()
+    goRate = commandCount / (time.time() - startTime)
+
+    startTime = time.time()
+    handler.sendCommands(["GET POS 3\n"] * commandCount)
+    getRate = commandCount / (time.time() - startTime)
+
+    handler.disconnect()
+    sim.stop()
+
+    print "%-6s  GO %2d bytes, %5.1f GOs/s   GET %5.1f/s" % (
+        ["text", "binary"][binary], goBytes(binary), goRate, getRate)
+
+
+def main(argv):
+    for binary in [False, True]:
+        benchmark(binary)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+
+# Count the commands and time it takes to run the moves in a motion script
+# against simulated controllers, reading back every axis's position, MAX_VEL
+# and ACCEL after each one the way a tool showing them would: asking the
+# controller every time, and from the cache. At the end, every cached value is
+# checked against the controller.
+#
+# Usage: cache_benchmark.py soa_beetle [more scripts]
+
+from ControllerSimulator import *
+from MotionScript import *
+from StepperAxis import *
+
+import sys
+import time
+
+# The moves are real, so run the simulators well ahead of real time
+simSpeed = 1000
+
+# cacheCheckPeriod for each run: 0 asks the controller for every read
+modes = [("uncached", 0),
+         ("cached", defaultCacheCheckPeriod)]
+
+
+def runScript(filename, checkPeriod):
+    sims = [ControllerSimulator(speed=simSpeed) for i in range(2)]
+    for sim in sims:
+        sim.start()
+
+    handlers = [SerialHandler(port=sim.port, baud=9600, rates=[]) for sim in sims]
+    for handler in handlers:
+        handler.cacheCheckPeriod = checkPeriod
+    axes = [stepperAxis(1, handlers[0])] + [stepperAxis(i, handlers[1]) for i in range(1, 4)]
+
+    startCommands = sum([handler.commandsSent for handler in handlers])
+    startTime = time.time()
+    moves = 0
+    for index, opcode, values in streamScript(filename):
+        if opcode != OP_GO:
+            continue
+        moveAxesAbsolute(axes, values)
+        if len(waitForAxes(axes, 60)) != len(axes):
+            raise NameError("timed out waiting for frame: ", index)
+        for axis in axes:
+            if axis.getPosition() != axis.requestedPosition:
+                raise NameError("axis isn't where it was sent: ", index)
+            axis.getMaxVelocity()
+            axis.getAcceleration()
+        moves += 1
+    elapsed = time.time() - startTime
+    commands = sum([handler.commandsSent for handler in handlers]) - startCommands
+    mismatches = sum([handler.checkCache() for handler in handlers])
+
+    for handler in handlers:
+        handler.disconnect()
+    for sim in sims:
+        sim.stop()
+    return moves, commands, elapsed, mismatches
+
+
+def main(argv):
+    for filename in argv:
+        print filename
+        for name, checkPeriod in modes:
+            moves, commands, elapsed, mismatches = runScript(filename, checkPeriod)
+            print "  %-9s %5d moves %6d commands %7.2f s, %d cached values wrong" % (
+                name, moves, commands, elapsed, mismatches)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+# Time a stop-motion run (move, take a picture, repeat) with each picture
+# downloaded before the next move, and with CapturePipeline downloading it
+# during the next move. The controllers are simulated, and so is the camera,
+# which takes as long as a real one would.
+#
+# Usage: capture_benchmark.py [script [frames]]
+
+from CameraController import *
+from ControllerSimulator import *
+from MotionScript import *
+from StepperAxis import *
+
+import sys
+import threading
+import time
+
+# Seconds for the shutter, and to get a picture off the camera over USB
+exposureTime = 0.2
+downloadTime = 0.8
+
+# Everything, camera included, runs this many times faster than real time
+speed = 4
+
+
+class FakeCamera:
+    """ Stands in for CameraController, sleeping instead of taking pictures """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pictures = 0
+
+    def capture(self, name):
+        self.download(self.trigger(), name)
+
+    def trigger(self):
+        with self.lock:
+            time.sleep(exposureTime / speed)
+        return None
+
+    def download(self, cam_path, name):
+        with self.lock:
+            time.sleep(downloadTime / speed)
+            self.pictures += 1
+
+
+def run(frames, pipelined):
+    sims = [ControllerSimulator(speed=speed) for i in range(2)]
+    for sim in sims:
+        sim.start()
+
+    camera = FakeCamera()
+    capturer = camera
+    if pipelined:
+        capturer = CapturePipeline(camera)
+
+    handlers = [SerialHandler(port=sim.port, baud=9600, rates=[]) for sim in sims]
+    axes = [stepperAxis(1, handlers[0])] + [stepperAxis(i, handlers[1]) for i in range(1, 4)]
+
+    # Getting to the first frame is a long move, and not what we're timing
+    moveAxesAbsolute(axes, frames[0][2])
+    waitForAxes(axes, 600)
+
+    startTime = time.time()
+    for index, opcode, values in frames[1:]:
+        if opcode == OP_GO:
+            moveAxesAbsolute(axes, values)
+            if len(waitForAxes(axes, 60)) != len(axes):
+                raise NameError("timed out waiting for frame: ", index)
+        elif opcode == OP_SNAP:
+            capturer.capture("%010d.jpg" % index)
+    if pipelined:
+        capturer.close()
+    elapsed = time.time() - startTime
+
+    for handler in handlers:
+        handler.disconnect()
+    for sim in sims:
+        sim.stop()
+    return camera.pictures, elapsed * speed
+
+
+def main(argv):
+    filename = (argv + ["soa_beetle"])[0]
+    frameCount = int((argv + [None, 60])[1])
+    frames = list(compileScript(filename, False).frames())[:frameCount + 1]
+
+    results = {}
+    for name, pipelined in [("sequential", False), ("pipelined", True)]:
+        pictures, elapsed = run(frames, pipelined)
+        results[pipelined] = elapsed
+        print "%-10s %3d pictures in %6.1f s (%.2f pictures/s)" % (
+            name, pictures, elapsed, pictures / elapsed)
+    print "%.2fx the frame rate" % (results[False] / results[True])
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,59 @@
+#!/usr/bin/python
+
+# Time getting pictures off a (mock) camera: written to a file by libgphoto2,
+# and downloaded to memory and handed to each kind of sink. The camera itself
+# takes no time, so this is only what it costs us on top of the download.
+#
+# Usage: download_benchmark.py [pictures [megabytes]]
+
+from CameraController import *
+from MockGphoto2 import *
+
+import Queue
+import hashlib
+import shutil
+import sys
+import tempfile
+import time
+
+
+def run(sink, pictures, imageSize, directory):
+    camera = CameraController(sink, MockGphoto2(imageSize))
+    directory = tempfile.mkdtemp(dir=directory)
+
+    startTime = time.time()
+    for i in range(pictures):
+        camera.capture(os.path.join(directory, "%010d.jpg" % i))
+    return time.time() - startTime
+
+
+def main(argv):
+    pictures = int((argv + [50])[0])
+    imageSize = int(float((argv[1:] + [6])[0]) * (1 << 20))
+
+    # Something that looks at every byte, and keeps nothing
+    checksums = []
+    def checksum(name, data):
+        checksums.append(hashlib.sha1(data).digest())
+
+    # Something that keeps them, and gets rid of them as fast as they come
+    queue = Queue.Queue()
+    def emptyQueue(name, data):
+        QueueSink(queue)(name, data)
+        queue.get()
+
+    directory = tempfile.mkdtemp()
+    try:
+        for name, sink in [("file descriptor", None),
+                           ("memory, to disk", DiskSink()),
+                           ("memory, to queue", emptyQueue),
+                           ("memory, checksum", checksum)]:
+            elapsed = run(sink, pictures, imageSize, directory)
+            print "%-17s %3d pictures in %6.3f s  %6.2f ms/picture  %7.1f MB/s" % (
+                name, pictures, elapsed, 1000 * elapsed / pictures,
+                pictures * imageSize / elapsed / (1 << 20))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
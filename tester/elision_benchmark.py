@@ -0,0 +1,66 @@
+#!/usr/bin/python
+
+# Count the commands it takes to run the moves in a motion script against
+# simulated controllers (the A axis on one, X Y Z on another, the way
+# motion_test.py has them): sending every move, leaving out the ones that
+# don't change anything, and also merging runs of GOs with no SNAP in between.
+#
+# Usage: elision_benchmark.py soa_beetle [more scripts]
+
+from ControllerSimulator import *
+from MotionScript import *
+from StepperAxis import *
+
+import sys
+
+# The moves are real, so run the simulators well ahead of real time
+simSpeed = 1000
+
+modes = [("every move", False, False),
+         ("elided", True, False),
+         ("elided+merged", True, True)]
+
+
+def countCommands(filename, elide, merge):
+    sims = [ControllerSimulator(speed=simSpeed) for i in range(2)]
+    for sim in sims:
+        sim.start()
+
+    handlers = [SerialHandler(port=sim.port, baud=9600, rates=[]) for sim in sims]
+    for handler in handlers:
+        handler.elideMoves = elide
+    axes = [stepperAxis(1, handlers[0])] + [stepperAxis(i, handlers[1]) for i in range(1, 4)]
+
+    frames = streamScript(filename)
+    if merge:
+        frames = mergeMoves(frames)
+    moves = 0
+    for index, opcode, values in frames:
+        if opcode != OP_GO:
+            continue
+        moveAxesAbsolute(axes, values)
+        if len(waitForAxes(axes, 60)) != len(axes):
+            raise NameError("timed out waiting for frame: ", index)
+        moves += 1
+
+    commands = sum([handler.commandsSent for handler in handlers])
+    for handler in handlers:
+        handler.disconnect()
+    for sim in sims:
+        sim.stop()
+    return moves, commands
+
+
+def main(argv):
+    for filename in argv:
+        print filename
+        baseline = None
+        for name, elide, merge in modes:
+            moves, commands = countCommands(filename, elide, merge)
+            if baseline == None:
+                baseline = commands
+            print "  %-14s %5d moves %6d commands (%d saved)" % (
+                name, moves, commands, baseline - commands)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
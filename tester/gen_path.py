@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+# Write a motion script that takes a picture at each point along a path. The
+# path is the sum of whichever of these are given (values are for A,X,Y,Z):
+#
+#   --start/--end     a straight line
+#   --amplitude       a swing of each axis either side of where it would be,
+#                     --cycles times over the path, starting --phase degrees
+#                     in (a Lissajous figure)
+#   --radius          part of a circle, from the first of --angles to the
+#                     second, in the plane of two axes
+#   --keyframes       a smooth curve through the points in a file, one per
+#                     line: "t a x y z" with t from 0 to 1, or just "a x y z"
+#                     to spread them evenly
+#
+# plus --center, which moves the whole thing. The soa_beetle path is:
+#
+# gen_path.py --frames 601 --start -100,0,0,0 --end 1700,0,0,1200 \
+#     --center 0,3750,4000,0 --amplitude 0,3750,4000,0 --cycles 0,3,3,0 \
+#     --phase 0,0,90,0 soa_beetle
+#
+# Usage: gen_path.py [options] output
+
+from MotionScript import cacheSuffix, positionCount
+from Trajectory import *
+
+import math
+import numpy
+import optparse
+import sys
+
+axisNames = ["A", "X", "Y", "Z"]
+
+
+def axisValues(text):
+    """ A value for each axis, from "a,x,y,z" """
+    values = [float(value) for value in text.split(",")]
+    if len(values) != positionCount:
+        raise ValueError("need %d values: %s" % (positionCount, text))
+    return values
+
+
+def readKeyframes(filename):
+    """ (key times, keyframes) from a keyframe file """
+    rows = []
+    for line in open(filename):
+        words = line.split()
+        if not words or words[0].startswith("#"):
+            continue
+        rows.append([float(word) for word in words])
+    if len(rows) < 2:
+        raise ValueError("need at least two keyframes in %s" % filename)
+
+    rows = numpy.array(rows)
+    if rows.shape[1] == positionCount:
+        return frameTimes(len(rows)), rows
+    if rows.shape[1] == positionCount + 1:
+        return rows[:, 0], rows[:, 1:]
+    raise ValueError("keyframes need %d or %d values: %s" % (positionCount, positionCount + 1, filename))
+
+
+def buildPath(options, t):
+    zeros = [0] * positionCount
+    positions = numpy.tile(axisValues(options.center or ",".join(["0"] * positionCount)),
+                           (len(t), 1))
+
+    if options.start or options.end:
+        positions += line(t, axisValues(options.start or "0,0,0,0"),
+                          axisValues(options.end or "0,0,0,0"))
+
+    if options.amplitude:
+        phases = [math.radians(phase) for phase in axisValues(options.phase)]
+        positions += lissajous(t, axisValues(options.amplitude), axisValues(options.cycles),
+                               phases)
+
+    if options.radius:
+        startAngle, endAngle = [math.radians(float(angle)) for angle in options.angles.split(",")]
+        plane = [axisNames.index(name.upper()) for name in options.plane.split(",")]
+        positions += arc(t, zeros, options.radius, startAngle, endAngle, plane)
+
+    if options.keyframes:
+        keyTimes, keyframes = readKeyframes(options.keyframes)
+        positions += spline(t, keyTimes, keyframes)
+
+    return positions
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options] output")
+    parser.add_option("--frames", type="int", default=601,
+                      help="points along the path")
+    parser.add_option("--center", help="where the whole path is moved to")
+    parser.add_option("--start", help="start of a straight line")
+    parser.add_option("--end", help="end of a straight line")
+    parser.add_option("--amplitude", help="size of the swing of each axis")
+    parser.add_option("--cycles", default="1,1,1,1",
+                      help="swings over the path, for each axis")
+    parser.add_option("--phase", default="0,0,0,0",
+                      help="how far into its swing each axis starts, in degrees")
+    parser.add_option("--radius", type="float", help="radius of an arc")
+    parser.add_option("--angles", default="0,360",
+                      help="where the arc starts and ends, in degrees")
+    parser.add_option("--plane", default="X,Y", help="axes the arc is drawn with")
+    parser.add_option("--keyframes", metavar="FILE", help="points to draw a curve through")
+    parser.add_option("--steps-per-unit", type="float", default=1,
+                      help="steps for each unit the path is given in")
+    parser.add_option("--no-snap", action="store_false", dest="snap", default=True,
+                      help="don't take a picture at each point")
+    parser.add_option("--format", choices=["text", "compiled", "both"], default="text",
+                      help="text script, compiled script, or both (the compiled one "
+                      "next to the text one, so it doesn't need compiling)")
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("where to write the script?")
+    output = args[0]
+
+    try:
+        positions = buildPath(options, frameTimes(options.frames))
+        steps = quantize(positions, options.steps_per_unit)
+    except (ValueError, IOError, NameError), e:
+        parser.error(str(e))
+
+    if options.format == "compiled":
+        if not output.endswith(cacheSuffix):
+            output += cacheSuffix
+        writeCompiled(output, steps, options.snap)
+    else:
+        writeScript(output, steps, options.snap, compiled=(options.format == "both"))
+    print "%d points written to %s" % (len(steps), output)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
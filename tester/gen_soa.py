@@ -1,7 +1,11 @@
 #!/usr/bin/python
-import math;
-outfile = open("soa_beetle","w");
 
+# The soa_beetle script: A and Z sweep across while X and Y go round three
+# times, taking a picture at each point. See gen_path.py for other paths.
+
+from Trajectory import *
+
+import math
 
 rangeX = 7500.0/2
 rangeY = 8000.0/2
@@ -9,6 +13,8 @@ rangeZ = 7200.0/6
 rangeA = 1800.0
 MAX = 600
 
-for a in range (0, MAX+1):
-    outfile.write("GO " + str((int)(a*rangeA/MAX)-100) + " " + str(int((math.sin(a*2*math.pi*3/MAX)+1)*rangeX)) + " " + str(int((math.cos(a*2*math.pi*3/MAX)+1)*rangeY)) + " " + str(int(a*rangeZ/MAX)) + "\n" )
-    outfile.write("SNAP 0\n")
+t = frameTimes(MAX + 1)
+positions = line(t, [-100, 0, 0, 0], [rangeA - 100, 0, 0, rangeZ]) + \
+            lissajous(t, [0, rangeX, rangeY, 0], [0, 3, 3, 0],
+                      phases=[0, 0, math.pi / 2, 0], centers=[0, rangeX, rangeY, 0])
+writeScript("soa_beetle", quantize(positions))
@@ -1,13 +1,22 @@
 #!/usr/bin/python
 
 # Do some testing of the interface
+#
+# Usage: interface_test.py [port]
+#        interface_test.py --sim     (against ControllerSimulator)
 
 import unittest
 import serial
+import sys
 import time
 import random
 
-ser = serial.Serial('/dev/ttyUSB0', 9600, timeout = 4)
+from BinaryProtocol import *
+
+defaultPort = '/dev/ttyUSB0'
+
+# Opened in main, once we know where the controller is
+ser = None
 
 # Number of valid stepper axis we have
 controllerAxisCount = 4
@@ -15,6 +24,12 @@ controllerAxisCount = 4
 # Size of the controller's message buffer, in characters
 controllerMessageBufferSize = 64
 
+# Number of moves the controller can queue up
+controllerQueueLength = 8
+
+# Seconds the controller waits for an ALIVE after changing baud rate
+baudVerifyTime = 1.0
+
 class controllerTest(unittest.TestCase):
     def setUp(self):
         self.flushSerial()
@@ -306,6 +321,316 @@ class GOtests(controllerTest):
             response = ser.readline()
             self.assertEqual(response, "ACK GET POS " + str(i) + " 0\n")
 
+    def testSetWhileMoving(self):
+        """ Axis parameters can't be changed while the axis is moving """
+        counts = 400
+        timeDelay = 1000
+
+        ser.write("GO 1 " + str(counts) + " " + str(timeDelay) + "\n")
+        response = ser.readline()
+        self.assertEqual(response, "ACK GO 1 " + str(counts) + " " + str(timeDelay) + "\n")
+
+        for param in ["MAX_VEL", "ACCEL", "POS"]:
+            ser.write("SET " + param + " 1 100\n")
+            response = ser.readline()
+            self.assertEqual(response, "ERROR invalid parameter\n")
+
+        time.sleep(timeDelay/1000)
+
+        response = ser.readline()
+        self.assertEqual(response, "NOTICE DONE 1\n")
+
+        # Put it back
+        ser.write("GO 1 0 " + str(timeDelay) + "\n")
+        response = ser.readline()
+        self.assertEqual(response, "ACK GO 1 0 " + str(timeDelay) + "\n")
+        time.sleep(timeDelay/1000)
+        response = ser.readline()
+        self.assertEqual(response, "NOTICE DONE 1\n")
+
+    def testGoAllIncompleteParams(self):
+        ser.write("GOALL 0 0 0\n")
+        response = ser.readline()
+        self.assertTrue(response.startswith("ERROR "))
+    def testGoAll(self):
+        counts = 400
+        timeDelay = 1000
+
+        """ Jog every axis forward together, then back """
+        for position in [counts, 0]:
+            positions = " ".join([str(position)] * controllerAxisCount)
+            ser.write("GOALL " + positions + " " + str(timeDelay) + "\n")
+            response = ser.readline()
+            self.assertEqual(response, "ACK GOALL " + positions + " " + str(timeDelay) + "\n")
+
+            time.sleep(timeDelay/1000)
+
+            # Only one DONE for the whole group
+            response = ser.readline()
+            self.assertEqual(response, "NOTICE DONE ALL\n")
+
+            for i in range(1, controllerAxisCount + 1):
+                ser.write("GET POS " + str(i) + "\n")
+                response = ser.readline()
+                self.assertEqual(response, "ACK GET POS " + str(i) + " " + str(position) + "\n")
+
+    def testLine(self):
+        """ Move every axis a different distance; they should all take the
+            time of the longest one """
+        timeDelay = 1000
+        positions = " ".join([str(50 * i) for i in range(1, controllerAxisCount + 1)])
+        ser.write("LINE " + positions + " " + str(timeDelay) + "\n")
+        response = ser.readline()
+        self.assertEqual(response, "ACK LINE " + positions + " " + str(timeDelay) + "\n")
+
+        time.sleep(timeDelay/1000)
+
+        response = ser.readline()
+        self.assertEqual(response, "NOTICE DONE ALL\n")
+
+        positions = " ".join(["0"] * controllerAxisCount)
+        ser.write("LINE " + positions + " " + str(timeDelay) + "\n")
+        response = ser.readline()
+        self.assertEqual(response, "ACK LINE " + positions + " " + str(timeDelay) + "\n")
+
+        time.sleep(timeDelay/1000)
+
+        response = ser.readline()
+        self.assertEqual(response, "NOTICE DONE ALL\n")
+
+
+class QUEUEtests(controllerTest):
+    def testIncompleteParams(self):
+        ser.write("QUEUE 1 2 3\n")
+        response = ser.readline()
+        self.assertTrue(response.startswith("ERROR "))
+
+    def testQueueEmpty(self):
+        ser.write("GET QUEUE\n")
+        response = ser.readline()
+        self.assertEqual(response, "ACK GET QUEUE " + str(controllerQueueLength) + "\n")
+
+    def testCantSetQueue(self):
+        ser.write("SET QUEUE 1\n")
+        response = ser.readline()
+        self.assertTrue(response.startswith("ERROR "))
+
+    def testQueue(self):
+        """ Queue two moves; the second should start as soon as the first
+            is done, with one DONE at the end """
+        timeDelay = 1000
+        for position in [100, 0]:
+            positions = " ".join([str(position)] * controllerAxisCount)
+            ser.write("QUEUE " + positions + " " + str(timeDelay) + "\n")
+
+        # An ACK for each QUEUE, and a NOTICE as each move comes off the
+        # queue, in whatever order the board got to them
+        responses = [ser.readline() for i in range(4)]
+        self.assertEqual(len([r for r in responses if r.startswith("ACK QUEUE ")]), 2)
+        self.assertEqual(len([r for r in responses if r.startswith("NOTICE QUEUE ")]), 2)
+
+        # Once the second move has started, the queue is empty again
+        self.assertEqual(responses[-1], "NOTICE QUEUE " + str(controllerQueueLength) + "\n")
+
+        time.sleep(timeDelay/1000)
+
+        response = ser.readline()
+        self.assertEqual(response, "NOTICE DONE QUEUE\n")
+
+        for i in range(1, controllerAxisCount + 1):
+            ser.write("GET POS " + str(i) + "\n")
+            response = ser.readline()
+            self.assertEqual(response, "ACK GET POS " + str(i) + " 0\n")
+
+    def testFlush(self):
+        """ Moves that haven't started yet are thrown away by FLUSH """
+        timeDelay = 1000
+        for position in [100, 200, 300]:
+            positions = " ".join([str(position)] * controllerAxisCount)
+            ser.write("QUEUE " + positions + " " + str(timeDelay) + "\n")
+        ser.write("FLUSH\n")
+
+        # The ACKs can have NOTICE QUEUEs mixed in with them
+        response = ser.readline()
+        while response != "ACK FLUSH\n":
+            self.assertTrue(response.startswith("ACK QUEUE ") or
+                            response.startswith("NOTICE QUEUE "))
+            response = ser.readline()
+
+        time.sleep(timeDelay/1000)
+
+        response = ser.readline()
+        self.assertEqual(response, "NOTICE DONE QUEUE\n")
+
+        # Only the first move ran
+        ser.write("GET POS 1\n")
+        response = ser.readline()
+        self.assertEqual(response, "ACK GET POS 1 100\n")
+
+        # Put everything back
+        positions = " ".join(["0"] * controllerAxisCount)
+        ser.write("LINE " + positions + " " + str(timeDelay) + "\n")
+        response = ser.readline()
+        self.assertEqual(response, "ACK LINE " + positions + " " + str(timeDelay) + "\n")
+        response = ser.readline()
+        self.assertEqual(response, "NOTICE DONE ALL\n")
+
+
+class BINARYtests(controllerTest):
+    def readFrame(self):
+        header = ser.read(2)
+        self.assertEqual(len(header), 2)
+        return decodeReply(bytearray(header + ser.read(ord(header[1]) + 1)))
+
+    def testHandshake(self):
+        ser.write("BINARY\n")
+        response = ser.readline()
+        self.assertEqual(response, "ACK BINARY\n")
+
+        ser.write(encodeCommand("GET POS 1\n"))
+        response = self.readFrame()
+        self.assertTrue(response.startswith("ACK GET POS 1 "))
+
+        # Going back to text is just a matter of sending some
+        ser.write("GET VERSION\n")
+        response = ser.readline()
+        self.assertTrue(response.startswith("ACK GET VERSION "))
+
+    def testBadCRC(self):
+        ser.write("BINARY\n")
+        response = ser.readline()
+        self.assertEqual(response, "ACK BINARY\n")
+
+        frame = encodeCommand("GET POS 1\n")
+        frame[-1] ^= 0xFF
+        ser.write(frame)
+        response = self.readFrame()
+        self.assertTrue(response.startswith("ERROR "))
+
+
+class BAUDtests(controllerTest):
+    def tearDown(self):
+        ser.baudrate = 9600
+
+    def testUnsupportedRate(self):
+        ser.write("BAUD 1234\n")
+        response = ser.readline()
+        self.assertTrue(response.startswith("ERROR "))
+
+    def testChangeBaud(self):
+        for rate in [115200, 9600]:
+            ser.write("BAUD " + str(rate) + "\n")
+            response = ser.readline()
+            self.assertEqual(response, "ACK BAUD " + str(rate) + "\n")
+
+            time.sleep(.01)
+            ser.baudrate = rate
+            ser.write("\nALIVE\n")
+            response = ser.readline()
+            self.assertEqual(response, "ACK ALIVE\n")
+
+    def testFallback(self):
+        """ If we never talk at the new rate, the controller goes back """
+        ser.write("BAUD 115200\n")
+        response = ser.readline()
+        self.assertEqual(response, "ACK BAUD 115200\n")
+
+        time.sleep(baudVerifyTime + .5)
+        ser.write("ALIVE\n")
+        response = ser.readline()
+        self.assertEqual(response, "ACK ALIVE\n")
+
+
+class WATCHtests(controllerTest):
+    def tearDown(self):
+        ser.write("WATCH 0\n")
+        self.flushSerial()
+
+    def readReports(self, count):
+        """ The next count position reports, as (time, positions, states) """
+        reports = []
+        while len(reports) < count:
+            response = ser.readline()
+            self.assertTrue(response.startswith("NOTICE POS "), response)
+            words = response.split()
+            self.assertEqual(len(words), 3 + controllerAxisCount + 1)
+            self.assertEqual(len(words[-1]), controllerAxisCount)
+            reports.append((int(words[2]), [int(w) for w in words[3:-1]], words[-1]))
+        return reports
+
+    def testIncompleteParams(self):
+        ser.write("WATCH\n")
+        response = ser.readline()
+        self.assertTrue(response.startswith("ERROR "))
+
+    def testNegativePeriod(self):
+        ser.write("WATCH -1\n")
+        response = ser.readline()
+        self.assertTrue(response.startswith("ERROR "))
+
+    def testMinimumPeriod(self):
+        ser.write("WATCH 1\n")
+        response = ser.readline()
+        self.assertEqual(response, "ACK WATCH 20\n")
+
+    def testReports(self):
+        period = 100
+        ser.write("WATCH " + str(period) + "\n")
+        response = ser.readline()
+        self.assertEqual(response, "ACK WATCH " + str(period) + "\n")
+
+        reports = self.readReports(4)
+        for previous, report in zip(reports, reports[1:]):
+            self.assertTrue(report[0] - previous[0] >= period)
+        self.assertEqual(reports[-1][2], "0" * controllerAxisCount)
+
+        # Nothing more after WATCH 0
+        ser.write("WATCH 0\n")
+        response = ser.readline()
+        while response != "ACK WATCH 0\n":
+            self.assertTrue(response.startswith("NOTICE POS "))
+            response = ser.readline()
+        time.sleep(3.0 * period / 1000)
+        self.assertEqual(ser.inWaiting(), 0)
+
+    def testReportsDuringMove(self):
+        ser.write("WATCH 50\n")
+        response = ser.readline()
+        self.assertEqual(response, "ACK WATCH 50\n")
+
+        ser.write("GO 1 200 1000\n")
+        reports = []
+        response = ser.readline()
+        while response != "NOTICE DONE 1\n":
+            if response.startswith("NOTICE POS "):
+                words = response.split()
+                reports.append((int(words[3]), words[-1][0]))
+            else:
+                self.assertEqual(response, "ACK GO 1 200 1000\n")
+            response = ser.readline()
+
+        # The axis is seen on its way there, and never goes backwards
+        self.assertTrue(len([r for r in reports if r[1] == "1" and 0 < r[0] < 200]) > 0)
+        positions = [r[0] for r in reports]
+        self.assertEqual(positions, sorted(positions))
+
+        ser.write("GO 1 0 1000\n")
+        response = ser.readline()
+        while response != "NOTICE DONE 1\n":
+            response = ser.readline()
+
+    def testBinaryReports(self):
+        ser.write("BINARY\n")
+        response = ser.readline()
+        self.assertEqual(response, "ACK BINARY\n")
+
+        ser.write(encodeCommand("WATCH 100\n"))
+        for expected in ["ACK WATCH 100", "NOTICE POS "]:
+            header = ser.read(2)
+            self.assertEqual(len(header), 2)
+            response = decodeReply(bytearray(header + ser.read(ord(header[1]) + 1)))
+            self.assertTrue(response.startswith(expected), response)
+
 
 class FUZZtests(controllerTest):
     """ Throw a bunch of random stuff at the board, then see if it still
@@ -346,6 +671,19 @@ class FUZZtests(controllerTest):
 
 
 if __name__ == '__main__':
+    port = defaultPort
+    if len(sys.argv) > 1:
+        port = sys.argv[1]
+
+    if port == '--sim':
+        from ControllerSimulator import ControllerSimulator
+        # The moves in GOtests need MAX_VEL set to 400 or more
+        sim = ControllerSimulator(maxVelocity=400)
+        sim.start()
+        port = sim.port
+
+    ser = serial.Serial(port, 9600, timeout = 4)
+
     suite = unittest.TestSuite()
 
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(GETtests))
@@ -353,6 +691,10 @@ if __name__ == '__main__':
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(HOMEtests))
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(STATEtests))
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(GOtests))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(QUEUEtests))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(BINARYtests))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(BAUDtests))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(WATCHtests))
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(FUZZtests))
 
     unittest.TextTestRunner(verbosity=2).run(suite)
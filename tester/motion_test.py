@@ -5,20 +5,34 @@
 # first three stepper motors.
 
 from CameraController import *
+from MotionScript import *
+from Rig import *
 from StepperAxis import *
 
+import getopt
+import itertools
+import logging
 import serial
 import time
 import sys
+import Trace
 
-handlerXYZ = SerialHandler(port="/dev/ttyUSB1", baud=9600)
-handlerA = SerialHandler(port="/dev/ttyUSB0", baud=9600)
+# Each frame is logged at INFO as it's run; -v adds every command at DEBUG
+log = logging.getLogger("motion_test")
 
-stepperA = stepperAxis(0, handlerA)
-stepperX = stepperAxis(1, handlerXYZ)
-stepperY = stepperAxis(2, handlerXYZ)
-stepperZ = stepperAxis(3, handlerXYZ)
-camera = CameraController()
+# Which board each axis is on is in rig.cfg
+rig = loadRig(os.path.join(os.path.dirname(os.path.abspath(__file__)), "rig.cfg"))
+
+stepperA = rig.axis("A")
+stepperX = rig.axis("X")
+stepperY = rig.axis("Y")
+stepperZ = rig.axis("Z")
+# Pictures are written to disk from memory, once the camera is free for the
+# next one
+camera = CameraController(DiskSink())
+
+# Pictures download while the next move is going
+capturePipeline = CapturePipeline(camera)
 
 aJog = 20
 xJog = 1
@@ -27,98 +41,151 @@ zJog = 36
 
 maxTime = 180
 
-def getCommandsFromFile(filename):
-    scriptfile = open(filename)
-
-    # Read in the file, stopping if we find an error
-    motionpoints = []
-    linecount = 0
-    for line in scriptfile:
-        linecount += 1
-        if line.startswith("#"):
-            continue
-        elif line.startswith("GO "):
-            points = line.split()
-            try:
-                motionpoints.append(["GO", int(points[1]), int(points[2]), int(points[3]), int(points[4])])
-            except:
-                print "error reading", linecount, ": ", line
-                exit(2)
-        elif line.startswith("HOME "):
-            points = line.split()
-            try:
-                motionpoints.append(["HOME", int(points[1])])
-            except:
-                print "error reading", linecount, ": ", line
-                exit(1)
-        elif line.startswith("SNAP "):
-            points = line.split()
-            try:
-                motionpoints.append(["SNAP", int(points[1])])
-            except:
-                print "error reading", linecount, ": ", line
-                exit(2)
-    return motionpoints
+# First frame of whatever runCommands is in the middle of, which is where to
+# start again if it gets interrupted
+resumeFrame = 0
 
 def waitForDone():
-    timeoutTime = time.time() + maxTime
-    allDone = False
+    steppers = [stepperA, stepperX, stepperY, stepperZ]
 
-    # While there is still time, and we haven't received an immediate
-    # response
-    while ( time.time() < timeoutTime ):
-        if not (stepperA.busy() or stepperX.busy() or stepperY.busy() or stepperZ.busy()):
-            return
+    # Sleep until every axis reports DONE, or we run out of time
+    finished = waitForAxes(steppers, maxTime)
+    if len(finished) == len(steppers):
+        return finished
 
     # Timed out. TODO: throw exception
     raise NameError("timed out waiting for steppers to complete movement!")
 
 
-def runCommands(points, dirname):
-    pointcount = 0
-    for point in points:
-        print point
-        if (point[0] == "GO"):
-            stepperA.moveAbsolute(point[1])
-            stepperX.moveAbsolute(point[2])
-            stepperY.moveAbsolute(point[3])
-            stepperZ.moveAbsolute(point[4])
+def logFrames(frames):
+    """ Positions of each GO frame, saying which one is being queued """
+    for index, opcode, values in frames:
+        log.info("%d: %s", index, frameText(opcode, values))
+        yield values
+
+def runCommands(frames, snap, queueMoves = False):
+    """ Run (index, opcode, values) frames, from a compiled script or
+        straight from streamScript(). snap(index) takes the picture for a
+        SNAP frame. With queueMoves, runs of GOs go to the controllers' move
+        queues. """
+    global resumeFrame
+    steppers = [stepperA, stepperX, stepperY, stepperZ]
+    for opcode, group in itertools.groupby(frames, lambda frame: frame[1]):
+        first = next(group)
+        resumeFrame = first[0]
+        if (opcode == OP_GO and queueMoves):
+            # A run of GOs with nothing in between can go to the controllers'
+            # move queues all at once, instead of stopping at every point.
+            # They are handed over as they are read, however many there are.
+            # Each move becomes a LINE, and each board runs through its queue
+            # without waiting for the others, so the path isn't quite the
+            # one the script gives.
+            second = next(group, None)
+            if (second == None):
+                log.info("%d: %s", first[0], frameText(opcode, first[2]))
+                span = "GO"
+                traceId = Trace.begin(Trace.CAT_FRAME, span)
+                moveAxesAbsolute(steppers, first[2], moveTime=first[2][positionCount])
+            else:
+                span = "GO run"
+                traceId = Trace.begin(Trace.CAT_FRAME, span)
+                goFrames = logFrames(itertools.chain([first, second], group))
+                streamAxesAbsolute(steppers, goFrames, timeout=maxTime)
 
             waitForDone()
+            Trace.end(Trace.CAT_FRAME, span, traceId)
+            continue
 
-        elif(point[0] == "HOME"):
-            if (point[1] == 0):
-                stepperA.home()
-            elif (point[1] == 1):
-                stepperX.home()
-            elif (point[1] == 2):
-                stepperY.home()
-            elif (point[1] == 3):
-                stepperZ.home()
-
-            waitForDone()
+        for index, opcode, values in itertools.chain([first], group):
+            resumeFrame = index
+            log.info("%d: %s", index, frameText(opcode, values))
+            traceId = Trace.begin(Trace.CAT_FRAME, opcodeNames[opcode])
+            if(opcode == OP_GO):
+                moveAxesAbsolute(steppers, values, moveTime=values[positionCount])
+                waitForDone()
 
-        elif(point[0] == "SNAP"):
-            if(point[1] == 0):
-                camera.capture('%s/%010d.jpg' % (dirname, pointcount))
+            elif(opcode == OP_HOME):
+                steppers[values[0]].home()
+                waitForDone()
 
-        pointcount += 1
+            elif(opcode == OP_SNAP):
+                if(values[0] == 0):
+                    snap(index)
+            Trace.end(Trace.CAT_FRAME, opcodeNames[opcode], traceId)
 
 def usage():
-    print "file=?"
+    print "usage: motion_test.py [-v | -q] [--stream] [--queue] [--merge] [--preview] [--start frame] [--trace file] script"
 
 def main(argv):
-    input = argv[0]
+    try:
+        opts, args = getopt.getopt(argv, "vq", ["stream", "queue", "merge", "preview", "start=", "trace="])
+        options = dict(opts)
+        start = int(options.get("--start", 0))
+        input = args[0]
+    except (getopt.GetoptError, ValueError, IndexError):
+        usage()
+        exit(2)
+
+    level = logging.INFO
+    if "-v" in options:
+        level = logging.DEBUG
+    if "-q" in options:
+        level = logging.WARNING
+    logging.basicConfig(level=level, format="%(message)s")
+
+    if "--trace" in options:
+        # Where the time goes: every command, picture and frame
+        Trace.enable()
 
     print input
 
-    points = getCommandsFromFile(input)
-
-    dirname = input + "_pics"
-    if not os.path.exists(dirname):
-        os.makedirs(dirname)
-
-    runCommands(points, dirname)
+    if "--stream" in options and not input.endswith(cacheSuffix):
+        # Start moving as soon as the first frame is read; a bad line stops
+        # the run when we get to it. (A compiled script is only loaded.)
+        frames = streamScript(input, start)
+    else:
+        # Check the whole script before anything moves
+        try:
+            frames = compileScript(input).frames(start)
+        except NameError, e:
+            print e.args[0]
+            exit(2)
+
+    if "--merge" in options:
+        # Go straight to the end of each run of GOs, instead of through
+        # every point on the way
+        frames = mergeMoves(frames)
+
+    preview = None
+    if "--preview" in options:
+        # A quick look at the whole run: live view pictures instead of
+        # stills, all in one video file
+        preview = MjpegSink(input + ".mjpeg", append=(start > 0))
+        snap = lambda index: camera.preview("%010d" % index, preview)
+    else:
+        dirname = input + "_pics"
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        snap = lambda index: capturePipeline.capture('%s/%010d.jpg' % (dirname, index))
+
+    try:
+        runCommands(frames, snap, queueMoves=("--queue" in options))
+    except (NameError, KeyboardInterrupt):
+        flags = [flag + " " for flag in ["--stream", "--queue", "--merge", "--preview"] if flag in options]
+        print "stopped; to pick up from here: motion_test.py %s--start %d %s" % (
+            "".join(flags), resumeFrame, input)
+        raise
+    finally:
+        # Save whatever was taken before stopping
+        capturePipeline.close()
+        if preview != None:
+            preview.close()
+        for name, error in capturePipeline.failures:
+            print "couldn't save", name, ":", error
+        rig.report()
+        if Trace.recorder != None:
+            Trace.recorder.report()
+            Trace.recorder.saveChromeTrace(options["--trace"])
 
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -0,0 +1,44 @@
+#!/usr/bin/python
+
+# Measure command throughput of SerialHandler against a simulated controller
+# on a 9600 baud link, for a range of pipelining window sizes.
+
+from ControllerSimulator import *
+from StepperAxis import *
+
+import sys
+import time
+
+commandCount = 200
+baud = 9600
+
+
+def benchmark(window):
+    sim = ControllerSimulator(baud=baud)
+    sim.start()
+    handler = SerialHandler(port=sim.port, baud=baud, rates=[])
+    handler.setWindow(window)
+
+    commands = []
+    for i in range(commandCount):
+        commands.append("GET POS " + str(i % controllerAxisCount + 1) + "\n")
+
+    startTime = time.time()
+    responses = handler.sendCommands(commands)
+    elapsed = time.time() - startTime
+
+    handler.disconnect()
+    sim.stop()
+
+    errors = len([r for r in responses if not r.startswith("ACK ")])
+    print "window %2d: %6.1f commands/s  rx backlog %3d/%d chars  overflows %d  errors %d" % (
+        window, commandCount / elapsed, sim.maxRxBacklog, controllerRxBufferSize,
+        sim.overflows, errors)
+
+
+def main(argv):
+    for window in [1, 2, 3, 4, 6, 8, 16]:
+        benchmark(window)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+
+# Time planning a long script: a frame at a time with planMove(), and all at
+# once with Planner.py, checking they agree. Also checks the plan against
+# the controller's own timing, by running the first moves on BoardModel.
+#
+# Usage: planner_benchmark.py [frames [acceleration]]
+
+from MotionScript import OP_GO, positionCount
+from Planner import planScript, scriptArrays
+from StepperModel import BoardModel, defaultMaxVelocity, planMove, tickFrequency
+from Trajectory import compileFrames, frameTimes, lissajous, quantize
+
+import sys
+import time
+
+# Moves run on BoardModel to check the plan against
+checkedMoves = 200
+
+
+def loopPlan(script, maxVelocity, acceleration):
+    """ Every frame's time, the way it would be done without NumPy """
+    times = []
+    previous = [0] * positionCount
+    for opcode, values in script:
+        if opcode != OP_GO:
+            times.append(0)
+            continue
+        positions = values[:positionCount]
+        times.append(max([planMove(abs(position - last), values[positionCount],
+                                   maxVelocity, acceleration)[0]
+                          if position != last else 0
+                          for position, last in zip(positions, previous)]))
+        previous = positions
+    return times
+
+
+def main(argv):
+    frames = int((argv + [100000])[0])
+    acceleration = int((argv[1:] + [0])[0])
+
+    t = frameTimes(frames)
+    steps = quantize(lissajous(t, [1000, 3750, 4000, 600], [1, 300, 300, 7],
+                               centers=[1000, 3750, 4000, 600]))
+    script = compileFrames(steps)
+
+    startTime = time.time()
+    expected = loopPlan(script, defaultMaxVelocity, acceleration)
+    loopTime = time.time() - startTime
+
+    startTime = time.time()
+    plan = planScript(script, defaultMaxVelocity, acceleration)
+    vectorTime = time.time() - startTime
+
+    mismatches = (plan.frameTimes != expected).sum()
+    print "%d frames: loop %.3f s, vectorized %.3f s (%.0fx), %d frames disagree" % (
+        len(script), loopTime, vectorTime, loopTime / vectorTime, mismatches)
+
+    # How close planMove's times are to the ticks the moves really take
+    board = BoardModel(positionCount, defaultMaxVelocity, acceleration)
+    opcodes, values = scriptArrays(script)
+    planned = 0
+    run = 0
+    for index in range(min(len(script), checkedMoves * 2)):
+        if opcodes[index] == OP_GO:
+            ticks = board.moveAll(values[index, :positionCount].tolist())
+            run += max(ticks) * 1000.0 / tickFrequency
+            planned += plan.frameTimes[index]
+    print "first %d moves: planned %.1f s, run on BoardModel %.1f s (%+.2f%%)" % (
+        checkedMoves, planned / 1000, run / 1000, 100 * (planned - run) / run)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
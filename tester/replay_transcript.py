@@ -0,0 +1,213 @@
+#!/usr/bin/python
+
+# Play back a session recorded with a transcript (see Transcript.py), so a
+# run of motion_test.py can be timed again without the rig that ran it.
+#
+# --client (the default) plays the controller's side of it back to a
+# SerialHandler, and sends the recorded commands through the handler again,
+# which times the host code. --controller sends the recorded commands to a
+# ControllerSimulator instead.
+#
+# Each command waits until as many messages have come back as had in the
+# recording, and each reply until as many commands have gone out, so things
+# happen in the same order however fast they go. Without --fast they also
+# wait until as far into the replay as they were into the recording.
+#
+# Usage: replay_transcript.py [--client | --controller] [--fast] [--speed N] transcript
+
+from BinaryProtocol import FrameDecoder, decodeCommand, frameStart
+from ControllerSimulator import ControllerSimulator
+from StepperAxis import SerialHandler
+from Transcript import readTranscript, roundTrips, splitTranscript
+
+import optparse
+import os
+import select
+import serial
+import sys
+import time
+from collections import deque
+
+# Seconds to wait for what should come next before giving up on the replay
+stallTime = 30
+
+
+class TranscriptController(ControllerSimulator):
+    """ Sends back what the controller sent in the recording, once the host
+        has sent as many commands as it had by then """
+    def __init__(self, replies, fast):
+        ControllerSimulator.__init__(self)
+        self.replies = deque(replies)
+        self.fast = fast
+        self.commandCount = 0
+
+    def receiveLine(self, line, size, framed, error):
+        if line != "" or error != None:
+            self.commandCount += 1
+
+    def sendReplies(self):
+        """ Send every reply that's due. Returns the seconds until the next
+            one will be, if it's only waiting on the time. """
+        while len(self.replies) > 0:
+            t, data, commands = self.replies[0]
+            if commands > self.commandCount:
+                return None
+            if not self.fast and self.startTime + t > time.time():
+                return self.startTime + t - time.time()
+            self.write(data)
+            self.replies.popleft()
+        return None
+
+    def run(self):
+        while self.running:
+            timeout = self.sendReplies()
+            if timeout == None:
+                timeout = 0.1
+            readable, _, _ = select.select([self.master], [], [], timeout)
+            if readable:
+                for message in self.parseInput(os.read(self.master, 4096)):
+                    self.receiveLine(*message)
+
+
+def commandText(data):
+    """ A recorded command as text, the way sendCommand() takes it """
+    if ord(data[0]) & frameStart:
+        return decodeCommand(bytearray(data)) + "\n"
+    return data
+
+
+def replayClient(records, fast):
+    """ Run the recorded commands through a SerialHandler. Returns the time
+        it took and the round trip of each command. """
+    commands, replies, messageCount = splitTranscript(records)
+    controller = TranscriptController(replies, fast)
+    handler = SerialHandler(port=controller.port, baud=9600, rates=[])
+
+    startTime = time.time()
+    controller.startTime = startTime
+    controller.start()
+    try:
+        for t, data, messages in commands:
+            if not handler.waitUntil(lambda: handler.messagesReceived >= messages, stallTime):
+                raise NameError("Replay stuck waiting for message: ", messages)
+            if not fast:
+                time.sleep(max(0, startTime + t - time.time()))
+
+            command = commandText(data)
+            if command == "BINARY\n":
+                # The handler has to know, to send frames from here on
+                handler.enableBinary()
+            else:
+                handler.sendCommandAsync(command)
+
+        if not handler.waitUntil(lambda: handler.messagesReceived >= messageCount, stallTime):
+            raise NameError("Replay stuck waiting for message: ", messageCount)
+        elapsed = time.time() - startTime
+    finally:
+        handler.disconnect()
+        controller.stop()
+    return elapsed, list(handler.roundTrips)
+
+
+class HostReplay:
+    """ Sends the recorded commands to a controller, the way the host did """
+    def __init__(self, port):
+        self.ser = serial.Serial(port, 9600)
+        self.decoder = FrameDecoder()
+        self.messageCount = 0
+        self.sentTimes = []
+        self.roundTrips = []
+
+    def read(self, timeout):
+        readable, _, _ = select.select([self.ser], [], [], max(0, timeout))
+        if not readable:
+            return
+        now = time.time()
+        for message, size, framed in self.decoder.feed(self.ser.read(max(1, self.ser.inWaiting()))):
+            if message.startswith("ACK ") or message.startswith("ERROR "):
+                if len(self.roundTrips) < len(self.sentTimes):
+                    self.roundTrips.append(now - self.sentTimes[len(self.roundTrips)])
+            if not message.startswith("NOTICE POS "):
+                self.messageCount += 1
+
+    def waitForMessages(self, count, timeout):
+        """ Read until count messages have come back. Returns False on
+            timeout. """
+        timeoutTime = time.time() + timeout
+        while self.messageCount < count:
+            if time.time() > timeoutTime:
+                return False
+            self.read(timeoutTime - time.time())
+        return True
+
+    def send(self, data):
+        self.sentTimes.append(time.time())
+        self.ser.write(data)
+
+
+def replayController(records, fast, speed):
+    """ Send the recorded commands to a simulated controller. Returns the
+        time it took and the round trip of each command. """
+    commands, replies, messageCount = splitTranscript(records)
+    sim = ControllerSimulator(speed=speed)
+    sim.start()
+    host = HostReplay(sim.port)
+
+    startTime = time.time()
+    try:
+        for t, data, messages in commands:
+            if not host.waitForMessages(messages, stallTime):
+                raise NameError("Replay stuck waiting for message: ", messages)
+            if not fast:
+                while time.time() < startTime + t:
+                    host.read(startTime + t - time.time())
+            host.send(data)
+
+        # The simulator might not do everything the controller did
+        if not host.waitForMessages(messageCount, stallTime):
+            print "only got %d of %d messages back" % (host.messageCount, messageCount)
+        elapsed = time.time() - startTime
+    finally:
+        host.ser.close()
+        sim.stop()
+    return elapsed, host.roundTrips
+
+
+def report(name, elapsed, times):
+    times = sorted(times)
+    if len(times) == 0:
+        print "%-8s no commands" % name
+        return
+    print "%-8s %5d commands in %8.3f s  round trip p50 %6.2f ms  p99 %6.2f ms  max %6.2f ms" % (
+        name, len(times), elapsed, 1000 * times[len(times) / 2],
+        1000 * times[int(len(times) * 0.99)], 1000 * times[-1])
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options] transcript")
+    parser.add_option("--client", action="store_false", dest="controller", default=False,
+                      help="time SerialHandler, with the recorded replies (default)")
+    parser.add_option("--controller", action="store_true", dest="controller",
+                      help="time a simulated controller, with the recorded commands")
+    parser.add_option("--fast", action="store_true", default=False,
+                      help="go as fast as possible, instead of at the recorded speed")
+    parser.add_option("--speed", type="float", default=1,
+                      help="simulated seconds per real second, for --controller")
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("which transcript?")
+
+    records = readTranscript(args[0])
+    if len(records) == 0:
+        print "nothing in the transcript"
+        return
+
+    if options.controller:
+        elapsed, times = replayController(records, options.fast, options.speed)
+    else:
+        elapsed, times = replayClient(records, options.fast)
+    report("recorded", records[-1][0], roundTrips(records))
+    report("replayed", elapsed, times)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+
+# Time a frame (move every axis a step, wait for them all) on rigs of more
+# and more simulated boards, with the boards sent their moves one after
+# another, and all at once the way Rig.moveTo() does it. Each board takes
+# latency seconds to answer a command.
+#
+# Usage: rig_benchmark.py [latency]
+
+from ControllerSimulator import *
+from Rig import *
+
+import sys
+import time
+
+frameCount = 20
+
+
+def run(boardCount, latency, parallel):
+    sims = [ControllerSimulator(latency=latency) for i in range(boardCount)]
+    for sim in sims:
+        sim.start()
+
+    boards = connectBoards(dict([("board%d" % i, {"port": sim.port, "baud": 9600, "rates": []})
+                                 for i, sim in enumerate(sims)]))
+    axes = [("%d.%d" % (i, axis), "board%d" % i, axis)
+            for i in range(boardCount) for axis in range(1, controllerAxisCount + 1)]
+    rig = Rig(boards, axes)
+
+    # Getting the current positions isn't part of a frame
+    rig.moveTo([0] * len(axes))
+    rig.wait(10)
+
+    startTime = time.time()
+    for frame in range(1, frameCount + 1):
+        if parallel:
+            rig.moveTo([frame] * len(axes))
+        else:
+            for board in range(boardCount):
+                steppers = rig.steppers[board * controllerAxisCount:(board + 1) * controllerAxisCount]
+                moveAxesAbsolute(steppers, [frame] * len(steppers))
+        if not rig.wait(10):
+            raise NameError("timed out waiting for frame: ", frame)
+    elapsed = time.time() - startTime
+
+    latencies = rig.latencies()
+    rig.disconnect()
+    for sim in sims:
+        sim.stop()
+    return elapsed / frameCount, max([latencies[name][1] for name in latencies])
+
+
+def main(argv):
+    latency = float((argv + [0.02])[0])
+    for boardCount in [1, 2, 4, 8]:
+        oneAtATime, roundTrip = run(boardCount, latency, False)
+        allAtOnce, roundTrip = run(boardCount, latency, True)
+        print "%d boards: %6.1f ms/frame one at a time, %6.1f ms/frame all at once (round trip %5.1f ms)" % (
+            boardCount, 1000 * oneAtATime, 1000 * allAtOnce, 1000 * roundTrip)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
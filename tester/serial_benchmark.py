@@ -0,0 +1,78 @@
+#!/usr/bin/python
+
+# Measure ACK latency and host CPU use of SerialHandler against a simulated
+# controller on a pty, comparing the buffered reader against the old
+# byte-at-a-time busy loop.
+
+from ControllerSimulator import *
+from StepperAxis import *
+
+import os
+import sys
+import time
+
+commandCount = 300
+
+
+class LegacySerialHandler(SerialHandler):
+    """ The original reader: one read(1) per byte, spinning on inWaiting() """
+    def startReader(self):
+        pass
+
+    def sendCommand(self, command):
+        self.ser.write(command)
+        return self.getImmediateResponse()
+
+    def getImmediateResponse(self):
+        timeoutTime = time.time() + self.timeout
+        buffer = ""
+        while ( time.time() < timeoutTime ):
+            while (self.ser.inWaiting() > 0):
+                buffer += self.ser.read(1)
+                if (buffer.endswith("\n")):
+                    message = buffer.split('\n',1)[0]
+                    buffer = ""
+                    if (message.startswith("ACK ") or message.startswith("ERROR ")):
+                        return message
+        raise NameError("timed out waiting for response from Arduino!")
+
+
+def benchmark(handlerClass, port, latency):
+    handler = handlerClass(port=port, baud=9600, rates=[])
+
+    latencies = []
+    startTimes = os.times()
+    for i in range(commandCount):
+        sent = time.time()
+        handler.sendCommand("GET POS 1\n")
+        latencies.append(time.time() - sent)
+    endTimes = os.times()
+
+    handler.disconnect()
+
+    wallTime = endTimes[4] - startTimes[4]
+    cpuTime = (endTimes[0] - startTimes[0]) + (endTimes[1] - startTimes[1])
+    latencies.sort()
+
+    print "%-20s %4.1f ms reply delay: mean %6.3f ms  p50 %6.3f ms  p99 %6.3f ms  cpu %5.1f%%" % (
+        handlerClass.__name__, 1000 * latency,
+        1000 * sum(latencies) / len(latencies),
+        1000 * latencies[len(latencies) / 2],
+        1000 * latencies[int(len(latencies) * 0.99)],
+        100 * cpuTime / max(wallTime, 0.01))
+
+
+def main(argv):
+    # With no reply delay this measures the per-command overhead, with a
+    # delay it shows how much CPU is burnt waiting for the ACK
+    for latency in [0, 0.005]:
+        sim = ControllerSimulator(latency=latency)
+        sim.fork()
+        try:
+            for handlerClass in [LegacySerialHandler, SerialHandler]:
+                benchmark(handlerClass, sim.port, latency)
+        finally:
+            sim.stop()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
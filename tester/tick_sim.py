@@ -0,0 +1,54 @@
+#!/usr/bin/python
+
+# Count stepper interrupt ticks for every GO frame of a motion script, with
+# each axis moving independently (GO/GOALL) and with coordinated LINE moves,
+# using the host-side model of the stepper ISR.
+#
+# Usage: tick_sim.py soa_beetle
+
+from StepperModel import *
+
+import sys
+
+# The A axis is on its own controller, X, Y and Z share another
+boardAxes = [[0], [1, 2, 3]]
+
+
+def readFrames(filename):
+    frames = []
+    for line in open(filename):
+        if line.startswith("GO "):
+            frames.append([int(value) for value in line.split()[1:5]])
+    return frames
+
+
+def simulate(frames, coordinated):
+    """ Returns the total ticks, and the ticks axis spent parked waiting for
+        the slowest axis of their frame (only ever on the other controller, or
+        not moving at all, when coordinated) """
+    boards = [BoardModel(len(axes)) for axes in boardAxes]
+    totalTicks = 0
+    idleTicks = 0
+
+    for frame in frames:
+        axisTicks = []
+        for board, axes in zip(boards, boardAxes):
+            axisTicks += board.moveAll([frame[axis] for axis in axes], 0, coordinated)
+        frameTicks = max(axisTicks)
+        totalTicks += frameTicks
+        idleTicks += sum([frameTicks - ticks for ticks in axisTicks])
+
+    return totalTicks, idleTicks
+
+
+def main(argv):
+    frames = readFrames(argv[0])
+    print len(frames), "GO frames"
+
+    for name, coordinated in [("independent", False), ("coordinated", True)]:
+        totalTicks, idleTicks = simulate(frames, coordinated)
+        print "%-12s %9d ticks (%7.1f s of motion), axis idle %9d ticks" % (
+            name, totalTicks, float(totalTicks) / tickFrequency, idleTicks)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+
+# Time writing the soa_beetle path with more and more frames: the way
+# gen_soa.py used to (a line at a time, with math.sin and string
+# concatenation), and with Trajectory.py as a text script and as a compiled
+# one.
+#
+# Usage: trajectory_benchmark.py [frames]
+
+from Trajectory import *
+
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+rangeX = 7500.0/2
+rangeY = 8000.0/2
+rangeZ = 7200.0/6
+rangeA = 1800.0
+
+
+def oldGenerator(filename, frames):
+    """ gen_soa.py as it was """
+    MAX = frames - 1
+    outfile = open(filename, "w")
+    for a in range (0, MAX+1):
+        outfile.write("GO " + str((int)(a*rangeA/MAX)-100) + " " + str(int((math.sin(a*2*math.pi*3/MAX)+1)*rangeX)) + " " + str(int((math.cos(a*2*math.pi*3/MAX)+1)*rangeY)) + " " + str(int(a*rangeZ/MAX)) + "\n" )
+        outfile.write("SNAP 0\n")
+    outfile.close()
+
+
+def beetle(frames):
+    t = frameTimes(frames)
+    return quantize(line(t, [-100, 0, 0, 0], [rangeA - 100, 0, 0, rangeZ]) +
+                    lissajous(t, [0, rangeX, rangeY, 0], [0, 3, 3, 0],
+                              phases=[0, 0, math.pi / 2, 0], centers=[0, rangeX, rangeY, 0]))
+
+
+def textGenerator(filename, frames):
+    writeScript(filename, beetle(frames))
+
+
+def compiledGenerator(filename, frames):
+    writeCompiled(filename, beetle(frames))
+
+
+def main(argv):
+    largest = int((argv + [1000000])[0])
+    directory = tempfile.mkdtemp()
+    try:
+        frames = 1000
+        while frames <= largest:
+            times = []
+            for generator in [oldGenerator, textGenerator, compiledGenerator]:
+                filename = os.path.join(directory, generator.__name__)
+                startTime = time.time()
+                generator(filename, frames)
+                times.append(time.time() - startTime)
+            print "%8d frames: old %8.3f s  text %7.3f s (%5.1fx)  compiled %7.3f s (%6.1fx)" % (
+                frames, times[0], times[1], times[0] / times[1], times[2], times[0] / times[2])
+            frames *= 10
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])